@@ -6,18 +6,22 @@
 from datetime import datetime
 import mimetypes
 import json
-import os
 import typing
 from cattr import unstructure
-from flask import request, jsonify, current_app
-from flask import make_response
+from flask import request, jsonify, current_app, stream_with_context
+from flask import Response
 from flask import Blueprint
-from loguru import logger
-from spiders import SpiderManager
-from models import Fictions, SimpleChapter, MiddleChapter, FictionChapters
-from models import SpiderConfig, EmailConfig
+from werkzeug.wsgi import wrap_file
+from spiders import SpiderManager, BaseSpider
+from spiders.spider import rate_limiter, circuit_breaker
+from models import Fictions, FictionChapters
+from models import SpiderConfig, EmailConfig, TaskJobs, LibraryCounters, ChapterJobs
 from models import db
-from utils import rabbitmq, email
+from utils import rabbitmq, export_cache
+from utils.segment_store import store as segment_store
+from utils.delivery import delivery, export_file_name, remove_orphaned_files
+from utils.epub import fragment_cache
+from utils.progress import progress_hub
 
 api_v1_blueprint = Blueprint('api_v1_blueprint', __name__, url_prefix='/api/v1')
 
@@ -29,11 +33,12 @@ def search_fiction_by_name():
     """
     fiction_name = request.json.get('fiction_name', '')
     spider_manager = SpiderManager()
-    fictions = spider_manager.search_fictions_by_name(fiction_name)
+    fictions, site_statuses = spider_manager.search_fictions_concurrently(fiction_name)
     ret = {
         'code': 0,
         'total': len(fictions),
-        'fictions': unstructure(fictions)
+        'fictions': unstructure(fictions),
+        'sites': unstructure(site_statuses)
     }
     return jsonify(ret)
 
@@ -65,75 +70,122 @@ def add_fiction():
 def update_fiction_by_id():
     """
     根据给定的小说编号，从数据库中加载小说信息，并通过爬虫采集小说章节列表，
-    将新增章节推送到采集队列中等待采集
+    将新增章节推送到采集队列中等待采集。
+    章节目录没有变化时只需要一次条件请求，有变化时只比对新增的尾部章节
     """
     fiction_id = request.json.get('fiction_id')
+    # 为True时忽略目录缓存校验信息，重新比对全部章节
+    full = request.json.get('full', False)
     fiction: Fictions = Fictions.query.get(fiction_id)
     if not fiction:
         raise Exception('指定小说不存在！')
-    # 获取已经缓存的章节列表
-    chapter_origin_ids = {item[0] for item in fiction.cached_chapter_origin_ids}
-    # 使用爬虫加载最新的章节列表
+    # 使用爬虫带条件地请求最新的章节目录，并找出需要采集的章节
     spider_manager = SpiderManager()
-    simple_chapters: typing.List[SimpleChapter] = spider_manager.get_chapters(fiction.fiction_url, fiction.fiction_name,
-                                                                              fiction.site)
-    # 更新fiction中完整章节数
-    fiction.fiction_chapters_total = len(simple_chapters)
-    fiction.update_time = datetime.now()
-    db.session.commit()
-    # 过滤出需要采集的章节列表
-    uncached_chapters = [chapter for chapter in simple_chapters if chapter.origin_id not in chapter_origin_ids]
-    # 推送到采集队列中
-    connection, channel = rabbitmq.create_rabbitmq_connection()
-    for chapter in uncached_chapters:
-        middle_chapter = MiddleChapter(origin_id=chapter.origin_id, chapter_name=chapter.chapter_name,
-                                       chapter_url=chapter.chapter_url, chapter_order=chapter.chapter_order,
-                                       fiction_id=fiction_id, chapter_content='', site=fiction.site,
-                                       fiction_url=fiction.fiction_url)
-        rabbitmq.send_msg(channel, json.dumps(unstructure(middle_chapter)))
-    connection.close()
+    toc, uncached_chapters = spider_manager.refresh_fiction(fiction, full=full)
+    # 交给后台发布器批量推送到采集队列中，不阻塞当前请求
+    job_id = ''
+    if uncached_chapters:
+        bodies = [json.dumps(unstructure(middle_chapter)) for middle_chapter in uncached_chapters]
+        job = TaskJobs.create_job('enqueue', fiction_id=fiction_id, total=len(bodies))
+        job_id = job.job_id
+        rabbitmq.publisher.submit(bodies, SpiderManager.make_publish_callback(job_id, fiction_id))
     # 返回响应
     ret = {
         'code': 0,
         'msg': '请求成功！',
-        'uncached_chapters': len(uncached_chapters)
+        'uncached_chapters': len(uncached_chapters),
+        'not_modified': toc.not_modified,
+        'job_id': job_id
     }
     return jsonify(ret)
 
 
+@api_v1_blueprint.route('/jobs/<job_id>/', methods=['GET'])
+def check_job_status(job_id):
+    """
+    查询后台任务的执行状态
+
+    Args:
+        job_id: 任务编号
+    """
+    job: TaskJobs = TaskJobs.query.get(job_id)
+    if not job:
+        raise Exception('任务不存在！')
+    if job.is_orphaned():
+        # 执行任务的进程已经退出，任务不会再有进展
+        remove_orphaned_files(TaskJobs.fail_orphaned_jobs([job_id]))
+        job = TaskJobs.query.get(job_id)
+    ret = {
+        'code': 0,
+        'msg': '请求成功！',
+        'job': job.to_dict()
+    }
+    return jsonify(ret)
+
+
+def encode_fictions_cursor(fiction: Fictions):
+    """
+    将小说的排序键编码成分页游标
+    """
+    return '{}_{}'.format(fiction.update_time.strftime('%Y%m%d%H%M%S%f'), fiction.fid)
+
+
+def decode_fictions_cursor(cursor: str):
+    """
+    解析分页游标
+
+    Returns:
+        typing.Tuple[datetime, int]，小说的更新时间和编号
+    """
+    try:
+        update_time, fid = cursor.split('_')
+        return datetime.strptime(update_time, '%Y%m%d%H%M%S%f'), int(fid)
+    except ValueError:
+        raise Exception('分页游标不正确！')
+
+
 @api_v1_blueprint.route('/fictions/all/', methods=['POST'])
 def all_fictions():
     """
-    读取全部小说信息
+    读取全部小说信息。
+    传入cursor时按游标分页，第一页传空字符串，之后传上一页返回的next_cursor；不传时按cur_page分页
     """
-    cur_page = request.json.get('cur_page', 0)
     page_size = request.json.get('page_size', 18)
+    cursor = request.json.get('cursor')
     # 按时间倒序
-    fictions = Fictions.query.order_by(Fictions.update_time.desc()).limit(page_size).offset(
-        (cur_page - 1) * page_size).all()
-    # 统计每个小说当前缓存了多少章节
-    fiction_ids = {fiction.fid for fiction in fictions}
-    count_result = FictionChapters.query.with_entities(FictionChapters.fiction_id,
-                                                       db.func.count(FictionChapters.fcid)).filter(
-        FictionChapters.fiction_id.in_(fiction_ids)).group_by(FictionChapters.fiction_id).all()
-    chapters_count_map = {fiction_id: chapters_count for fiction_id, chapters_count in count_result}
-    # 转小说信息转成dict，并将缓存章节数量注入其中
+    query = Fictions.query.order_by(Fictions.update_time.desc(), Fictions.fid.desc())
+    if cursor is not None:
+        # 游标分页：从上一页最后一本小说之后继续读取，不受页码深度影响。
+        # 条件展开成 update_time < t OR (update_time = t AND fid < f)，而不是行值比较 (update_time, fid) < (t, f)，
+        # 两种写法结果相同，展开后各个数据库都能按(update_time, fid)索引范围扫描
+        if cursor:
+            update_time, fid = decode_fictions_cursor(cursor)
+            query = query.filter(db.or_(Fictions.update_time < update_time,
+                                        db.and_(Fictions.update_time == update_time, Fictions.fid < fid)))
+        fictions = query.limit(page_size).all()
+    else:
+        # 兼容按页码分页
+        cur_page = request.json.get('cur_page', 0)
+        fictions = query.limit(page_size).offset((cur_page - 1) * page_size).all()
+    # 转小说信息转成dict，缓存章节数量直接读取小说上维护的计数
     fiction_infos = []
     for fiction in fictions:
         fiction_info = fiction.to_dict()
-        fiction_info['cached_chapters_number'] = chapters_count_map.get(fiction.fid, 0)
+        fiction_info['cached_chapters_number'] = fiction.cached_chapters_count
         if fiction.fiction_chapters_total == 0:
             cached_percentage = 100
         else:
             cached_percentage = fiction_info['cached_chapters_number'] / fiction.fiction_chapters_total * 100
         fiction_info['cached_percentage'] = round(cached_percentage, 2)
         fiction_infos.append(fiction_info)
-    total = Fictions.query.count()
+    total = LibraryCounters.get_value('fictions')
+    next_cursor = encode_fictions_cursor(fictions[-1]) if len(fictions) == page_size else ''
     ret = {
         'code': 0,
         'msg': '请求成功',
         'fictions': fiction_infos,
-        'total': total
+        'total': total,
+        'next_cursor': next_cursor
     }
     return jsonify(ret)
 
@@ -150,11 +202,18 @@ def delete_fiction(fiction_id):
     fiction: Fictions = Fictions.query.get(fiction_id)
     if not fiction:
         raise Exception('指定小说不存在！')
-    # 先删除所有章节
+    # 先删除所有章节和采集队列中的章节登记
     FictionChapters.query.filter(FictionChapters.fiction_id == fiction_id).delete()
+    ChapterJobs.query.filter(ChapterJobs.fiction_id == fiction_id).delete()
     # 再删除小说
     db.session.delete(fiction)
+    LibraryCounters.incr('fictions', -1)
     db.session.commit()
+    # 清理导出缓存、epub章节片段和段文件
+    export_cache.remove_cached_files(fiction_id)
+    fragment_cache.remove(fiction_id)
+    with segment_store.lock(fiction_id):
+        segment_store.remove(fiction_id)
     ret = {
         'code': 0,
         'msg': '删除成功！'
@@ -165,7 +224,9 @@ def delete_fiction(fiction_id):
 @api_v1_blueprint.route('/fictions/download/<fiction_id>/', methods=['GET'])
 def download_fiction(fiction_id):
     """
-    从数据库中读取指定小说章节内容，并组织成txt文件返回
+    从导出缓存中读取指定小说的txt文件并返回，支持ETag和Range请求。
+    mode为delta或range时只导出部分章节，format为epub时导出epub，参数与/fictions/send/相同。
+    下载不会推进推送水位，需要把这次下载当作推送时，传入mark_delivered=1
 
     Args:
         fiction_id: 小说编号
@@ -174,13 +235,76 @@ def download_fiction(fiction_id):
     fiction: Fictions = Fictions.query.get(fiction_id)
     if not fiction:
         raise Exception('指定小说不存在！')
-    # 抽取小说内容
-    fiction_txt_bytes = fiction.generate_txt_bytes()
+    mode = request.args.get('mode', 'full')
+    export_format = request.args.get('format', 'txt')
+    if mode != 'full' or export_format != 'txt':
+        return download_fiction_stream(fiction, mode, export_format)
+    # 缓存过期时会先增量更新缓存文件
+    batch_size = current_app.config.get('EXPORT_BATCH_SIZE')
+    fiction_file, file_size, etag = export_cache.open_cached_txt_file(fiction, batch_size)
     file_name = '{}.txt'.format(fiction.fiction_name)
-    response = make_response(fiction_txt_bytes)
-    mime_type = mimetypes.guess_type(file_name)
-    response.headers['Content-Type'] = mime_type
+    mime_type, _ = mimetypes.guess_type(file_name)
+    # 交给服务器的file_wrapper发送，支持时会使用sendfile零拷贝
+    response = Response(wrap_file(request.environ, fiction_file), mimetype=mime_type, direct_passthrough=True)
+    response.content_length = file_size
+    response.set_etag(etag)
+    response.make_conditional(request, accept_ranges=True, complete_length=file_size)
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(file_name.encode().decode('latin-1'))
+    return response
+
+
+def no_export_range_msg(fiction: Fictions, mode, default_msg):
+    """
+    没有可以导出的章节时的提示。delta方式被还没有缓存的章节阻塞时，说明在等待哪个章节
+    """
+    if mode == 'delta':
+        waiting_order = fiction.waiting_chapter_order()
+        if waiting_order is not None:
+            return '排序为{}的章节还没有缓存，缓存后才能继续推送之后的章节！'.format(waiting_order)
+    return default_msg
+
+
+def download_fiction_stream(fiction: Fictions, mode, export_format):
+    """
+    直接从数据库流式生成小说文件，不经过导出缓存。
+    推送水位和推送到kindle共用，生成完文件并不代表客户端收到了文件，预览或下载工具重试都会消耗水位，
+    所以只有请求中带上mark_delivered=1时，才在文件完整生成后推进水位
+
+    Args:
+        fiction: 小说
+        mode: 导出方式，full、delta或range
+        export_format: 文件格式，txt或epub
+    """
+    if export_format not in ('txt', 'epub'):
+        raise Exception('不支持的文件格式：{}！'.format(export_format))
+    export_range = fiction.resolve_export_range(mode, request.args.get('start'), request.args.get('end'))
+    if not export_range:
+        raise Exception(no_export_range_msg(fiction, mode, '没有需要导出的新章节！'))
+    lower, first, last, delivered = export_range
+    criterion = Fictions.export_range_criterion(first, last)
+    fiction_id = fiction.fid
+    batch_size = current_app.config.get('EXPORT_BATCH_SIZE')
+    name = export_file_name(fiction, lower, first, last)
+    mark_delivered = request.args.get('mark_delivered') in ('1', 'true')
+
+    def generate():
+        if export_format == 'epub':
+            # 已渲染过的章节直接使用缓存的片段，只渲染新章节
+            yield from fiction.iter_epub_bytes(batch_size, criterion, title=name)
+        else:
+            yield from fiction.iter_txt_bytes(batch_size, criterion)
+        if mark_delivered:
+            Fictions.mark_delivered(fiction_id, lower, delivered)
+            db.session.commit()
+
+    file_name = '{}.{}'.format(name, export_format)
+    mime_type = 'application/epub+zip' if export_format == 'epub' else mimetypes.guess_type(file_name)[0]
+    response = Response(stream_with_context(generate()), mimetype=mime_type)
     response.headers['Content-Disposition'] = 'attachment; filename={}'.format(file_name.encode().decode('latin-1'))
+    # 文件中缺少的章节排序范围，格式为 起始-结束,起始-结束
+    missing_chapters = fiction.missing_chapter_ranges(first, last)
+    if missing_chapters:
+        response.headers['X-Missing-Chapters'] = ','.join('{}-{}'.format(*item) for item in missing_chapters)
     return response
 
 
@@ -193,20 +317,67 @@ def check_fiction_cached_progress(fiction_id):
         fiction_id: 小说编号
     """
     fiction_id = int(fiction_id)
-    fiction: Fictions = Fictions.get(fiction_id)
+    # 按主键读取，缓存章节数由爬虫维护，不需要统计章节表
+    fiction: Fictions = Fictions.query.get(fiction_id)
     if not fiction:
         raise Exception('小说不存在！')
     cached_number = fiction.cached_chapters_number
     total_number = fiction.fiction_chapters_total
+    # 采集队列中排队和下载中的章节数
+    job_counts = ChapterJobs.count_by_status(fiction_id)
     ret = {
         'code': 0,
         'msg': '请求成功！',
         'cached_number': cached_number,
-        'total_number': total_number
+        'total_number': total_number,
+        'queued_number': job_counts['queued'],
+        'running_number': job_counts['running'],
+        'failed_number': job_counts['failed']
     }
     return jsonify(ret)
 
 
+@api_v1_blueprint.route('/fictions/progress/stream/', methods=['GET'])
+def stream_fictions_progress():
+    """
+    通过server-sent events推送一本或多本小说的缓存进度，取代定时轮询/fictions/progress/。
+    同一进程内的全部连接共用进度推送中心的一次批量查询，只在进度变化时推送，没有变化时定时发送心跳
+
+    Args:
+        fiction_ids: 查询参数，逗号分隔的小说编号
+    """
+    try:
+        fiction_ids = sorted({int(fiction_id) for fiction_id in request.args.get('fiction_ids', '').split(',')
+                              if fiction_id.strip()})
+    except ValueError:
+        raise Exception('小说编号不正确！')
+    if not fiction_ids:
+        raise Exception('请指定小说编号！')
+    app = current_app._get_current_object()
+    keepalive = current_app.config.get('PROGRESS_KEEPALIVE')
+
+    def generate():
+        sent = {}
+        version = 0
+        with progress_hub.subscribe(app, fiction_ids):
+            while True:
+                version, snapshot = progress_hub.wait(version, keepalive)
+                changed = [snapshot[fiction_id] for fiction_id in fiction_ids
+                           if fiction_id in snapshot and snapshot[fiction_id] != sent.get(fiction_id)]
+                if changed:
+                    for item in changed:
+                        sent[item['fiction_id']] = item
+                    yield 'event: progress\ndata: {}\n\n'.format(json.dumps(changed))
+                else:
+                    yield ': keepalive\n\n'
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 禁止反向代理缓冲，进度可以及时送达
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @api_v1_blueprint.route('/spider_configs/all/', methods=['GET'])
 def all_spider_configs():
     """
@@ -222,6 +393,41 @@ def all_spider_configs():
     return jsonify(ret)
 
 
+@api_v1_blueprint.route('/spider_configs/pool_stats/', methods=['GET'])
+def spider_pool_stats():
+    """
+    读取当前进程中各爬虫连接池的统计信息，以及各域名的限流状态
+    """
+    ret = {
+        'code': 0,
+        'msg': '请求成功！',
+        'pool_stats': BaseSpider.pool_stats(),
+        'rate_limits': rate_limiter.stats() if rate_limiter else []
+    }
+    return jsonify(ret)
+
+
+@api_v1_blueprint.route('/spider_configs/breakers/', methods=['GET'])
+def spider_breakers():
+    """
+    查询各网站的熔断状态
+    """
+    states = circuit_breaker.states() if circuit_breaker else {}
+    breakers = []
+    for spider_config in SpiderConfig.query.all():
+        breaker = states.get(spider_config.site, {'site': spider_config.site, 'state': 'closed', 'since': '',
+                                                  'calls': 0, 'failures': 0, 'retry_after': 0})
+        breaker['spider_status'] = spider_config.spider_status
+        breakers.append(breaker)
+    ret = {
+        'code': 0,
+        'msg': '请求成功！',
+        'enabled': circuit_breaker is not None,
+        'breakers': breakers
+    }
+    return jsonify(ret)
+
+
 @api_v1_blueprint.route('/spider_configs/update/', methods=['POST'])
 def update_spider_config():
     """
@@ -309,7 +515,11 @@ def update_email_config():
 @api_v1_blueprint.route('/fictions/send/<fiction_id>/', methods=['GET'])
 def send_fiction_to_kindle(fiction_id):
     """
-    将指定小说通过邮箱推送到kindle上
+    将指定小说通过邮箱推送到kindle上。
+    只创建推送任务，附件的生成和发送在后台进行，通过/jobs/<job_id>/查询推送进度。
+    mode参数：full-全部章节（默认），delta-上次推送之后新增的章节，range-章节排序在start到end之间的章节。
+    推送成功后记录已推送的最大章节排序，作为delta方式的起点。format参数：txt（默认）或epub
+    返回的missing_chapters是推送范围内没有缓存的章节排序范围，缓存超过DELIVERY_GAP_SECONDS仍缺少的章节会被跳过
 
     Args:
         fiction_id: 小说编号
@@ -319,13 +529,6 @@ def send_fiction_to_kindle(fiction_id):
     fiction: Fictions = Fictions.query.get(fiction_id)
     if not fiction:
         raise Exception('指定小说不存在！')
-    # 生成临时小说
-    text_bytes = fiction.generate_txt_bytes()
-    filename = '{}_{}.txt'.format(fiction.fiction_name, int(datetime.now().timestamp()))
-    temporary_file_path = current_app.config.get('TEMPORARY_FILE_PATH')
-    file_path = os.path.join(temporary_file_path, filename)
-    with open(file_path, 'wb') as f:
-        f.write(text_bytes)
     # 读取邮箱配置信息
     email_config: EmailConfig = EmailConfig.query.first()
     if not email_config:
@@ -333,21 +536,27 @@ def send_fiction_to_kindle(fiction_id):
             'code': -1,
             'msg': '邮箱信息不正确！请重新配置！'
         }
-    else:
-        # 发送邮件
-        try:
-            smtp = email.create_smtp_client(email_config)
-            smtp.send(to=email_config.recipient, subject=fiction.fiction_name, contents=[file_path, ])
-            ret = {
-                'code': 0,
-                'msg': '邮件推送成功，kindle更新有延迟，请耐心等待～'
-            }
-        except Exception as e:
-            logger.error(e)
-            ret = {
-                'code': -1,
-                'msg': '邮件发送失败，请确认邮箱配置！'
-            }
-    # 删除临时小说
-    os.remove(file_path)
+        return jsonify(ret)
+    # 确定需要推送的章节范围
+    mode = request.args.get('mode', 'full')
+    export_range = fiction.resolve_export_range(mode, request.args.get('start'), request.args.get('end'))
+    if not export_range:
+        ret = {
+            'code': -1,
+            'msg': no_export_range_msg(fiction, mode, '没有需要推送的新章节！')
+        }
+        return jsonify(ret)
+    # 交给后台投递器分卷发送，不阻塞当前请求
+    export_format = request.args.get('format', 'txt')
+    if export_format not in ('txt', 'epub'):
+        raise Exception('不支持的文件格式：{}！'.format(export_format))
+    job = TaskJobs.create_job('delivery', fiction_id=fiction_id)
+    delivery.submit(current_app._get_current_object(), job.job_id, fiction_id, export_range, export_format)
+    ret = {
+        'code': 0,
+        'msg': '已加入推送队列，kindle更新有延迟，请耐心等待～',
+        'job_id': job.job_id,
+        # 推送的章节中没有缓存的章节排序范围，delta方式下是长时间没有缓存上、被跳过的章节
+        'missing_chapters': fiction.missing_chapter_ranges(export_range[1], export_range[2])
+    }
     return jsonify(ret)
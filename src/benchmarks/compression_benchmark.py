@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# @File    : compression_benchmark.py
+# @Author  : AaronJny
+# @Time    : 2020/03/22
+# @Desc    : 对比章节内容不同压缩方式的压缩比、压缩和解压速度
+"""
+用法（在src目录下执行）：
+
+    python3 benchmarks/compression_benchmark.py [--site 网站名称] [--chapters 数量] [--fiction-id 小说编号]
+
+默认使用脚本生成的章节样例，每章包含相同的网站模板文字和不同的正文。
+指定--site时，从数据库中读取该网站最近缓存的章节作为样例。
+前一半章节用于训练字典，后一半用于测试。
+指定--fiction-id时，额外测试从数据库中导出这本小说的速度。
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils import compression
+
+BOILERPLATE_HEAD = '    天才一秒记住本站地址：www.zwda.com。E小说手机版阅读网址：m.zwda.com\n'
+BOILERPLATE_TAIL = '\n    请记住本书首发域名：www.zwda.com。E小说手机版阅读网址：m.zwda.com\n' \
+                   '    章节错误,点此报送(免注册), 报送后维护人员会在两分钟内校正章节内容,请耐心等待。\n'
+WORDS = '的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学' \
+        '么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感'
+
+
+def build_chapters(number=400, paragraphs=60):
+    random.seed(0)
+    chapters = []
+    for _ in range(number):
+        body = '\n'.join('    ' + ''.join(random.choice(WORDS) for _ in range(random.randint(20, 80)))
+                         for _ in range(paragraphs))
+        chapters.append((BOILERPLATE_HEAD + body + BOILERPLATE_TAIL).encode('utf8'))
+    return chapters
+
+
+def load_chapters(site, number):
+    from app import app
+    from models import db, Fictions, FictionChapters
+    with app.app_context():
+        rows = FictionChapters.query.join(Fictions, Fictions.fid == FictionChapters.fiction_id).with_entities(
+            FictionChapters.chapter_content, FictionChapters.content_codec, FictionChapters.content_dict_id,
+            FictionChapters.content_blob).filter(Fictions.site == site).order_by(
+            FictionChapters.fcid.desc()).limit(number).all()
+        return [FictionChapters.decode_content(db.session, *row).encode('utf8') for row in rows]
+
+
+def measure_export(fiction_id):
+    from app import app
+    from models import Fictions
+    with app.app_context():
+        fiction = Fictions.query.get(fiction_id)
+        if not fiction:
+            raise Exception('指定小说不存在！')
+        start_time = time.time()
+        size = sum(len(chunk) for chunk in fiction.iter_txt_bytes())
+        elapsed = time.time() - start_time
+    print('导出小说{}：{:.2f}MB，耗时{:.3f}秒，{:.1f}MB/s'.format(fiction_id, size / 1024 / 1024, elapsed,
+                                                       size / 1024 / 1024 / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比章节内容不同压缩方式的压缩比、压缩和解压速度')
+    parser.add_argument('--site', default=None, help='从数据库中读取该网站的章节作为样例')
+    parser.add_argument('--chapters', type=int, default=400, help='样例章节数')
+    parser.add_argument('--dict-size', type=int, default=64 * 1024, help='字典大小上限')
+    parser.add_argument('--fiction-id', type=int, default=0, help='测试导出速度的小说编号')
+    args = parser.parse_args()
+
+    chapters = load_chapters(args.site, args.chapters) if args.site else build_chapters(args.chapters)
+    train_samples, test_samples = chapters[:len(chapters) // 2], chapters[len(chapters) // 2:]
+    raw_size = sum(len(chapter) for chapter in test_samples)
+    codecs = [compression.ZLIB] + ([compression.ZSTD] if compression.zstandard else [])
+
+    print('测试章节{}个，原始大小{:.2f}MB'.format(len(test_samples), raw_size / 1024 / 1024))
+    print('{:<12}{:>10}{:>12}{:>10}{:>16}{:>16}'.format('压缩方式', '字典', '压缩后(KB)', '压缩比', '压缩(MB/s)',
+                                                        '解压(MB/s)'))
+    for codec in codecs:
+        for use_dict in (False, True):
+            dictionary = compression.train_dictionary(codec, train_samples, args.dict_size) if use_dict else b''
+            start_time = time.time()
+            blobs = [compression.compress(codec, chapter, dictionary) for chapter in test_samples]
+            compress_time = time.time() - start_time
+            start_time = time.time()
+            restored = [compression.decompress(codec, blob, dictionary) for blob in blobs]
+            decompress_time = time.time() - start_time
+            assert restored == test_samples
+            compressed_size = sum(len(blob) for blob in blobs)
+            print('{:<12}{:>10}{:>12.1f}{:>10.2f}{:>16.1f}{:>16.1f}'.format(
+                codec, len(dictionary), compressed_size / 1024, raw_size / compressed_size,
+                raw_size / 1024 / 1024 / compress_time, raw_size / 1024 / 1024 / decompress_time))
+    if args.fiction_id:
+        measure_export(args.fiction_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# @File    : epub_benchmark.py
+# @Author  : AaronJny
+# @Time    : 2020/03/25
+# @Desc    : 测试epub导出的耗时和内存占用
+"""
+用法（在src目录下执行）：
+
+    python3 benchmarks/epub_benchmark.py [--chapters 数量] [--fiction-id 小说编号]
+
+默认使用脚本生成的章节，分别测试：
+  首次导出：全部章节都需要渲染
+  重新导出：全部章节使用缓存的片段
+  新增章节后导出：只渲染新增的1%章节
+指定--fiction-id时，额外测试从数据库中导出这本小说的epub，先清空片段缓存再导出两次。
+内存占用为导出过程中python分配的峰值，输出直接丢弃，不计入内存。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.compression_benchmark import build_chapters
+from utils import epub
+
+
+def iter_fragments(chapters, cache):
+    """
+    模拟Fictions.iter_chapter_fragments，按批读取缓存，缺失的章节渲染后写入缓存
+    """
+    batch_size = 200
+    for start in range(0, len(chapters), batch_size):
+        keys = list(range(start, min(start + batch_size, len(chapters))))
+        fragments = cache.get_many(0, keys)
+        rendered = {key: epub.render_chapter('第{}章'.format(key + 1), chapters[key].decode('utf8'))
+                    for key in keys if key not in fragments}
+        cache.put_many(0, rendered)
+        fragments.update(rendered)
+        for key in keys:
+            yield key, '第{}章'.format(key + 1), fragments[key]
+
+
+def measure(name, generate):
+    """
+    消费生成器，统计耗时、输出大小和内存峰值
+    """
+    tracemalloc.start()
+    start_time = time.time()
+    size = sum(len(chunk) for chunk in generate())
+    elapsed = time.time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<16}{:>12.3f}{:>12.2f}{:>14.2f}'.format(name, elapsed, size / 1024 / 1024, peak / 1024 / 1024))
+
+
+def measure_fiction(fiction_id):
+    from app import app
+    from models import Fictions
+    with app.app_context():
+        fiction = Fictions.query.get(fiction_id)
+        if not fiction:
+            raise Exception('指定小说不存在！')
+        epub.fragment_cache.remove(fiction_id)
+        measure('小说{}首次'.format(fiction_id), fiction.iter_epub_bytes)
+        measure('小说{}重新'.format(fiction_id), fiction.iter_epub_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测试epub导出的耗时和内存占用')
+    parser.add_argument('--chapters', type=int, default=3000, help='生成的章节数')
+    parser.add_argument('--fiction-id', type=int, default=0, help='测试从数据库导出的小说编号')
+    args = parser.parse_args()
+
+    chapters = build_chapters(args.chapters)
+    raw_size = sum(len(chapter) for chapter in chapters)
+    print('章节{}个，正文{:.2f}MB'.format(len(chapters), raw_size / 1024 / 1024))
+    print('{:<16}{:>12}{:>12}{:>14}'.format('场景', '耗时(秒)', '大小(MB)', '内存峰值(MB)'))
+    with tempfile.TemporaryDirectory() as directory:
+        cache = epub.FragmentCache(os.path.join(directory, 'fragments.db'))
+        existing = chapters[:len(chapters) - len(chapters) // 100]
+
+        def build(items):
+            return lambda: epub.iter_epub_bytes('测试', '作者', 'urn:benchmark', iter_fragments(items, cache))
+
+        measure('首次导出', build(existing))
+        measure('重新导出', build(existing))
+        measure('新增章节后导出', build(chapters))
+    if args.fiction_id:
+        measure_fiction(args.fiction_id)
+
+
+if __name__ == '__main__':
+    main()
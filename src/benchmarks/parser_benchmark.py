@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# @File    : parser_benchmark.py
+# @Author  : AaronJny
+# @Time    : 2020/03/18
+# @Desc    : 对比BeautifulSoup和lxml两种解析方式的耗时
+"""
+用法（在src目录下执行）：
+
+    python3 benchmarks/parser_benchmark.py [--fixtures 目录] [--number 次数]
+
+默认使用脚本生成的网页样例，包括20条结果的搜索页、5000章的目录页和200段正文的章节页。
+如果--fixtures目录中存在search.html、toc.html、chapter.html，则使用这些真实网页代替对应的样例。
+旧的解析方式依赖beautifulsoup4。
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bs4 import BeautifulSoup
+from models import FictionSearchItem, SimpleChapter, MiddleChapter
+from spiders.spider import ZwdaSpider
+
+FICTION_URL = 'https://www.zwda.com/1234/'
+
+
+def build_search_page(items=20):
+    divs = []
+    for i in range(items):
+        divs.append('''
+        <div class="result-item result-game-item">
+          <div class="result-game-item-pic"><a href="/{i}/"><img src="https://img.zwda.com/{i}.jpg"></a></div>
+          <div class="result-game-item-detail">
+            <h3 class="result-item-title result-game-item-title"><a href="/{i}/" title="小说{i}"><span>小说</span>{i}</a></h3>
+            <p class="result-game-item-desc">这是第{i}本小说的简介，<em>简介</em>内容比较长。</p>
+            <div class="result-game-item-info">
+              <p class="result-game-item-info-tag"><span>作者：</span><span>作者{i}</span></p>
+              <p class="result-game-item-info-tag"><span>类型：</span><span>玄幻</span></p>
+              <p class="result-game-item-info-tag"><span>更新时间：</span><span>2020-03-18</span></p>
+              <p class="result-game-item-info-tag"><span>最新章节：</span><a href="/{i}/99/">第99章 结局</a></p>
+            </div>
+          </div>
+        </div>'''.format(i=i))
+    html = '<html><head><meta charset="utf-8"><title>搜索</title></head><body><div class="result-list">{}</div>' \
+           '</body></html>'.format(''.join(divs))
+    return html.encode('utf8')
+
+
+def build_toc_page(chapters=5000):
+    links = ''.join('<dd><a href="/1234/{}/">第{}章 章节名称{}</a></dd>'.format(100000 + i, i + 1, i)
+                    for i in range(chapters))
+    html = '<html><head><meta http-equiv="Content-Type" content="text/html; charset=gbk"></head><body>' \
+           '<div class="nav">导航</div><div id="list"><dl>{}</dl></div></body></html>'.format(links)
+    return html.encode('gbk')
+
+
+def build_chapter_page(paragraphs=200):
+    text = '<br />\n'.join('&nbsp;&nbsp;&nbsp;&nbsp;这是正文的第{}段，内容是一些用来测试的文字。'.format(i) for i in range(paragraphs))
+    html = '<html><head><meta http-equiv="Content-Type" content="text/html; charset=gbk"></head><body>' \
+           '<div class="bookname"><h1>第1章</h1></div><div id="content">{}<script>read();</script></div>' \
+           '</body></html>'.format(text)
+    return html.encode('gbk')
+
+
+def load_fixture(fixtures_dir, name, builder):
+    if fixtures_dir:
+        path = os.path.join(fixtures_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+    return builder()
+
+
+def bs4_parse_search_results(content, domain='www.zwda.com', site='E小说'):
+    """
+    改用lxml之前的搜索结果解析方式
+    """
+    bsobj = BeautifulSoup(content, 'lxml')
+    fiction_divs = bsobj.find('div', {'class': 'result-list'}).find_all('div', {'class': 'result-item'})
+    results = []
+    for fiction_div in fiction_divs:
+        image_url = fiction_div.find('div', {'class': 'result-game-item-pic'}).find('img').get('src')
+        title = fiction_div.find('h3', {'class': 'result-item-title'}).get_text().strip()
+        desc = fiction_div.find('p', {'class': 'result-game-item-desc'}).get_text().strip()
+        info_tags = fiction_div.find('div', {'class': 'result-game-item-info'}).find_all(
+            'p', {'class': 'result-game-item-info-tag'})
+        author = info_tags[0].find_all('span')[1].get_text().strip()
+        fiction_kind = info_tags[1].find_all('span')[1].get_text().strip()
+        update_date = info_tags[2].find_all('span')[1].get_text().strip()
+        latest_chapter = info_tags[3].find('a').get_text().strip()
+        origin_url = urljoin('https://{}'.format(domain), fiction_div.find('h3').find('a').get('href'))
+        origin_id = origin_url.strip('/').split('/')[-1]
+        results.append(FictionSearchItem(fiction_name=title, image_url=image_url, author=author,
+                                         fiction_kind=fiction_kind, update_date=update_date,
+                                         latest_chapter=latest_chapter, introduction=desc, site=site,
+                                         origin_url=origin_url, origin_id=origin_id))
+    return results
+
+
+def bs4_parse_chapters(fiction_url, content):
+    """
+    改用lxml之前的章节列表解析方式
+    """
+    chapters = []
+    bsobj = BeautifulSoup(content, 'lxml')
+    for index, a_tag in enumerate(bsobj.find('div', {'id': 'list'}).find_all('a')):
+        chapter_url = urljoin(fiction_url, a_tag.get('href'))
+        chapters.append(SimpleChapter(origin_id=int(chapter_url.strip('/').split('/')[-1]),
+                                      chapter_name=a_tag.get_text().strip(), chapter_url=chapter_url,
+                                      chapter_order=index))
+    return chapters
+
+
+def bs4_parse_chapter(content):
+    """
+    改用lxml之前的章节正文解析方式
+    """
+    html = content.decode('gbk', errors='ignore')
+    html = re.sub('<[ ]*br[ ]*/?[ ]*>', '\n<br>', html)
+    return BeautifulSoup(html, 'lxml').find('div', {'id': 'content'}).get_text()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='对比BeautifulSoup和lxml两种解析方式的耗时')
+    parser.add_argument('--fixtures', default=None, help='存放search.html、toc.html、chapter.html的目录')
+    parser.add_argument('--number', type=int, default=20, help='每种页面解析的次数')
+    args = parser.parse_args()
+
+    spider = ZwdaSpider()
+    search_page = load_fixture(args.fixtures, 'search.html', build_search_page)
+    toc_page = load_fixture(args.fixtures, 'toc.html', build_toc_page)
+    chapter_page = load_fixture(args.fixtures, 'chapter.html', build_chapter_page)
+
+    cases = [
+        ('搜索页', len(search_page),
+         lambda: bs4_parse_search_results(search_page),
+         lambda: spider._parse_search_results(search_page)),
+        ('目录页', len(toc_page),
+         lambda: bs4_parse_chapters(FICTION_URL, toc_page),
+         lambda: spider._parse_chapters(FICTION_URL, toc_page)),
+        ('章节页', len(chapter_page),
+         lambda: bs4_parse_chapter(chapter_page),
+         lambda: spider._parse_chapter(MiddleChapter(), chapter_page).chapter_content),
+    ]
+    print('{:<8}{:>12}{:>16}{:>16}{:>10}{:>8}'.format('页面', '字节数', 'bs4(ms/次)', 'lxml(ms/次)', '加速比', '一致'))
+    for name, size, old_func, new_func in cases:
+        same = old_func() == new_func()
+        old_time = timeit.timeit(old_func, number=args.number) / args.number * 1000
+        new_time = timeit.timeit(new_func, number=args.number) / args.number * 1000
+        print('{:<8}{:>12}{:>16.3f}{:>16.3f}{:>10.1f}{:>8}'.format(name, size, old_time, new_time,
+                                                                   old_time / new_time, '是' if same else '否'))
+
+
+if __name__ == '__main__':
+    main()
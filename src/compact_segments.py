@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# @File    : compact_segments.py
+# @Author  : AaronJny
+# @Time    : 2020/03/23
+# @Desc    : 把数据库中的章节内容迁移到段文件，并整理段文件
+"""
+用法（在src目录下执行）：
+
+    python3 compact_segments.py [--fiction-id 小说编号] [--force]
+
+先在config.py中设置CHAPTER_STORAGE = 'segments'。
+默认只处理还有章节保存在数据库中、或段文件中无效内容超过SEGMENT_GARBAGE_RATIO的小说，
+--force时全部重新整理。整理按小说进行，脚本可以随时中断后重新执行。
+"""
+import argparse
+import time
+from loguru import logger
+from app import app
+from models import Fictions, FictionChapters
+from config import Config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把数据库中的章节内容迁移到段文件，并整理段文件')
+    parser.add_argument('--fiction-id', type=int, default=0, help='只处理指定小说')
+    parser.add_argument('--force', action='store_true', help='不检查无效内容占比，全部重新整理')
+    args = parser.parse_args()
+
+    if Config.CHAPTER_STORAGE != 'segments':
+        raise Exception("请先在config.py中设置CHAPTER_STORAGE = 'segments'！")
+    with app.app_context():
+        if args.fiction_id:
+            fiction_ids = [args.fiction_id]
+        else:
+            fiction_ids = [row[0] for row in Fictions.query.with_entities(Fictions.fid).order_by(Fictions.fid)]
+        for fiction_id in fiction_ids:
+            start_time = time.time()
+            if args.force:
+                chapters = FictionChapters.compact_segments(fiction_id)
+            elif FictionChapters.compact_segments_if_needed(fiction_id):
+                chapters = FictionChapters.query.filter(FictionChapters.fiction_id == fiction_id).count()
+            else:
+                continue
+            logger.info('小说{} 整理了{}个章节，耗时{:.1f}秒'.format(fiction_id, chapters, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
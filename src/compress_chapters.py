@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# @File    : compress_chapters.py
+# @Author  : AaronJny
+# @Time    : 2020/03/22
+# @Desc    : 训练压缩字典，并压缩数据库中已有的章节内容
+"""
+用法（在src目录下执行）：
+
+    python3 compress_chapters.py [--train] [--recompress] [--site 网站名称] [--batch-size 数量]
+
+--train       先用每个网站最近的CHAPTER_DICT_SAMPLES个章节训练一个新字典
+--recompress  已压缩、但没有使用最新字典的章节也重新压缩
+不加参数时只压缩未压缩的章节。已压缩的章节始终可以正常导出，脚本可以随时中断后重新执行。
+已经迁移到段文件的章节不在这里处理，它们的内容在写入段文件时已经按当时的配置压缩。
+"""
+import argparse
+import time
+from loguru import logger
+from sqlalchemy import bindparam
+from app import app
+from models import db, Fictions, FictionChapters, ChapterDictionaries
+from config import Config
+from utils import compression
+from utils.segment_store import store as segment_store
+
+
+def sample_chapter_contents(site, limit):
+    """
+    抽取网站最近缓存的章节内容，保存在段文件中的章节从段文件读取
+    """
+    rows = FictionChapters.query.join(Fictions, Fictions.fid == FictionChapters.fiction_id).with_entities(
+        FictionChapters.fiction_id, FictionChapters.chapter_content, FictionChapters.content_codec,
+        FictionChapters.content_dict_id, FictionChapters.content_blob, FictionChapters.segment_id,
+        FictionChapters.segment_offset, FictionChapters.segment_length, FictionChapters.content_hash).filter(
+        Fictions.site == site).order_by(FictionChapters.fcid.desc()).limit(limit).all()
+    samples = []
+    reader = segment_store.reader()
+    try:
+        for fiction_id, chapter_content, content_codec, content_dict_id, content_blob, segment_id, \
+                segment_offset, segment_length, content_hash in rows:
+            if segment_id:
+                data = reader.read(fiction_id, segment_id, segment_offset, segment_length, content_hash)
+                chapter_content = FictionChapters.decode_bytes(db.session, content_codec, content_dict_id, data)
+            else:
+                chapter_content = FictionChapters.decode_content(db.session, chapter_content, content_codec,
+                                                                 content_dict_id, content_blob)
+            samples.append(chapter_content.encode('utf8'))
+    finally:
+        reader.close()
+    return samples
+
+
+def train(site, codec):
+    """
+    训练并保存网站的压缩字典
+    """
+    samples = sample_chapter_contents(site, Config.CHAPTER_DICT_SAMPLES)
+    data = compression.train_dictionary(codec, samples, Config.CHAPTER_DICT_SIZE)
+    if not data:
+        logger.warning('{} 的章节太少，无法训练字典'.format(site))
+        return
+    dictionary = ChapterDictionaries(site=site, codec=codec, data=data, samples=len(samples))
+    db.session.add(dictionary)
+    db.session.commit()
+    logger.info('{} 训练了{}字节的字典，使用{}个章节，字典编号{}'.format(site, len(data), len(samples),
+                                                          dictionary.dict_id))
+
+
+def compress_site(site, codec, batch_size, recompress=False):
+    """
+    按章节编号分批压缩网站的章节。段文件中的章节在数据库中没有内容，跳过
+
+    Returns:
+        typing.Tuple[int, int, int]，处理的章节数、原始字节数和压缩后字节数
+    """
+    latest_dict_id, _ = ChapterDictionaries.latest(db.session, site, codec)
+    fiction_ids = [row[0] for row in Fictions.query.with_entities(Fictions.fid).filter(Fictions.site == site)]
+    update = FictionChapters.__table__.update().where(FictionChapters.fcid == bindparam('_fcid')).values(
+        chapter_content=bindparam('chapter_content'), content_codec=bindparam('content_codec'),
+        content_dict_id=bindparam('content_dict_id'), content_blob=bindparam('content_blob'))
+    chapters, raw_bytes, compressed_bytes = 0, 0, 0
+    for fiction_id in fiction_ids:
+        last_fcid = 0
+        while True:
+            criterion = [FictionChapters.content_codec == '']
+            if recompress:
+                criterion = [db.or_(FictionChapters.content_codec != codec,
+                                    FictionChapters.content_dict_id != latest_dict_id)]
+            rows = FictionChapters.query.with_entities(
+                FictionChapters.fcid, FictionChapters.chapter_content, FictionChapters.content_codec,
+                FictionChapters.content_dict_id, FictionChapters.content_blob).filter(
+                FictionChapters.fiction_id == fiction_id, FictionChapters.segment_id == 0,
+                FictionChapters.fcid > last_fcid, *criterion).order_by(
+                FictionChapters.fcid).limit(batch_size).all()
+            if not rows:
+                break
+            last_fcid = rows[-1][0]
+            params = []
+            for fcid, *content in rows:
+                chapter_content = FictionChapters.decode_content(db.session, *content)
+                encoded = FictionChapters.encode_content(db.session, site, chapter_content)
+                encoded['_fcid'] = fcid
+                params.append(encoded)
+                raw_bytes += len(chapter_content.encode('utf8'))
+                compressed_bytes += len(encoded['content_blob'] or encoded['chapter_content'].encode('utf8'))
+            db.session.execute(update, params)
+            db.session.commit()
+            chapters += len(rows)
+    return chapters, raw_bytes, compressed_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='训练压缩字典，并压缩数据库中已有的章节内容')
+    parser.add_argument('--train', action='store_true', help='先训练新字典')
+    parser.add_argument('--recompress', action='store_true', help='重新压缩没有使用最新字典的章节')
+    parser.add_argument('--site', default=None, help='只处理指定网站')
+    parser.add_argument('--batch-size', type=int, default=200, help='每批处理的章节数')
+    args = parser.parse_args()
+
+    if not Config.CHAPTER_COMPRESSION:
+        raise Exception('请先在config.py中开启CHAPTER_COMPRESSION！')
+    codec = compression.default_codec()
+    with app.app_context():
+        if args.site:
+            sites = [args.site]
+        else:
+            sites = [row[0] for row in Fictions.query.with_entities(Fictions.site).distinct()]
+        for site in sites:
+            if args.train:
+                train(site, codec)
+                # 丢弃进程内缓存，马上使用新字典
+                ChapterDictionaries._latest_cache.clear()
+            start_time = time.time()
+            chapters, raw_bytes, compressed_bytes = compress_site(site, codec, args.batch_size, args.recompress)
+            elapsed = time.time() - start_time
+            ratio = raw_bytes / compressed_bytes if compressed_bytes else 0
+            logger.info('{} 压缩了{}个章节，{:.2f}MB -> {:.2f}MB，压缩比{:.2f}，耗时{:.1f}秒'.format(
+                site, chapters, raw_bytes / 1024 / 1024, compressed_bytes / 1024 / 1024, ratio, elapsed))
+
+
+if __name__ == '__main__':
+    main()
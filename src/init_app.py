@@ -6,8 +6,10 @@
 import shutil
 import os
 from app import app
-from models import db
+from sqlalchemy import inspect
+from models import db, Fictions, FictionChapters, TaskJobs
 from spiders import init_spider_configs
+from utils.mysql import add_missing_columns
 
 
 def init_before_app_start():
@@ -22,8 +24,25 @@ def init_before_app_start():
     with app.app_context():
         # 初始化数据库
         db.create_all()
+        # 旧版本的章节表没有唯一索引，加索引之前先删除重复章节
+        removed_chapters = 0
+        inspector = inspect(db.engine)
+        if FictionChapters.__tablename__ in inspector.get_table_names():
+            index_names = {index['name'] for index in inspector.get_indexes(FictionChapters.__tablename__)}
+            if 'uk_fiction_chapters_fiction_origin' not in index_names:
+                removed_chapters = FictionChapters.remove_duplicates()
+        # 升级旧版本的数据库时，补上新增的列和索引
+        added_columns = add_missing_columns(db.engine, db.Model.metadata.sorted_tables)
+        if 'fictions.cached_chapters_count' in added_columns:
+            # 新增的已缓存章节数从现有章节统计一次
+            db.engine.execute('UPDATE fictions SET cached_chapters_count = '
+                              '(SELECT COUNT(*) FROM fiction_chapters WHERE fiction_chapters.fiction_id = fictions.fid)')
+        elif removed_chapters:
+            Fictions.reconcile_cached_chapters_count()
         # 初始爬虫信息
         init_spider_configs()
+        # 上次运行时没有执行完的后台任务随进程一起丢失了
+        TaskJobs.fail_orphaned_jobs()
 
     db.session.remove()
 
@@ -3,8 +3,18 @@
 # @Author  : AaronJny
 # @Time    : 2020/02/29
 # @Desc    :
-from datetime import datetime
+from datetime import datetime, timedelta
+import os
+import socket
 import typing
+import threading
+import time
+import uuid
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import IntegrityError
+from config import Config
+from utils import compression, epub
+from utils.segment_store import store as segment_store
 from . import db
 
 
@@ -59,11 +69,24 @@ class Fictions(db.Model):
     fiction_chapters_total = db.Column(db.Integer, nullable=False, default=0, comment='小说在原网站上的总章节数')
     image_url = db.Column(db.String(128), nullable=False, default='', comment='小说图片地址')
     update_time = db.Column(db.DateTime, nullable=False, default=datetime.now, comment='更新时间')
+    toc_etag = db.Column(db.String(128), nullable=False, default='', comment='上次请求章节目录时响应的ETag')
+    toc_last_modified = db.Column(db.String(64), nullable=False, default='', comment='上次请求章节目录时响应的Last-Modified')
+    toc_hash = db.Column(db.String(40), nullable=False, default='', comment='上次章节目录的摘要')
+    toc_last_origin_id = db.Column(db.Integer, nullable=False, default=0, comment='连续已缓存的最后一个章节的原始编号，更新时只比对之后的章节')
+    refresh_interval = db.Column(db.Integer, nullable=False, default=3600, comment='自动更新的间隔，单位秒')
+    next_refresh_time = db.Column(db.DateTime, nullable=True, index=True, comment='下次自动更新的时间，为空时尽快更新')
+    last_new_chapter_time = db.Column(db.DateTime, nullable=True, comment='最近一次发现新章节的时间')
+    cached_chapters_count = db.Column(db.Integer, nullable=False, default=0, comment='已缓存的章节数，由爬虫写入章节时维护')
+    delivered_chapter_order = db.Column(db.Integer, nullable=False, default=-1,
+                                        comment='已推送的最大章节排序，-1表示还没有推送过')
     # fiction_cached = db.Column(db.SmallInteger, nullable=False, default=0, comment='小说是否已经进行缓存，1-是，0-否')
 
     # 小说对应的全部章节
     chapters = db.relationship('FictionChapters', backref='fiction', lazy=True)
 
+    # 书架按更新时间倒序分页
+    __table_args__ = (db.Index('ix_fictions_update_time_fid', 'update_time', 'fid'),)
+
     def to_dict(self):
         data = {
             'fid': self.fid,
@@ -74,17 +97,187 @@ class Fictions(db.Model):
             'fiction_url': self.fiction_url,
             'fiction_chapters_total': self.fiction_chapters_total,
             'image_url': self.image_url,
-            'update_time': self.update_time.strftime('%Y-%m-%d %H:%M:%S')
+            'update_time': self.update_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'delivered_chapter_order': self.delivered_chapter_order
         }
         return data
 
     @property
     def cached_chapters_number(self):
         """
-        查询当前小说在数据库中缓存的章节数
+        当前小说在数据库中缓存的章节数，读取爬虫维护的计数，不再统计章节表
+        """
+        return self.cached_chapters_count
+
+    @classmethod
+    def reconcile_cached_chapters_count(cls, batch_size=100):
+        """
+        核对并修复已缓存章节数的偏差，比如爬虫写入后进程异常退出、手动修改了章节表等情况。
+        按批次统计章节表，只重写有偏差的小说
+
+        Args:
+            batch_size: 每批核对的小说数量
+
+        Returns:
+            修复的小说数量
+        """
+        repaired = 0
+        last_fid = 0
+        while True:
+            rows = Fictions.query.with_entities(Fictions.fid, Fictions.cached_chapters_count).filter(
+                Fictions.fid > last_fid).order_by(Fictions.fid).limit(batch_size).all()
+            if not rows:
+                break
+            last_fid = rows[-1][0]
+            count_result = FictionChapters.query.with_entities(FictionChapters.fiction_id,
+                                                               db.func.count(FictionChapters.fcid)).filter(
+                FictionChapters.fiction_id.in_([fid for fid, _ in rows])).group_by(FictionChapters.fiction_id).all()
+            chapters_count_map = dict(count_result)
+            for fid, cached_chapters_count in rows:
+                if chapters_count_map.get(fid, 0) == cached_chapters_count:
+                    continue
+                # 在同一条语句中重新统计并写入，避免覆盖核对期间爬虫新增的计数
+                chapters_count = db.select([db.func.count(FictionChapters.fcid)]).where(
+                    FictionChapters.fiction_id == Fictions.fid).as_scalar()
+                Fictions.query.filter(Fictions.fid == fid).update({Fictions.cached_chapters_count: chapters_count},
+                                                                  synchronize_session=False)
+                repaired += 1
+            db.session.commit()
+        return repaired
+
+    def resolve_export_range(self, mode='full', start=None, end=None):
+        """
+        根据导出方式确定需要导出的章节排序范围
+
+        Args:
+            mode: 导出方式，full-全部章节，delta-上次推送之后新增的章节，range-指定排序范围内的章节
+            start: range方式的起始章节排序（包含）
+            end: range方式的结束章节排序（包含），为空时到最后一章
+
+        Returns:
+            typing.Optional[typing.Tuple[typing.Optional[int], int, int, int]]，
+            (推送水位需要满足的下限, 第一个章节的排序, 最后一个章节的排序, 推送后水位可以推进到的排序)，
+            没有需要导出的章节时返回None。
+            下限为None时不检查水位，否则只有在水位不低于下限-1时才推进，避免跳过中间没有推送的章节。
+            章节是乱序缓存的，水位只推进到连续已缓存的最后一个章节，delta方式也只导出这些章节，
+            还没有缓存的章节留到下次推送。长时间没有缓存上的章节会被跳过，见contiguous_chapter_order
+        """
+        if mode == 'full':
+            lower, upper = None, None
+        elif mode == 'delta':
+            lower, upper = self.delivered_chapter_order + 1, None
+        elif mode == 'range':
+            if start is None:
+                raise Exception('请指定起始章节！')
+            lower, upper = int(start), None if end is None else int(end)
+        else:
+            raise Exception('不支持的导出方式：{}！'.format(mode))
+        criterion = [FictionChapters.fiction_id == self.fid]
+        if lower is not None:
+            criterion.append(FictionChapters.chapter_order >= lower)
+        if upper is not None:
+            criterion.append(FictionChapters.chapter_order <= upper)
+        first, last = FictionChapters.query.with_entities(db.func.min(FictionChapters.chapter_order),
+                                                          db.func.max(FictionChapters.chapter_order)).filter(
+            *criterion).first()
+        if last is None:
+            return None
+        delivered = self.contiguous_chapter_order(0 if lower is None else lower, last)
+        if mode == 'delta':
+            if delivered < lower:
+                return None
+            first, last = lower, delivered
+        return lower, first, last, delivered
+
+    def contiguous_chapter_order(self, start, end):
+        """
+        从start开始连续缓存的最后一个章节排序，不超过end。
+        缺口之后的章节已经缓存超过DELIVERY_GAP_SECONDS时，缺少的章节视为无法下载，跳过缺口继续向后计算
+
+        Returns:
+            最后一个章节排序，start没有缓存时返回start-1
+        """
+        rows = FictionChapters.query.with_entities(FictionChapters.chapter_order,
+                                                   db.func.min(FictionChapters.add_time)).filter(
+            FictionChapters.fiction_id == self.fid, FictionChapters.chapter_order >= start,
+            FictionChapters.chapter_order <= end).group_by(FictionChapters.chapter_order).order_by(
+            FictionChapters.chapter_order).all()
+        gap_time = datetime.now() - timedelta(seconds=Config.DELIVERY_GAP_SECONDS)
+        expected = start
+        for chapter_order, add_time in rows:
+            if chapter_order != expected and add_time > gap_time:
+                break
+            expected = chapter_order + 1
+        return expected - 1
+
+    def missing_chapter_ranges(self, first, last):
+        """
+        first到last之间没有缓存的章节排序范围，导出和推送时提示用户
+
+        Returns:
+            typing.List[typing.List[int]]，每个元素为[起始排序, 结束排序]
+        """
+        rows = FictionChapters.query.with_entities(FictionChapters.chapter_order).filter(
+            FictionChapters.fiction_id == self.fid, FictionChapters.chapter_order >= first,
+            FictionChapters.chapter_order <= last).distinct().order_by(FictionChapters.chapter_order).all()
+        ranges = []
+        expected = first
+        for chapter_order, in rows:
+            if chapter_order > expected:
+                ranges.append([expected, chapter_order - 1])
+            expected = chapter_order + 1
+        if expected <= last:
+            ranges.append([expected, last])
+        return ranges
+
+    def waiting_chapter_order(self):
+        """
+        delta方式没有可以推送的章节，是因为水位之后的第一个章节还没有缓存时，返回这个章节的排序，否则返回None
+        """
+        lower = self.delivered_chapter_order + 1
+        orders = [row[0] for row in FictionChapters.query.with_entities(FictionChapters.chapter_order).filter(
+            FictionChapters.fiction_id == self.fid, FictionChapters.chapter_order >= lower).order_by(
+            FictionChapters.chapter_order).limit(1)]
+        if orders and orders[0] > lower:
+            return lower
+        return None
+
+    @classmethod
+    def export_range_criterion(cls, first, last):
+        """
+        导出指定排序范围内章节的过滤条件，配合iter_chapters等方法使用
         """
-        chapters_number = FictionChapters.query.filter_by(fiction_id=self.fid).count()
-        return chapters_number
+        return [FictionChapters.chapter_order >= first, FictionChapters.chapter_order <= last]
+
+    @classmethod
+    def mark_delivered(cls, fiction_id, lower, last):
+        """
+        推送成功后推进小说的推送水位，在同一条语句中比较，不会被并发的推送回退。需要调用方提交事务
+
+        Args:
+            fiction_id: 小说编号
+            lower: resolve_export_range返回的下限
+            last: resolve_export_range返回的水位可以推进到的排序
+        """
+        criterion = [Fictions.fid == fiction_id, Fictions.delivered_chapter_order < last]
+        if lower is not None:
+            criterion.append(Fictions.delivered_chapter_order >= lower - 1)
+        Fictions.query.filter(*criterion).update({Fictions.delivered_chapter_order: last},
+                                                 synchronize_session=False)
+
+    @classmethod
+    def release_unpublished(cls, fiction_id):
+        """
+        推送章节失败或推送任务丢失时调用：清空小说的目录校验信息和排队中的章节登记，
+        下次更新时重新比对全部章节，避免漏掉没有发布的这批章节。需要调用方提交事务
+
+        Args:
+            fiction_id: 小说编号
+        """
+        Fictions.query.filter(Fictions.fid == fiction_id).update(
+            {'toc_etag': '', 'toc_last_modified': '', 'toc_hash': '', 'toc_last_origin_id': 0},
+            synchronize_session=False)
+        ChapterJobs.release_queued(fiction_id)
 
     @property
     def cached_chapter_origin_ids(self):
@@ -95,6 +288,20 @@ class Fictions(db.Model):
             FictionChapters.origin_id).all()
         return origin_ids
 
+    def cached_chapter_origin_ids_in(self, origin_ids):
+        """
+        查询给定原始编号中已经缓存了的章节编号，只查询这部分章节，不扫描整本小说
+
+        Args:
+            origin_ids: 章节的原始编号列表
+        """
+        if not origin_ids:
+            return set()
+        rows = FictionChapters.query.filter(FictionChapters.fiction_id == self.fid,
+                                            FictionChapters.origin_id.in_(origin_ids)).with_entities(
+            FictionChapters.origin_id).all()
+        return {row[0] for row in rows}
+
     def add_or_update(self):
         """
         如果是新小说，就加入到小说信息表中。
@@ -108,21 +315,144 @@ class Fictions(db.Model):
             ret = fiction
         else:
             db.session.add(self)
+            LibraryCounters.incr('fictions', 1)
             ret = self
         db.session.commit()
         return ret
 
-    def generate_txt_bytes(self):
+    def iter_chapters(self, batch_size=200, criterion=(), include_fcid=False):
         """
-        生成文本数据字节序列
+        按章节排序，通过服务端游标分批读取已缓存的章节，避免一次性把全部章节加载到内存中
+
+        Args:
+            batch_size: 每批读取的章节数
+            criterion: 额外的章节过滤条件
+            include_fcid: 是否同时返回章节编号
+
+        Returns:
+            typing.Iterator[typing.Tuple[str, str]]，章节名称和章节内容，include_fcid为True时为(章节编号, 章节名称, 章节内容)
+        """
+        query = FictionChapters.query.with_entities(
+            FictionChapters.fcid, FictionChapters.chapter_name, FictionChapters.chapter_content,
+            FictionChapters.content_codec,
+            FictionChapters.content_dict_id, FictionChapters.content_blob, FictionChapters.segment_id,
+            FictionChapters.segment_offset, FictionChapters.segment_length, FictionChapters.content_hash).filter(
+            FictionChapters.fiction_id == self.fid, *criterion).order_by(FictionChapters.chapter_order,
+                                                                        FictionChapters.fcid)
+        # 服务端游标读取期间不能在同一个连接上执行其他查询，否则pymysql会丢弃还没有读取的结果，
+        # 导出的内容在当前批次后被截断。先把需要的压缩字典全部读入缓存
+        dict_ids = FictionChapters.query.with_entities(FictionChapters.content_dict_id).filter(
+            FictionChapters.fiction_id == self.fid, FictionChapters.content_dict_id > 0, *criterion).distinct().all()
+        ChapterDictionaries.preload(db.session, [row[0] for row in dict_ids])
+        reader = segment_store.reader()
+        try:
+            for fcid, chapter_name, chapter_content, content_codec, content_dict_id, content_blob, segment_id, \
+                    segment_offset, segment_length, content_hash in query.execution_options(
+                    stream_results=True).yield_per(batch_size):
+                if segment_id:
+                    # 保存在段文件中的章节，通过mmap读取
+                    data = reader.read(self.fid, segment_id, segment_offset, segment_length, content_hash)
+                    chapter_content = FictionChapters.decode_bytes(None, content_codec, content_dict_id, data)
+                else:
+                    chapter_content = FictionChapters.decode_content(None, chapter_content, content_codec,
+                                                                     content_dict_id, content_blob)
+                yield (fcid, chapter_name, chapter_content) if include_fcid else (chapter_name, chapter_content)
+        finally:
+            reader.close()
+
+    def iter_chapter_texts(self, batch_size=200, criterion=(), leading_newline=False):
+        """
+        逐个章节生成文本
+
+        Args:
+            batch_size: 每批从数据库中读取的章节数
+            criterion: 额外的章节过滤条件
+            leading_newline: 第一个章节前是否也加上分隔换行，追加到已有文本后面时使用
+        """
+        for index, (chapter_name, chapter_content) in enumerate(self.iter_chapters(batch_size, criterion)):
+            text = '{}\n\n{}\n'.format(chapter_name, chapter_content)
+            # 章节之间以换行分隔
+            if index > 0 or leading_newline:
+                text = '\n' + text
+            yield text
+
+    def iter_txt_bytes(self, batch_size=200, criterion=(), leading_newline=False):
+        """
+        逐批生成文本数据字节序列，每批包含batch_size个章节
+
+        Args:
+            batch_size: 每批包含的章节数
+            criterion: 额外的章节过滤条件
+            leading_newline: 第一个章节前是否也加上分隔换行，追加到已有文本后面时使用
         """
-        cached_chapters: typing.List[FictionChapters] = sorted(self.chapters, key=lambda x: x.chapter_order)
         texts = []
-        for chapter in cached_chapters:
-            text = '{}\n\n{}\n'.format(chapter.chapter_name, chapter.chapter_content)
+        for text in self.iter_chapter_texts(batch_size, criterion, leading_newline):
             texts.append(text)
-        fiction_txt_str = '\n'.join(texts)
-        fiction_txt_bytes = fiction_txt_str.encode('utf8')
+            if len(texts) >= batch_size:
+                yield ''.join(texts).encode('utf8')
+                texts = []
+        if texts:
+            yield ''.join(texts).encode('utf8')
+
+    def iter_chapter_fragments(self, batch_size=200, criterion=()):
+        """
+        按章节顺序生成epub的章节片段。已经渲染过的章节直接读取片段缓存，只有新章节需要读取内容并渲染。
+        按(章节排序, 章节编号)分页查询，每批只读取章节名称，不会把整本小说加载到内存中
+
+        Args:
+            batch_size: 每批处理的章节数
+            criterion: 额外的章节过滤条件
+
+        Returns:
+            typing.Iterator[typing.Tuple[int, str, epub.Fragment]]，章节编号、章节名称和章节片段
+        """
+        last_row = None
+        while True:
+            query = FictionChapters.query.with_entities(
+                FictionChapters.fcid, FictionChapters.chapter_order, FictionChapters.chapter_name).filter(
+                FictionChapters.fiction_id == self.fid, *criterion)
+            if last_row is not None:
+                query = query.filter(db.or_(FictionChapters.chapter_order > last_row[1],
+                                            db.and_(FictionChapters.chapter_order == last_row[1],
+                                                    FictionChapters.fcid > last_row[0])))
+            rows = query.order_by(FictionChapters.chapter_order, FictionChapters.fcid).limit(batch_size).all()
+            if not rows:
+                break
+            last_row = rows[-1]
+            fragments = epub.fragment_cache.get_many(self.fid, [row[0] for row in rows])
+            missing = [row[0] for row in rows if row[0] not in fragments]
+            if missing:
+                rendered = {fcid: epub.render_chapter(chapter_name, chapter_content)
+                            for fcid, chapter_name, chapter_content in
+                            self.iter_chapters(batch_size, [FictionChapters.fcid.in_(missing)], include_fcid=True)}
+                epub.fragment_cache.put_many(self.fid, rendered)
+                fragments.update(rendered)
+            for fcid, _, chapter_name in rows:
+                # 查询期间被删除的章节直接跳过
+                if fcid in fragments:
+                    yield fcid, chapter_name, fragments[fcid]
+
+    @property
+    def epub_identifier(self):
+        return 'urn:webfiction:{}:{}'.format(self.site, self.origin_id)
+
+    def iter_epub_bytes(self, batch_size=200, criterion=(), title=None):
+        """
+        流式生成epub字节序列
+
+        Args:
+            batch_size: 每批处理的章节数
+            criterion: 额外的章节过滤条件
+            title: 书名，为空时使用小说名称
+        """
+        yield from epub.iter_epub_bytes(title or self.fiction_name, self.fiction_author, self.epub_identifier,
+                                        self.iter_chapter_fragments(batch_size, criterion))
+
+    def generate_txt_bytes(self):
+        """
+        生成文本数据字节序列
+        """
+        fiction_txt_bytes = b''.join(self.iter_txt_bytes())
         return fiction_txt_bytes
 
 
@@ -139,6 +469,244 @@ class FictionChapters(db.Model):
     origin_url = db.Column(db.String(128), nullable=False, default='', comment='来源地址')
     origin_id = db.Column(db.Integer, nullable=False, default=0, comment='来源网站上的小说章节编号')
     add_time = db.Column(db.DateTime, nullable=False, default=datetime.now, comment='下载日期')
+    content_codec = db.Column(db.String(8), nullable=False, default='',
+                              comment='章节内容的压缩方式，为空时内容保存在chapter_content中')
+    content_dict_id = db.Column(db.Integer, nullable=False, default=0, comment='压缩字典编号，0表示不使用字典')
+    content_blob = db.Column(db.LargeBinary().with_variant(mysql.MEDIUMBLOB(), 'mysql'), nullable=True,
+                             comment='压缩后的章节内容')
+    segment_id = db.Column(db.Integer, nullable=False, default=0, comment='章节内容所在段文件的代号，0表示保存在数据库中')
+    segment_offset = db.Column(db.BigInteger, nullable=False, default=0, comment='章节内容在段文件中的偏移')
+    segment_length = db.Column(db.Integer, nullable=False, default=0, comment='章节内容在段文件中的长度')
+    content_hash = db.Column(db.String(40), nullable=False, default='', comment='段文件中章节内容的摘要')
+
+    __table_args__ = (
+        # 同一本小说的同一个章节只保存一次，重复投递的消息直接忽略
+        db.Index('uk_fiction_chapters_fiction_origin', 'fiction_id', 'origin_id', unique=True),
+        # 导出时按章节顺序读取
+        db.Index('ix_fiction_chapters_fiction_order', 'fiction_id', 'chapter_order'),
+    )
+
+    @classmethod
+    def insert_ignore(cls, session, rows):
+        """
+        批量写入章节，已经存在的章节（小说编号和章节原始编号相同）直接忽略。需要调用方提交事务
+
+        Args:
+            session: 数据库会话
+            rows: 章节数据列表
+
+        Returns:
+            实际写入的章节数
+        """
+        if not rows:
+            return 0
+        statement = FictionChapters.__table__.insert().prefix_with('IGNORE', dialect='mysql').prefix_with(
+            'OR IGNORE', dialect='sqlite')
+        return session.execute(statement, rows).rowcount
+
+    @classmethod
+    def encode_content(cls, session, site, chapter_content):
+        """
+        按配置压缩章节内容，使用该网站最新的压缩字典
+
+        Args:
+            session: 数据库会话
+            site: 章节所属网站
+            chapter_content: 章节内容
+
+        Returns:
+            dict，章节表中保存内容的各个字段
+        """
+        if not Config.CHAPTER_COMPRESSION or not chapter_content:
+            return {'chapter_content': chapter_content, 'content_codec': '', 'content_dict_id': 0,
+                    'content_blob': None}
+        codec = compression.default_codec()
+        dict_id, dictionary = ChapterDictionaries.latest(session, site, codec)
+        raw = chapter_content.encode('utf8')
+        blob = compression.compress(codec, raw, dictionary)
+        if len(blob) >= len(raw):
+            # 内容太短，压缩后反而更大，直接保存原文
+            return {'chapter_content': chapter_content, 'content_codec': '', 'content_dict_id': 0,
+                    'content_blob': None}
+        return {'chapter_content': '', 'content_codec': codec, 'content_dict_id': dict_id, 'content_blob': blob}
+
+    @classmethod
+    def decode_content(cls, session, chapter_content, content_codec, content_dict_id, content_blob):
+        """
+        读取章节内容，压缩保存的章节在这里解压
+
+        Returns:
+            章节内容
+        """
+        if not content_codec:
+            return chapter_content
+        dictionary = ChapterDictionaries.get_data(session, content_dict_id)
+        return compression.decompress(content_codec, content_blob, dictionary).decode('utf8')
+
+    @classmethod
+    def decode_bytes(cls, session, content_codec, content_dict_id, data):
+        """
+        将段文件中读取的字节序列还原成章节内容
+        """
+        if not content_codec:
+            return data.decode('utf8')
+        dictionary = ChapterDictionaries.get_data(session, content_dict_id)
+        return compression.decompress(content_codec, data, dictionary).decode('utf8')
+
+    @classmethod
+    def content_bytes(cls, encoded):
+        """
+        encode_content返回的内容在段文件中保存的字节序列
+        """
+        return encoded['content_blob'] if encoded['content_codec'] else encoded['chapter_content'].encode('utf8')
+
+    @classmethod
+    def compact_segments(cls, fiction_id):
+        """
+        把小说全部章节的内容按章节顺序写入新一代段文件，清除重复写入和已删除章节留下的无效内容，
+        保存在数据库中的章节内容也一并迁移到段文件
+
+        Args:
+            fiction_id: 小说编号
+
+        Returns:
+            写入的章节数
+        """
+        with segment_store.lock(fiction_id):
+            rows = FictionChapters.query.with_entities(
+                FictionChapters.fcid, FictionChapters.chapter_content, FictionChapters.content_codec,
+                FictionChapters.content_blob, FictionChapters.segment_id, FictionChapters.segment_offset,
+                FictionChapters.segment_length, FictionChapters.content_hash).filter(
+                FictionChapters.fiction_id == fiction_id).order_by(FictionChapters.chapter_order).all()
+            reader = segment_store.reader()
+
+            def iter_blobs():
+                for fcid, chapter_content, content_codec, content_blob, segment_id, segment_offset, \
+                        segment_length, content_hash in rows:
+                    if segment_id:
+                        data = reader.read(fiction_id, segment_id, segment_offset, segment_length, content_hash)
+                    else:
+                        data = content_blob if content_codec else chapter_content.encode('utf8')
+                    yield fcid, data
+
+            try:
+                generation, locations = segment_store.compact(fiction_id, iter_blobs())
+            finally:
+                reader.close()
+            update = FictionChapters.__table__.update().where(FictionChapters.fcid == db.bindparam('_fcid')).values(
+                chapter_content='', content_blob=None, segment_id=generation,
+                segment_offset=db.bindparam('segment_offset'), segment_length=db.bindparam('segment_length'),
+                content_hash=db.bindparam('content_hash'))
+            params = [{'_fcid': fcid, 'segment_offset': offset, 'segment_length': length, 'content_hash': digest}
+                      for fcid, offset, length, digest in locations]
+            try:
+                if params:
+                    db.session.execute(update, params)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                segment_store.discard(fiction_id, generation)
+                raise e
+            segment_store.activate(fiction_id, generation)
+        return len(params)
+
+    @classmethod
+    def compact_segments_if_needed(cls, fiction_id):
+        """
+        段文件中无效内容太多，或者还有章节内容保存在数据库中时，整理小说的段文件
+
+        Returns:
+            是否进行了整理
+        """
+        in_database = FictionChapters.query.filter(FictionChapters.fiction_id == fiction_id,
+                                                   FictionChapters.segment_id == 0).limit(1).count()
+        if not in_database:
+            with segment_store.lock(fiction_id):
+                generation = segment_store.current_generation(fiction_id)
+                size = segment_store.segment_sizes(fiction_id).get(generation, 0)
+            if not size:
+                return False
+            live_size = FictionChapters.query.with_entities(db.func.sum(FictionChapters.segment_length)).filter(
+                FictionChapters.fiction_id == fiction_id, FictionChapters.segment_id == generation).scalar() or 0
+            if 1 - live_size / size <= Config.SEGMENT_GARBAGE_RATIO:
+                return False
+        cls.compact_segments(fiction_id)
+        return True
+
+    @classmethod
+    def remove_duplicates(cls):
+        """
+        删除重复的章节，每本小说的同一个章节只保留最早写入的一条。
+        在给旧表加唯一索引之前调用
+
+        Returns:
+            删除的章节数
+        """
+        result = db.session.execute('DELETE FROM fiction_chapters WHERE fcid NOT IN '
+                                    '(SELECT fcid FROM (SELECT MIN(fcid) AS fcid FROM fiction_chapters '
+                                    'GROUP BY fiction_id, origin_id) AS t)')
+        db.session.commit()
+        return result.rowcount
+
+
+class LibraryCounters(db.Model):
+    """
+    书架计数器，避免每次请求都执行COUNT(*)
+    """
+
+    name = db.Column(db.String(32), primary_key=True, comment='计数器名称')
+    value = db.Column(db.Integer, nullable=False, default=0, comment='计数值')
+
+    # 计数器名称到重新统计方法的映射
+    counters = {
+        'fictions': lambda: Fictions.query.count()
+    }
+
+    @classmethod
+    def incr(cls, name, delta):
+        """
+        原子地增加计数值，计数器还不存在时不处理，读取时再重新统计。需要调用方提交事务
+
+        Args:
+            name: 计数器名称
+            delta: 增加的值，可以为负数
+        """
+        LibraryCounters.query.filter(LibraryCounters.name == name).update(
+            {LibraryCounters.value: LibraryCounters.value + delta}, synchronize_session=False)
+
+    @classmethod
+    def reconcile(cls):
+        """
+        重新统计全部计数器
+        """
+        for name, count in cls.counters.items():
+            value = count()
+            counter: LibraryCounters = LibraryCounters.query.get(name)
+            if counter:
+                counter.value = value
+            else:
+                db.session.add(LibraryCounters(name=name, value=value))
+        db.session.commit()
+
+    @classmethod
+    def get_value(cls, name):
+        """
+        读取计数值，计数器不存在时重新统计并保存
+
+        Args:
+            name: 计数器名称
+        """
+        counter: LibraryCounters = LibraryCounters.query.get(name)
+        if counter:
+            return counter.value
+        value = cls.counters[name]()
+        try:
+            db.session.add(LibraryCounters(name=name, value=value))
+            db.session.commit()
+        except IntegrityError:
+            # 其他请求已经创建了这个计数器
+            db.session.rollback()
+        return value
 
 
 class EmailConfig(db.Model):
@@ -171,3 +739,325 @@ class EmailConfig(db.Model):
         """
         email_config = EmailConfig.query.first()
         return email_config
+
+
+class TaskJobs(db.Model):
+    """
+    后台任务信息表
+    """
+
+    job_id = db.Column(db.String(32), nullable=False, primary_key=True, comment='任务编号')
+    kind = db.Column(db.String(16), nullable=False, default='', comment='任务类型')
+    fiction_id = db.Column(db.Integer, nullable=False, default=0, comment='小说编号')
+    status = db.Column(db.String(16), nullable=False, default='pending',
+                       comment='任务状态 pending-等待中，running-执行中，done-已完成，failed-失败')
+    total = db.Column(db.Integer, nullable=False, default=0, comment='需要处理的数量')
+    finished = db.Column(db.Integer, nullable=False, default=0, comment='已处理的数量')
+    msg = db.Column(db.String(255), nullable=False, default='', comment='任务说明或错误信息')
+    owner = db.Column(db.String(64), nullable=False, default='', comment='执行任务的进程，主机名:进程号')
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.now, comment='创建时间')
+    update_time = db.Column(db.DateTime, nullable=False, default=datetime.now, comment='更新时间')
+
+    def to_dict(self):
+        data = {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'fiction_id': self.fiction_id,
+            'status': self.status,
+            'total': self.total,
+            'finished': self.finished,
+            'msg': self.msg,
+            'create_time': self.create_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'update_time': self.update_time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        return data
+
+    @classmethod
+    def create_job(cls, kind, fiction_id=0, total=0):
+        """
+        创建一个等待执行的任务
+
+        Args:
+            kind: 任务类型
+            fiction_id: 小说编号
+            total: 需要处理的数量
+        """
+        job = TaskJobs(job_id=uuid.uuid4().hex, kind=kind, fiction_id=fiction_id, total=total,
+                       owner=cls.current_owner())
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    @classmethod
+    def current_owner(cls):
+        """
+        当前进程的标识，任务在创建它的进程中的后台线程执行
+        """
+        return '{}:{}'.format(socket.gethostname(), os.getpid())[-64:]
+
+    def is_orphaned(self, now=None):
+        """
+        任务是否已经丢失：执行它的本机进程已经退出（比如gunicorn重启了worker）。
+        本机进程还在运行时，任务可能只是在排队，不算丢失；
+        只有无法检查进程的任务（其他主机上的进程），才按超过TASK_JOB_STALE_SECONDS没有更新判断
+        """
+        if self.status not in ('pending', 'running'):
+            return False
+        host, _, pid = self.owner.rpartition(':')
+        if host == socket.gethostname() and pid.isdigit():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                # 进程存在但属于其他用户，无法确认是不是执行任务的进程，按更新时间判断
+                pass
+            else:
+                return False
+        now = now or datetime.now()
+        return self.update_time < now - timedelta(seconds=Config.TASK_JOB_STALE_SECONDS)
+
+    @classmethod
+    def fail_orphaned_jobs(cls, job_ids=None, kind=None):
+        """
+        把已经丢失的等待中和执行中的任务标记为失败。
+        任务只保存在执行进程的内存队列中，进程退出后不会再有人更新它们
+
+        Args:
+            job_ids: 只检查这些任务，为空时检查全部等待中和执行中的任务
+            kind: 只检查这个类型的任务，为空时检查全部类型
+
+        Returns:
+            typing.List[TaskJobs]，标记为失败的任务
+        """
+        query = TaskJobs.query.filter(TaskJobs.status.in_(['pending', 'running']))
+        if job_ids is not None:
+            query = query.filter(TaskJobs.job_id.in_(job_ids))
+        if kind is not None:
+            query = query.filter(TaskJobs.kind == kind)
+        now = datetime.now()
+        orphaned_jobs = [job for job in query.all() if job.is_orphaned(now)]
+        failed_jobs = []
+        for job in orphaned_jobs:
+            # 只在状态没有变化时修改，避免覆盖刚刚完成的任务
+            updated = TaskJobs.query.filter(TaskJobs.job_id == job.job_id, TaskJobs.status == job.status).update(
+                {'status': 'failed', 'msg': '执行任务的进程已退出，请重新提交！', 'update_time': now},
+                synchronize_session=False)
+            if not updated:
+                continue
+            failed_jobs.append(job)
+            if job.kind == 'enqueue':
+                # 和发布失败时一样，下次更新时重新推送没有发布的章节
+                Fictions.release_unpublished(job.fiction_id)
+        db.session.commit()
+        return failed_jobs
+
+    @classmethod
+    def update_job(cls, job_id, **fields):
+        """
+        更新任务状态
+
+        Args:
+            job_id: 任务编号
+            fields: 需要更新的字段
+        """
+        fields['update_time'] = datetime.now()
+        TaskJobs.query.filter(TaskJobs.job_id == job_id).update(fields)
+        db.session.commit()
+
+    @classmethod
+    def touch(cls, job_ids):
+        """
+        刷新等待中和执行中任务的更新时间，表示执行任务的进程还在处理这些任务。
+        使用单独的连接提交，不影响当前会话中正在流式读取的查询
+
+        Args:
+            job_ids: 任务编号列表
+        """
+        if not job_ids:
+            return
+        with db.engine.begin() as conn:
+            conn.execute(TaskJobs.__table__.update().where(TaskJobs.job_id.in_(job_ids)).where(
+                TaskJobs.status.in_(['pending', 'running'])).values(update_time=datetime.now()))
+
+
+class ChapterJobs(db.Model):
+    """
+    已推送到采集队列、还没有写入数据库的章节，避免重复推送同一个章节。
+    章节写入数据库后删除对应记录，超过过期时间的记录视为已丢失，可以重新推送
+    """
+
+    fiction_id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=False, comment='小说编号')
+    origin_id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=False,
+                          comment='来源网站上的小说章节编号')
+    status = db.Column(db.String(16), nullable=False, default='queued',
+                       comment='状态 queued-排队中，running-下载中，failed-重试次数用完')
+    expire_at = db.Column(db.DateTime, nullable=False, comment='过期时间')
+
+    @classmethod
+    def register(cls, fiction_id, chapters: typing.List, ttl):
+        """
+        登记即将推送的章节，过滤掉已经在队列中的章节。需要调用方提交事务
+
+        Args:
+            fiction_id: 小说编号
+            chapters: 待推送的章节列表，元素需要有origin_id属性
+            ttl: 登记的有效期，单位秒
+
+        Returns:
+            需要推送的章节列表
+        """
+        if not chapters:
+            return []
+        now = datetime.now()
+        origin_ids = [chapter.origin_id for chapter in chapters]
+        # 清理已过期的记录，对应章节重新推送
+        ChapterJobs.query.filter(ChapterJobs.fiction_id == fiction_id, ChapterJobs.origin_id.in_(origin_ids),
+                                 ChapterJobs.expire_at <= now).delete(synchronize_session=False)
+        in_flight_ids = {row[0] for row in ChapterJobs.query.with_entities(ChapterJobs.origin_id).filter(
+            ChapterJobs.fiction_id == fiction_id, ChapterJobs.origin_id.in_(origin_ids)).all()}
+        chapters = [chapter for chapter in chapters if chapter.origin_id not in in_flight_ids]
+        if chapters:
+            expire_at = now + timedelta(seconds=ttl)
+            rows = [{'fiction_id': fiction_id, 'origin_id': chapter.origin_id, 'status': 'queued',
+                     'expire_at': expire_at} for chapter in chapters]
+            # 并发登记同一批章节时忽略冲突，重复推送的章节在写入时会被唯一索引去重
+            statement = ChapterJobs.__table__.insert().prefix_with('IGNORE', dialect='mysql').prefix_with(
+                'OR IGNORE', dialect='sqlite')
+            db.session.execute(statement, rows)
+        return chapters
+
+    @classmethod
+    def release_queued(cls, fiction_id):
+        """
+        删除小说排队中的章节记录，推送失败时调用，下次更新时重新推送。需要调用方提交事务
+
+        Args:
+            fiction_id: 小说编号
+        """
+        ChapterJobs.query.filter(ChapterJobs.fiction_id == fiction_id, ChapterJobs.status == 'queued').delete(
+            synchronize_session=False)
+
+    @classmethod
+    def count_by_status(cls, fiction_id):
+        """
+        统计小说各状态的章节数
+
+        Args:
+            fiction_id: 小说编号
+
+        Returns:
+            typing.Dict[str, int]
+        """
+        return cls.count_by_fictions([fiction_id])[fiction_id]
+
+    @classmethod
+    def count_by_fictions(cls, fiction_ids):
+        """
+        一次统计多本小说各状态的章节数。排队中和下载中的只统计未过期的记录，失败的记录在重新推送前一直计数
+
+        Args:
+            fiction_ids: 小说编号列表
+
+        Returns:
+            typing.Dict[int, typing.Dict[str, int]]
+        """
+        counts = {fiction_id: {'queued': 0, 'running': 0, 'failed': 0} for fiction_id in fiction_ids}
+        if not fiction_ids:
+            return counts
+        rows = ChapterJobs.query.with_entities(ChapterJobs.fiction_id, ChapterJobs.status, db.func.count()).filter(
+            ChapterJobs.fiction_id.in_(fiction_ids),
+            db.or_(ChapterJobs.status == 'failed', ChapterJobs.expire_at > datetime.now())).group_by(
+            ChapterJobs.fiction_id, ChapterJobs.status).all()
+        for fiction_id, status, number in rows:
+            counts[fiction_id][status] = number
+        return counts
+
+
+class ChapterDictionaries(db.Model):
+    """
+    按网站训练的章节内容压缩字典，字典写入后不再修改，已压缩的章节始终使用压缩时的字典解压
+    """
+
+    dict_id = db.Column(db.Integer, nullable=False, primary_key=True, autoincrement=True)
+    site = db.Column(db.String(32), nullable=False, index=True, comment='网站名称')
+    codec = db.Column(db.String(8), nullable=False, comment='字典对应的压缩方式')
+    data = db.Column(db.LargeBinary().with_variant(mysql.MEDIUMBLOB(), 'mysql'), nullable=False, comment='字典内容')
+    samples = db.Column(db.Integer, nullable=False, default=0, comment='训练使用的章节数')
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.now, comment='创建时间')
+
+    # 进程内缓存，字典编号到字典内容
+    _data_cache: typing.Dict[int, bytes] = {}
+    # 进程内缓存，(网站, 压缩方式)到(字典编号, 字典内容, 读取时间)，定时重新读取以使用新训练的字典
+    _latest_cache: typing.Dict[typing.Tuple[str, str], typing.Tuple[int, bytes, float]] = {}
+    _latest_ttl = 600
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_data(cls, session, dict_id):
+        """
+        读取字典内容
+
+        Args:
+            session: 数据库会话，为None时使用单独的连接查询，调用方正在通过服务端游标读取章节时使用
+            dict_id: 字典编号，为0时返回b''
+        """
+        if not dict_id:
+            return b''
+        data = cls._data_cache.get(dict_id)
+        if data is None:
+            if session is None:
+                with db.engine.connect() as connection:
+                    data = connection.execute(db.select([ChapterDictionaries.data]).where(
+                        ChapterDictionaries.dict_id == dict_id)).scalar()
+            else:
+                dictionary = session.query(ChapterDictionaries).get(dict_id)
+                data = dictionary.data if dictionary else None
+            if data is None:
+                raise Exception('压缩字典{}不存在！'.format(dict_id))
+            with cls._lock:
+                cls._data_cache[dict_id] = data
+        return data
+
+    @classmethod
+    def preload(cls, session, dict_ids):
+        """
+        一次读取多个字典放入进程内缓存，已经缓存的字典不再读取
+
+        Args:
+            session: 数据库会话
+            dict_ids: 字典编号列表
+        """
+        missing = [dict_id for dict_id in set(dict_ids) if dict_id and dict_id not in cls._data_cache]
+        if not missing:
+            return
+        rows = session.query(ChapterDictionaries.dict_id, ChapterDictionaries.data).filter(
+            ChapterDictionaries.dict_id.in_(missing)).all()
+        with cls._lock:
+            for dict_id, data in rows:
+                cls._data_cache[dict_id] = data
+
+    @classmethod
+    def latest(cls, session, site, codec):
+        """
+        读取网站最新的字典
+
+        Args:
+            session: 数据库会话
+            site: 网站名称
+            codec: 压缩方式
+
+        Returns:
+            typing.Tuple[int, bytes]，字典编号和字典内容，没有字典时返回0和b''
+        """
+        cached = cls._latest_cache.get((site, codec))
+        if cached and time.time() - cached[2] < cls._latest_ttl:
+            return cached[0], cached[1]
+        row = session.query(ChapterDictionaries.dict_id).filter(
+            ChapterDictionaries.site == site, ChapterDictionaries.codec == codec).order_by(
+            ChapterDictionaries.dict_id.desc()).first()
+        dict_id = row[0] if row else 0
+        data = cls.get_data(session, dict_id)
+        with cls._lock:
+            cls._latest_cache[(site, codec)] = (dict_id, data, time.time())
+        return dict_id, data
@@ -71,3 +71,37 @@ class MiddleChapter(object):
     site = attrib(type=str, default='')
     # 小说主页地址
     fiction_url = attrib(type=str, default='')
+
+
+@attrs
+class SiteSearchStatus(object):
+    """
+    单个网站的检索状态
+    """
+
+    # 网站名称
+    site = attrib(type=str, default='')
+    # 检索状态 ok-成功，error-出错，timeout-超时未返回，open-网站熔断中未检索
+    status = attrib(type=str, default='ok')
+    # 耗时，单位秒
+    elapsed = attrib(type=float, default=0.0)
+    # 检索到的小说数量
+    total = attrib(type=int, default=0)
+
+
+@attrs
+class TocResult(object):
+    """
+    一次章节目录请求的结果
+    """
+
+    # 目录是否没有变化，没有变化时chapters为空
+    not_modified = attrib(type=bool, default=False)
+    # 章节列表
+    chapters = attrib(type=list, factory=list)
+    # 响应头中的ETag
+    etag = attrib(type=str, default='')
+    # 响应头中的Last-Modified
+    last_modified = attrib(type=str, default='')
+    # 章节列表的摘要
+    toc_hash = attrib(type=str, default='')
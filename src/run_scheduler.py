@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# @File    : run_scheduler.py
+# @Author  : AaronJny
+# @Time    : 2020/03/21
+# @Desc    : 启动自动更新调度器
+from loguru import logger
+from app import app
+from models import SpiderConfig, TaskJobs
+from spiders import SpiderManager
+from spiders.scheduler import RefreshScheduler
+
+logger.info('自动更新调度器已启动，正在检查需要更新的小说……')
+
+with app.app_context():
+    # 上次运行时没有发布完的章节消息随进程一起丢失了
+    TaskJobs.fail_orphaned_jobs()
+    spider_manager = SpiderManager.from_spider_configs(SpiderConfig.all_usable_spider_configs())
+    scheduler = RefreshScheduler(spider_manager)
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+logger.info('自动更新调度器已关闭！')
@@ -4,17 +4,33 @@
 # @Time    : 2020/03/06
 # @Desc    :
 from loguru import logger
+from config import Config
 from models import SpiderConfig
 from spiders import SpiderManager
-from utils import mysql
+from utils import mysql, metrics, rabbitmq
 
 logger.info('章节内容下载爬虫已启动，正在监听队列……')
 
+
+def collect_queue_depths():
+    for queue_name, depth in rabbitmq.queue_depths().items():
+        metrics.queue_depth.set(queue_name, value=depth)
+
+
+if Config.METRICS_PORT:
+    metrics.registry.add_collector(collect_queue_depths)
+    metrics.start_http_server(Config.METRICS_PORT)
+
 session = mysql.create_sqlalchemy_session()
 spider_configs = session.query(SpiderConfig).filter(SpiderConfig.spider_status == 1).all()
 
 spider_manager = SpiderManager.from_spider_configs(spider_configs)
-spider_manager.listen_and_crawl_chapter_contents(session)
+if Config.SPIDER_WORKER_MODE == 'asyncio':
+    from spiders.async_worker import listen_and_crawl_chapter_contents_async
+
+    listen_and_crawl_chapter_contents_async(spider_manager, session)
+else:
+    spider_manager.listen_and_crawl_chapter_contents(session)
 
 session.close()
 
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# @File    : async_worker.py
+# @Author  : AaronJny
+# @Time    : 2020/03/16
+# @Desc    : 基于asyncio的章节下载worker，可以同时下载多个章节
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+import typing
+import aio_pika
+import aiohttp
+from cattr import structure
+from loguru import logger
+from config import Config
+from models import MiddleChapter
+from utils import rabbitmq, metrics
+from .spider import SpiderManager, BaseSpider, circuit_breaker
+from .write_buffer import ChapterWriteBuffer
+
+
+class AsyncChapterWorker:
+    """
+    异步章节下载worker。
+    通过prefetch控制整个进程同时处理的消息数，每个网站最多同时下载site_concurrency个章节，
+    章节经写缓冲区批量写入数据库之后才确认消息
+    """
+
+    def __init__(self, spider_manager: SpiderManager, session, prefetch_count: int = None,
+                 site_concurrency: int = None):
+        self.spider_manager = spider_manager
+        self.write_buffer = ChapterWriteBuffer(session)
+        self.prefetch_count = prefetch_count or Config.SPIDER_PREFETCH_COUNT
+        self.site_concurrency = site_concurrency or Config.SPIDER_SITE_CONCURRENCY
+        self.client: typing.Optional[aiohttp.ClientSession] = None
+        self.channel: typing.Optional[aio_pika.Channel] = None
+        self._site_semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+        # 持有正在运行的任务的引用，避免被垃圾回收
+        self._tasks = set()
+        # 数据库会话和写缓冲区都不是线程安全的，只在这一个线程中使用
+        self._db_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _site_semaphore(self, site):
+        semaphore = self._site_semaphores.get(site)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.site_concurrency)
+            self._site_semaphores[site] = semaphore
+        return semaphore
+
+    @classmethod
+    async def _run_breaker(cls, method, *args):
+        """
+        熔断器的状态保存在sqlite中，其他进程持有写锁时会阻塞等待，放到线程池中执行，不阻塞事件循环
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, method, *args)
+
+    async def _download(self, spider: BaseSpider, middle_chapter: MiddleChapter):
+        async with self._site_semaphore(middle_chapter.site):
+            start_time = time.time()
+            try:
+                chapter = await spider.async_download_chapter(self.client, middle_chapter)
+            except Exception:
+                if circuit_breaker:
+                    await self._run_breaker(circuit_breaker.record, middle_chapter.site, False,
+                                            time.time() - start_time)
+                raise
+            if circuit_breaker:
+                await self._run_breaker(circuit_breaker.record, middle_chapter.site, True, time.time() - start_time)
+            return chapter
+
+    async def _park(self, message: aio_pika.IncomingMessage, site):
+        """
+        网站熔断中，将消息放入对应级别的暂存队列等网站恢复后再处理，不消耗重试次数，然后确认原消息
+        """
+        delay = await self._run_breaker(circuit_breaker.retry_after, site)
+        parked_message = aio_pika.Message(message.body, content_type=message.content_type,
+                                          delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                                          expiration=delay,
+                                          headers={'x-retry-count': int((message.headers or {}).get(
+                                              'x-retry-count', 0))})
+        await self.channel.default_exchange.publish(parked_message,
+                                                    routing_key=rabbitmq.parked_queue_name(
+                                                        rabbitmq.parked_queue_level(delay)))
+        await message.ack()
+        metrics.messages_in_flight.dec()
+
+    async def _mark_failed(self, message: aio_pika.IncomingMessage):
+        """
+        记录放入死信队列的章节，计入小说的失败章节数
+        """
+        try:
+            middle_chapter = structure(json.loads(message.body), MiddleChapter)
+            await asyncio.get_event_loop().run_in_executor(self._db_executor, self.write_buffer.mark_failed,
+                                                           middle_chapter)
+        except Exception as e:
+            logger.error(e)
+
+    async def _retry_later(self, message: aio_pika.IncomingMessage):
+        """
+        将处理失败的消息放入延迟重试队列，重试次数用完时放入死信队列，然后确认原消息
+        """
+        retry_count = int((message.headers or {}).get('x-retry-count', 0))
+        if retry_count >= Config.RETRY_MAX_ATTEMPTS:
+            routing_key = rabbitmq.dead_letter_queue_name()
+            retry_message = aio_pika.Message(message.body, content_type=message.content_type,
+                                             delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                                             headers={'x-retry-count': retry_count})
+            logger.error('重试{}次仍然失败，已放入死信队列：{}'.format(retry_count, message.body))
+            metrics.chapter_failures.inc()
+            await self._mark_failed(message)
+        else:
+            routing_key = rabbitmq.retry_queue_name(min(retry_count, Config.RETRY_MAX_ATTEMPTS - 1))
+            retry_message = aio_pika.Message(message.body, content_type=message.content_type,
+                                             delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                                             expiration=rabbitmq.compute_retry_delay(retry_count),
+                                             headers={'x-retry-count': retry_count + 1})
+            metrics.chapter_retries.inc()
+        await self.channel.default_exchange.publish(retry_message, routing_key=routing_key)
+        await message.ack()
+        metrics.messages_in_flight.dec()
+
+    def _buffer_chapter(self, chapter: MiddleChapter, message: aio_pika.IncomingMessage):
+        self.write_buffer.add(chapter, message)
+        return self._flush_if_due()
+
+    def _flush_if_due(self):
+        if not self.write_buffer.due():
+            return [], []
+        try:
+            messages = self.write_buffer.flush()
+        except Exception as e:
+            # 写入失败的章节留在缓冲区中，稍后重试
+            logger.error(e)
+            return [], []
+        return messages, [message for _, message in self.write_buffer.take_rejected()]
+
+    async def _ack_messages(self, flushed):
+        """
+        确认写缓冲区处理完的消息
+
+        Args:
+            flushed: _flush_if_due的返回值，(已写入和被拒绝的消息, 被拒绝的消息)
+        """
+        messages, rejected_messages = flushed
+        for message in rejected_messages:
+            # 无法写入数据库的章节重试也不会成功，直接放入死信队列
+            dead_message = aio_pika.Message(message.body, content_type=message.content_type,
+                                            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                                            headers={'x-retry-count': int((message.headers or {}).get(
+                                                'x-retry-count', 0))})
+            await self.channel.default_exchange.publish(dead_message, routing_key=rabbitmq.dead_letter_queue_name())
+            metrics.chapter_failures.inc()
+        for message in messages:
+            await message.ack()
+        metrics.messages_in_flight.dec(amount=len(messages))
+
+    async def _handle_message(self, message: aio_pika.IncomingMessage):
+        loop = asyncio.get_event_loop()
+        try:
+            middle_chapter = structure(json.loads(message.body), MiddleChapter)
+            spider = self.spider_manager.spiders.get(middle_chapter.site)
+            await loop.run_in_executor(self._db_executor, self.write_buffer.mark_started, middle_chapter)
+            if circuit_breaker and not await self._run_breaker(circuit_breaker.allow, middle_chapter.site):
+                await self._park(message, middle_chapter.site)
+                return
+            chapter = await self._download(spider, middle_chapter)
+        except Exception as e:
+            logger.error(e)
+            await self._retry_later(message)
+            return
+        flushed = await loop.run_in_executor(self._db_executor, self._buffer_chapter, chapter, message)
+        await self._ack_messages(flushed)
+
+    async def _flush_periodically(self):
+        """
+        定时检查写缓冲区，避免消息较少时章节迟迟不写入数据库
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(0.5)
+            flushed = await loop.run_in_executor(self._db_executor, self._flush_if_due)
+            await self._ack_messages(flushed)
+
+    async def on_message(self, message: aio_pika.IncomingMessage):
+        # 每条消息在独立的任务中处理，同时处理的数量由prefetch限制
+        metrics.messages_in_flight.inc()
+        task = asyncio.ensure_future(self._handle_message(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def run(self):
+        connection = await aio_pika.connect_robust(Config.RABBITMQ_URL)
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
+        exchange = await channel.declare_exchange(Config.RABBITMQ_EXCHANGE, aio_pika.ExchangeType(Config.EXCHANGE_TYPE),
+                                                  durable=True)
+        queue = await channel.declare_queue(Config.RABBITMQ_QUEUE, auto_delete=True)
+        await queue.bind(exchange, routing_key=Config.ROUTING_KEY)
+        for level in range(Config.RETRY_MAX_ATTEMPTS):
+            await channel.declare_queue(rabbitmq.retry_queue_name(level), durable=True,
+                                        arguments=rabbitmq.retry_queue_arguments())
+        for level in range(rabbitmq.parked_queue_levels()):
+            await channel.declare_queue(rabbitmq.parked_queue_name(level), durable=True,
+                                        arguments=rabbitmq.retry_queue_arguments())
+        await channel.declare_queue(rabbitmq.dead_letter_queue_name(), durable=True)
+        self.channel = channel
+        timeout = aiohttp.ClientTimeout(total=BaseSpider.timeout)
+        connector = aiohttp.TCPConnector(limit_per_host=self.site_concurrency)
+        async with aiohttp.ClientSession(headers=BaseSpider.default_headers, timeout=timeout,
+                                         connector=connector) as client:
+            self.client = client
+            await queue.consume(self.on_message)
+            try:
+                # 持续运行，直到被取消
+                await self._flush_periodically()
+            finally:
+                await connection.close()
+
+
+def listen_and_crawl_chapter_contents_async(spider_manager: SpiderManager, session):
+    """
+    以异步模式监听消息队列，持续读取采集需求并进行处理
+
+    Args:
+        spider_manager: 爬虫管理器
+        session: 数据库会话
+    """
+    spider_manager.session = session
+    worker = AsyncChapterWorker(spider_manager, session)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(worker.run())
+    except KeyboardInterrupt:
+        pass
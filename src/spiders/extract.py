@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# @File    : extract.py
+# @Author  : AaronJny
+# @Time    : 2020/03/18
+# @Desc    : 基于lxml的网页解析工具
+import typing
+from lxml import etree
+
+# 解析器不保留注释，避免注释内容混进正文
+_parser = etree.HTMLParser(remove_comments=True)
+
+
+def parse_html(content: bytes, encoding: str = None):
+    """
+    将网页字节序列解析成lxml元素树
+
+    Args:
+        content: 网页字节序列
+        encoding: 网页编码，为None时由lxml根据网页声明自动识别。
+                  指定编码时先忽略非法字节再解析，libxml2遇到非法字节会直接截断后面的内容
+
+    Returns:
+        根元素，网页为空时返回None
+    """
+    if encoding:
+        return etree.HTML(content.decode(encoding, errors='ignore'), _parser)
+    return etree.HTML(content, _parser)
+
+
+def has_class(class_name: str):
+    """
+    生成匹配class属性中包含class_name的XPath条件
+    """
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(class_name)
+
+
+def first(elements: typing.List, default=None):
+    """
+    取XPath结果中的第一个
+    """
+    return elements[0] if elements else default
+
+
+def element_text(element, strip=False):
+    """
+    拼接元素中的全部文本，br标签转换为换行
+
+    Args:
+        element: lxml元素
+        strip: 是否去掉首尾空白
+    """
+    if element is None:
+        return ''
+    texts = []
+    # 用栈代替递归遍历元素树，依次处理元素的文本、子元素和子元素后的文本
+    stack = [element]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            texts.append(item)
+            continue
+        if item.tag == 'br':
+            texts.append('\n')
+        elif item.text:
+            texts.append(item.text)
+        for child in reversed(item):
+            if child.tail:
+                stack.append(child.tail)
+            stack.append(child)
+    text = ''.join(texts)
+    return text.strip() if strip else text
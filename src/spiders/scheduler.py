@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# @File    : scheduler.py
+# @Author  : AaronJny
+# @Time    : 2020/03/21
+# @Desc    : 自动更新书架中全部小说的调度器
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import json
+import random
+import time
+import typing
+from cattr import unstructure
+from loguru import logger
+from sqlalchemy import or_
+from config import Config
+from models import db, Fictions, TaskJobs, LibraryCounters, FictionChapters
+from utils import rabbitmq
+from .spider import SpiderManager, SiteCircuitOpen, circuit_breaker
+
+
+class RefreshScheduler:
+    """
+    自动更新调度器。
+    每轮取出到期的小说，按网站分组并发请求章节目录，请求速率由限流器和熔断器控制。
+    每本小说的更新间隔根据是否发现新章节自适应调整：发现新章节时缩短，参考上次发现新章节以来的时长；
+    没有发现时按倍数放大，很少更新的小说逐渐退避到最长间隔
+    """
+
+    def __init__(self, spider_manager: SpiderManager, batch_size: int = None, site_concurrency: int = None):
+        self.spider_manager = spider_manager
+        self.batch_size = batch_size or Config.REFRESH_BATCH_SIZE
+        self.site_concurrency = site_concurrency or Config.REFRESH_SITE_CONCURRENCY
+        # 每个网站一个线程池，限制同一网站同时进行的目录请求数
+        self._executors: typing.Dict[str, ThreadPoolExecutor] = {}
+        # 上次核对计数器的时间
+        self._last_reconcile_time = 0
+
+    def _executor(self, site):
+        executor = self._executors.get(site)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=self.site_concurrency)
+            self._executors[site] = executor
+        return executor
+
+    def due_fictions(self, now: datetime):
+        """
+        查询到期需要更新的小说，最久没有更新的排在前面
+
+        Args:
+            now: 当前时间
+        """
+        return Fictions.query.filter(or_(Fictions.next_refresh_time.is_(None),
+                                         Fictions.next_refresh_time <= now)).order_by(
+            Fictions.next_refresh_time).limit(self.batch_size).all()
+
+    @classmethod
+    def next_interval(cls, fiction: Fictions, found_new: bool, last_new_chapter_time: typing.Optional[datetime],
+                      now: datetime):
+        """
+        计算下次更新的间隔
+
+        Args:
+            fiction: 小说
+            found_new: 本次是否发现了新章节
+            last_new_chapter_time: 本次之前最近一次发现新章节的时间
+            now: 当前时间
+
+        Returns:
+            更新间隔，单位秒
+        """
+        interval = fiction.refresh_interval or Config.REFRESH_MIN_INTERVAL
+        if found_new:
+            interval = interval / 2
+            if last_new_chapter_time:
+                # 两次发现新章节的间隔可以近似看作小说的更新周期，按周期的一半检查
+                interval = min(interval, (now - last_new_chapter_time).total_seconds() / 2)
+        else:
+            interval = interval * Config.REFRESH_BACKOFF_FACTOR
+        return int(min(max(interval, Config.REFRESH_MIN_INTERVAL), Config.REFRESH_MAX_INTERVAL))
+
+    @classmethod
+    def _schedule(cls, fiction: Fictions, delay: float):
+        # 加入随机抖动，避免同一批小说一直在同一时刻到期
+        delay = delay * random.uniform(0.9, 1.1)
+        fiction.next_refresh_time = datetime.now() + timedelta(seconds=delay)
+
+    def _refresh_done(self, fiction: Fictions, future):
+        try:
+            toc = future.result()
+        except SiteCircuitOpen:
+            # 网站熔断中，等网站恢复后再更新，不改变更新间隔
+            self._schedule(fiction, circuit_breaker.retry_after(fiction.site) if circuit_breaker else
+                           Config.REFRESH_ERROR_DELAY)
+            db.session.commit()
+            return 0
+        except Exception as e:
+            logger.error('{} 更新失败：{}'.format(fiction.fiction_name, e))
+            self._schedule(fiction, Config.REFRESH_ERROR_DELAY)
+            db.session.commit()
+            return 0
+        last_new_chapter_time = fiction.last_new_chapter_time
+        uncached_chapters = self.spider_manager.apply_toc(fiction, toc)
+        if uncached_chapters:
+            bodies = [json.dumps(unstructure(middle_chapter)) for middle_chapter in uncached_chapters]
+            job = TaskJobs.create_job('enqueue', fiction_id=fiction.fid, total=len(bodies))
+            rabbitmq.publisher.submit(bodies, SpiderManager.make_publish_callback(job.job_id, fiction.fid))
+            logger.info('{} 发现{}个新章节'.format(fiction.fiction_name, len(uncached_chapters)))
+        fiction.refresh_interval = self.next_interval(fiction, bool(uncached_chapters), last_new_chapter_time,
+                                                      datetime.now())
+        self._schedule(fiction, fiction.refresh_interval)
+        db.session.commit()
+        return len(uncached_chapters)
+
+    def run_once(self):
+        """
+        更新一轮到期的小说
+
+        Returns:
+            本轮更新的小说数量
+        """
+        fictions = self.due_fictions(datetime.now())
+        futures = {}
+        for fiction in fictions:
+            if fiction.site not in self.spider_manager.spiders:
+                # 对应的爬虫已关闭，稍后再检查
+                self._schedule(fiction, Config.REFRESH_ERROR_DELAY)
+                continue
+            # 线程中只请求网络，数据库操作都在当前线程中进行
+            future = self._executor(fiction.site).submit(self.spider_manager.get_toc, fiction.fiction_url,
+                                                         fiction.fiction_name, fiction.site, fiction.toc_etag,
+                                                         fiction.toc_last_modified, fiction.toc_hash)
+            futures[future] = fiction
+        db.session.commit()
+        new_chapters = 0
+        for future in as_completed(futures):
+            new_chapters += self._refresh_done(futures[future], future)
+        if fictions:
+            logger.info('本轮更新了{}本小说，发现{}个新章节'.format(len(fictions), new_chapters))
+        return len(fictions)
+
+    @classmethod
+    def reconcile(cls):
+        """
+        核对并修复已缓存章节数和书架计数器
+        """
+        repaired = Fictions.reconcile_cached_chapters_count()
+        LibraryCounters.reconcile()
+        logger.info('计数器核对完成，修复了{}本小说的已缓存章节数'.format(repaired))
+        if Config.CHAPTER_STORAGE == 'segments':
+            cls.compact_segments()
+
+    @classmethod
+    def compact_segments(cls):
+        """
+        整理无效内容过多的段文件，并把仍保存在数据库中的章节迁移到段文件
+        """
+        compacted = 0
+        for (fiction_id,) in Fictions.query.with_entities(Fictions.fid).all():
+            try:
+                compacted += FictionChapters.compact_segments_if_needed(fiction_id)
+            except Exception as e:
+                logger.error('小说{}的段文件整理失败：{}'.format(fiction_id, e))
+        logger.info('段文件检查完成，整理了{}本小说'.format(compacted))
+
+    def run_forever(self):
+        """
+        持续运行调度器，没有到期的小说时等待一段时间再检查，并定时核对计数器
+        """
+        while True:
+            try:
+                if time.time() - self._last_reconcile_time >= Config.RECONCILE_INTERVAL:
+                    self._last_reconcile_time = time.time()
+                    self.reconcile()
+                refreshed = self.run_once()
+            except Exception as e:
+                logger.error(e)
+                db.session.rollback()
+                refreshed = 0
+            finally:
+                # 每轮结束后丢弃会话中的对象，下一轮重新从数据库读取
+                db.session.remove()
+            if refreshed < self.batch_size:
+                time.sleep(Config.REFRESH_POLL_INTERVAL)
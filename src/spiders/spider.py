@@ -3,20 +3,46 @@
 # @Author  : AaronJny
 # @Time    : 2020/02/28
 # @Desc    :
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+import hashlib
+import importlib.util
 import json
-import re
+import threading
+import time
 import traceback
 import typing
-from cattr import structure
-from bs4 import BeautifulSoup
+import unicodedata
+from cattr import structure, unstructure
+from flask import current_app
 from loguru import logger
+from lxml import etree
 import requests
-from tenacity import retry, stop_after_attempt, wait_fixed
+from requests.adapters import HTTPAdapter
+from tenacity import retry, stop_any, stop_after_attempt, wait_fixed
 from urllib.parse import urljoin
-from models import FictionSearchItem, SpiderConfig, SimpleChapter
-from models import MiddleChapter, FictionChapters
+from config import Config
+from models import FictionSearchItem, SpiderConfig, SimpleChapter, SiteSearchStatus, TocResult
+from models import MiddleChapter, Fictions, ChapterJobs, TaskJobs
 from models import db
-from utils import rabbitmq
+from utils import rabbitmq, metrics
+from utils.cache import TTLCache, SqliteCacheBackend
+from utils.ratelimit import DomainRateLimiter
+from utils.circuit_breaker import SiteCircuitBreaker
+from .extract import parse_html, has_class, first, element_text
+from .write_buffer import ChapterWriteBuffer
+
+# 并发检索各网站时使用的线程池，在进程内共享
+search_executor = ThreadPoolExecutor(max_workers=Config.SEARCH_MAX_WORKERS)
+# 检索结果缓存，按网站和规范化后的小说名称缓存
+search_cache = TTLCache(max_size=Config.SEARCH_CACHE_SIZE, ttl=Config.SEARCH_CACHE_TTL,
+                        backend=SqliteCacheBackend(Config.SEARCH_CACHE_DB_PATH) if Config.SEARCH_CACHE_DB_PATH else None)
+# 多进程共享的按域名限流器
+rate_limiter = DomainRateLimiter(Config.RATE_LIMIT_DB_PATH) if Config.RATE_LIMIT_ENABLED else None
+# 多进程共享的按网站熔断器
+circuit_breaker = SiteCircuitBreaker(Config.BREAKER_DB_PATH) if Config.BREAKER_ENABLED else None
+
 
 def retry_exception_log_callback(retry_state):
     """
@@ -26,6 +52,53 @@ def retry_exception_log_callback(retry_state):
     return []
 
 
+def _accept_encoding():
+    """
+    安装了brotli时，额外声明支持br压缩
+    """
+    if importlib.util.find_spec('brotli'):
+        return 'gzip, deflate, br'
+    return 'gzip, deflate'
+
+
+# 按域名共享的HTTP会话，同一进程内的所有爬虫实例复用连接池
+http_sessions: typing.Dict[str, requests.Session] = {}
+http_sessions_lock = threading.Lock()
+# 当前线程中请求的截止时间，并发检索时设置，超过截止时间的请求不再发起
+request_deadline = threading.local()
+
+
+class SiteCircuitOpen(Exception):
+    """
+    网站处于熔断状态，暂时不发起请求
+    """
+
+
+class RequestDeadlineExceeded(Exception):
+    """
+    已经超过当前线程的请求截止时间
+    """
+
+
+def remaining_request_time():
+    """
+    Returns:
+        当前线程距离请求截止时间的秒数，没有设置截止时间时返回None
+    """
+    expires_at = getattr(request_deadline, 'expires_at', None)
+    if expires_at is None:
+        return None
+    return expires_at - time.time()
+
+
+def request_deadline_passed(retry_state):
+    """
+    重试的停止条件，超过请求截止时间后不再重试
+    """
+    remaining = remaining_request_time()
+    return remaining is not None and remaining <= 0
+
+
 class BaseSpider:
     """
     爬虫基本类
@@ -35,21 +108,112 @@ class BaseSpider:
     domain = 'sample.com'
     # 网站名称
     site = '示例网站'
+    # 所有请求共用的默认请求头
+    default_headers = {
+        'User-Agent':
+        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.97 Safari/537.36',
+        'Accept':
+        'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3',
+        'Accept-Encoding': _accept_encoding(),
+        'Connection': 'keep-alive',
+    }
+    # 请求超时时间，单位秒
+    timeout = 20
 
-    @classmethod
-    def replace_br(cls, content: bytes, encoding='utf8'):
+    @property
+    def http_session(self) -> requests.Session:
         """
-        将content中的br标签，替换成\n+br，以保证换行被正确保留
+        当前域名对应的HTTP会话，使用带连接数上限的keep-alive连接池
+        """
+        with http_sessions_lock:
+            session = http_sessions.get(self.domain)
+            if session is None:
+                session = requests.Session()
+                session.headers.update(self.default_headers)
+                # pool_block=True时，连接数达到上限的请求会等待空闲连接，而不是新建连接
+                adapter = HTTPAdapter(pool_connections=Config.SPIDER_POOL_CONNECTIONS,
+                                      pool_maxsize=Config.SPIDER_POOL_MAXSIZE, pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                http_sessions[self.domain] = session
+        return session
+
+    def fetch(self, url, referer=None, **kwargs):
+        """
+        通过共享的会话发起GET请求
 
         Args:
-            content: 网页字节序列
-            encoding: 编码方式
+            url: 请求地址
+            referer: 来源页面地址
+            kwargs: 传递给requests的其他参数
+
+        Returns:
+            requests.Response
         """
-        html = content.decode(encoding, errors='ignore')
-        html = re.sub('<[ ]*br[ ]*/?[ ]*>', '\n<br>', html)
-        return html
-    
-    @retry(stop = stop_after_attempt(3), wait = wait_fixed(2), retry_error_callback = retry_exception_log_callback)
+        headers = kwargs.pop('headers', {})
+        if referer:
+            headers['Referer'] = referer
+        kwargs.setdefault('timeout', self.timeout)
+        if not rate_limiter:
+            return self._timed_get(url, headers, **kwargs)
+        # 每个请求都要先从限流器中取得名额
+        with rate_limiter.limit(self.domain) as result:
+            response = self._timed_get(url, headers, **kwargs)
+            result['status_code'] = response.status_code
+        return response
+
+    def _timed_get(self, url, headers, **kwargs):
+        """
+        发起GET请求，并记录请求耗时、下载字节数和失败次数。
+        设置了请求截止时间时，超时时间不超过剩余的时间
+        """
+        remaining = remaining_request_time()
+        if remaining is not None:
+            if remaining <= 0:
+                raise RequestDeadlineExceeded('请求{}时已超过截止时间！'.format(url))
+            kwargs['timeout'] = min(kwargs['timeout'], remaining)
+        try:
+            with metrics.fetch_seconds.time(self.site):
+                response = self.http_session.get(url, headers=headers, **kwargs)
+        except Exception:
+            metrics.fetch_errors.inc(self.site)
+            raise
+        metrics.fetch_bytes.inc(self.site, amount=len(response.content))
+        return response
+
+    @classmethod
+    def pool_stats(cls):
+        """
+        统计各域名连接池的请求数、新建连接数和连接复用率
+
+        Returns:
+            typing.List[dict]
+        """
+        stats = []
+        with http_sessions_lock:
+            sessions = list(http_sessions.items())
+        for domain, session in sessions:
+            pools = session.get_adapter('https://').poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                num_requests = pool.num_requests
+                num_connections = pool.num_connections
+                reuse_rate = (num_requests - num_connections) / num_requests if num_requests else 0
+                stats.append({
+                    'domain': domain,
+                    'host': pool.host,
+                    'scheme': pool.scheme,
+                    'requests': num_requests,
+                    'connections': num_connections,
+                    # 连接池队列中的None是尚未创建的连接占位
+                    'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn) if pool.pool else 0,
+                    'reuse_rate': round(reuse_rate, 4)
+                })
+        return stats
+
+    @retry(stop=stop_any(stop_after_attempt(3), request_deadline_passed), wait=wait_fixed(2), reraise=True)
     def search_fictions_by_name(self, fiction_name):
         """
         通过书名检索相关书籍
@@ -79,12 +243,65 @@ class BaseSpider:
         return result
 
     def _get_chapters(self, fiction_url, fiction_name):
+        return self._get_toc(fiction_url, fiction_name).chapters
+
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2), reraise=True)
+    def get_toc(self, fiction_url: str, fiction_name: str, etag: str = '', last_modified: str = '',
+                toc_hash: str = ''):
+        """
+        带条件地请求小说章节目录。
+        传入上次保存的ETag和Last-Modified时，网站返回304即认为目录没有变化；
+        网站不支持条件请求时，再用章节列表的摘要和上次的摘要比较
+
+        Args:
+            fiction_url: 小说主页地址
+            fiction_name: 小说名称
+            etag: 上次响应的ETag
+            last_modified: 上次响应的Last-Modified
+            toc_hash: 上次章节列表的摘要
+
+        Returns:
+            TocResult
+        """
+        result: TocResult = self._get_toc(fiction_url, fiction_name, etag, last_modified)
+        if not result.not_modified:
+            result.toc_hash = self.compute_toc_hash(result.chapters)
+            if toc_hash and result.toc_hash == toc_hash:
+                result.not_modified = True
+                result.chapters = []
+        else:
+            result.toc_hash = toc_hash
+        return result
+
+    def _get_toc(self, fiction_url, fiction_name, etag='', last_modified=''):
         raise NotImplementedError
 
-    @retry(stop = stop_after_attempt(3), wait = wait_fixed(2), retry_error_callback = retry_exception_log_callback)
+    @classmethod
+    def conditional_headers(cls, etag='', last_modified=''):
+        """
+        根据上次响应的缓存校验信息生成条件请求头
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    @classmethod
+    def compute_toc_hash(cls, chapters: typing.List[SimpleChapter]):
+        """
+        计算章节列表的摘要，只包含章节编号和名称，不受网页中广告等内容变化的影响
+        """
+        sha1 = hashlib.sha1()
+        for chapter in chapters:
+            sha1.update('{}\t{}\n'.format(chapter.origin_id, chapter.chapter_name).encode('utf8'))
+        return sha1.hexdigest()
+
     def download_chapter(self, middle_chapter: MiddleChapter):
         """
-        根据章节信息，从网络上下载章节内容
+        根据章节信息，从网络上下载章节内容。
+        这里不做重试，失败的章节由采集队列延迟后重新投递，不阻塞消费者
 
         Args:
             middle_chapter: 章节基本信息
@@ -96,6 +313,59 @@ class BaseSpider:
         return result
 
     def _download_chapter(self, middle_chapter: MiddleChapter):
+        response = self.fetch(middle_chapter.chapter_url, referer=middle_chapter.fiction_url)
+        with metrics.parse_seconds.time(self.site):
+            return self._parse_chapter(middle_chapter, response.content)
+
+    async def async_download_chapter(self, client, middle_chapter: MiddleChapter):
+        """
+        使用异步HTTP客户端下载章节内容
+
+        Args:
+            client: aiohttp.ClientSession
+            middle_chapter: 章节基本信息
+
+        Returns:
+            MiddleChapter
+        """
+        lease_id = await rate_limiter.acquire_async(self.domain) if rate_limiter else None
+        start_time = time.time()
+        status_code = None
+        try:
+            async with client.get(middle_chapter.chapter_url,
+                                  headers={'Referer': middle_chapter.fiction_url}) as response:
+                status_code = response.status
+                content = await response.read()
+        except asyncio.CancelledError:
+            # 任务被取消时立即归还名额，不用等到名额过期
+            if rate_limiter:
+                rate_limiter.cancel_soon(lease_id)
+            raise
+        except Exception:
+            metrics.fetch_seconds.observe(self.site, value=time.time() - start_time)
+            metrics.fetch_errors.inc(self.site)
+            if rate_limiter:
+                await rate_limiter.release_async(lease_id, self.domain, time.time() - start_time, status_code,
+                                                 error=True)
+            raise
+        metrics.fetch_seconds.observe(self.site, value=time.time() - start_time)
+        metrics.fetch_bytes.inc(self.site, amount=len(content))
+        if rate_limiter:
+            await rate_limiter.release_async(lease_id, self.domain, time.time() - start_time, status_code)
+        with metrics.parse_seconds.time(self.site):
+            return self._parse_chapter(middle_chapter, content)
+
+    def _parse_chapter(self, middle_chapter: MiddleChapter, content: bytes):
+        """
+        从章节页面中解析出章节内容，同步和异步下载共用
+
+        Args:
+            middle_chapter: 章节基本信息
+            content: 章节页面字节序列
+
+        Returns:
+            MiddleChapter
+        """
         raise NotImplementedError
 
 
@@ -103,55 +373,61 @@ class ZwdaSpider(BaseSpider):
     domain = 'www.zwda.com'
     site = 'E小说'
 
-    def _search_fictions_by_name(self, fiction_name):
-        headers = {
-            'User-Agent':
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.97 Safari/537.36',
-            'Accept':
-            'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3',
-            'Referer': 'https://{}'.format(self.domain),
-        }
+    # 预编译的XPath选择器
+    search_item_xpath = etree.XPath('(//div[{}])[1]//div[{}]'.format(has_class('result-list'),
+                                                                      has_class('result-item')))
+    search_image_xpath = etree.XPath('((.//div[{}])[1]//img)[1]/@src'.format(has_class('result-game-item-pic')))
+    search_title_xpath = etree.XPath('(.//h3[{}])[1]'.format(has_class('result-item-title')))
+    search_desc_xpath = etree.XPath('(.//p[{}])[1]'.format(has_class('result-game-item-desc')))
+    search_info_tags_xpath = etree.XPath('(.//div[{}])[1]//p[{}]'.format(has_class('result-game-item-info'),
+                                                                           has_class('result-game-item-info-tag')))
+    search_url_xpath = etree.XPath('((.//h3)[1]//a)[1]/@href')
+    span_xpath = etree.XPath('.//span')
+    link_xpath = etree.XPath('(.//a)[1]')
+    chapter_links_xpath = etree.XPath("(//div[@id='list'])[1]//a")
+    chapter_content_xpath = etree.XPath("(//div[@id='content'])[1]")
 
+    def _search_fictions_by_name(self, fiction_name):
         params = (('q', fiction_name), )
 
-        response = requests.get('https://{}/search.php'.format(self.domain),
-                                headers=headers,
-                                params=params,
-                                timeout=20)
+        response = self.fetch('https://{}/search.php'.format(self.domain),
+                              referer='https://{}'.format(self.domain),
+                              params=params)
+        return self._parse_search_results(response.content)
+
+    def _parse_search_results(self, content: bytes):
+        """
+        从搜索结果页中解析小说信息
+
+        Args:
+            content: 搜索结果页字节序列
 
-        bsobj = BeautifulSoup(response.content, 'lxml')
-        # 提取搜索结果列表
-        fiction_divs = bsobj.find('div', {
-            'class': 'result-list'
-        }).find_all('div', {'class': 'result-item'})
+        Returns:
+            typing.List[FictionSearchItem]
+        """
+        root = parse_html(content)
+        if root is None:
+            return []
         results = []
         # 逐个解析小说信息
-        for fiction_div in fiction_divs:
+        for fiction_div in self.search_item_xpath(root):
             # 小说封面地址
-            image_url = fiction_div.find('div', {
-                'class': 'result-game-item-pic'
-            }).find('img').get('src')
+            image_url = first(self.search_image_xpath(fiction_div), '')
             # 小说标题
-            title = fiction_div.find('h3', {
-                'class': 'result-item-title'
-            }).get_text().strip()
+            title = element_text(first(self.search_title_xpath(fiction_div)), strip=True)
             # 小说简介
-            desc = fiction_div.find('p', {
-                'class': 'result-game-item-desc'
-            }).get_text().strip()
-            info_tags = fiction_div.find('div', {
-                'class': 'result-game-item-info'
-            }).find_all('p', {'class': 'result-game-item-info-tag'})
+            desc = element_text(first(self.search_desc_xpath(fiction_div)), strip=True)
+            info_tags = self.search_info_tags_xpath(fiction_div)
             # 作者
-            author = info_tags[0].find_all('span')[1].get_text().strip()
+            author = element_text(self.span_xpath(info_tags[0])[1], strip=True)
             # 类型
-            fiction_kind = info_tags[1].find_all('span')[1].get_text().strip()
+            fiction_kind = element_text(self.span_xpath(info_tags[1])[1], strip=True)
             # 更新时间
-            update_date = info_tags[2].find_all('span')[1].get_text().strip()
+            update_date = element_text(self.span_xpath(info_tags[2])[1], strip=True)
             # 最新章节
-            latest_chapter = info_tags[3].find('a').get_text().strip()
+            latest_chapter = element_text(first(self.link_xpath(info_tags[3])), strip=True)
             # 小说地址
-            origin_url = fiction_div.find('h3').find('a').get('href')
+            origin_url = first(self.search_url_xpath(fiction_div), '')
             origin_url = urljoin('https://{}'.format(self.domain), origin_url)
             # 来源站点上的编号
             origin_id = origin_url.strip('/').split('/')[-1]
@@ -170,25 +446,41 @@ class ZwdaSpider(BaseSpider):
             results.append(fiction_search_item)
         return results
 
-    def _get_chapters(self, fiction_url, fiction_name):
-        headers = {
-            'User-Agent':
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.97 Safari/537.36',
-            'Accept':
-            'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3',
-            'Referer': 'https://{}/search.php?keyword='.format(self.domain),
-        }
-        response = requests.get(fiction_url, headers=headers, timeout=20)
+    def _get_toc(self, fiction_url, fiction_name, etag='', last_modified=''):
+        response = self.fetch(fiction_url, referer='https://{}/search.php?keyword='.format(self.domain),
+                              headers=self.conditional_headers(etag, last_modified))
+        result = TocResult(etag=response.headers.get('ETag', ''),
+                           last_modified=response.headers.get('Last-Modified', ''))
+        if response.status_code == 304:
+            # 304响应可能不带校验信息，沿用上次的
+            result.not_modified = True
+            result.etag = result.etag or etag
+            result.last_modified = result.last_modified or last_modified
+            return result
+        response.raise_for_status()
+        result.chapters = self._parse_chapters(fiction_url, response.content)
+        return result
 
-        chapters = []
+    def _parse_chapters(self, fiction_url, content: bytes):
+        """
+        从小说主页中解析章节列表
+
+        Args:
+            fiction_url: 小说主页地址
+            content: 小说主页字节序列
 
-        bsobj = BeautifulSoup(response.content, 'lxml')
-        a_tags = bsobj.find('div', {'id': 'list'}).find_all('a')
-        for index, a_tag in enumerate(a_tags):
+        Returns:
+            typing.List[SimpleChapter]
+        """
+        chapters = []
+        root = parse_html(content)
+        if root is None:
+            return chapters
+        for index, a_tag in enumerate(self.chapter_links_xpath(root)):
             chapter_url = a_tag.get('href')
             chapter_url = urljoin(fiction_url, chapter_url)
             origin_id = int(chapter_url.strip('/').split('/')[-1])
-            chapter_name = a_tag.get_text().strip()
+            chapter_name = element_text(a_tag, strip=True)
             simple_chapter = SimpleChapter(origin_id=origin_id,
                                            chapter_name=chapter_name,
                                            chapter_url=chapter_url,
@@ -196,21 +488,12 @@ class ZwdaSpider(BaseSpider):
             chapters.append(simple_chapter)
         return chapters
 
-    def _download_chapter(self, middle_chapter: MiddleChapter):
-        headers = {
-            'User-Agent':
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.97 Safari/537.36',
-            'Accept':
-            'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3',
-            'Referer': middle_chapter.fiction_url,
-        }
-        response = requests.get(middle_chapter.chapter_url,
-                                headers=headers,
-                                timeout=20)
-        html = self.replace_br(response.content, encoding='gbk')
-        bsobj = BeautifulSoup(html, 'lxml')
-        content = bsobj.find('div', {'id': 'content'}).get_text()
-        middle_chapter.chapter_content = content
+    def _parse_chapter(self, middle_chapter: MiddleChapter, content: bytes):
+        root = parse_html(content, encoding='gbk')
+        content_div = first(self.chapter_content_xpath(root)) if root is not None else None
+        if content_div is None:
+            raise Exception('章节 {} 页面中找不到正文！'.format(middle_chapter.chapter_name))
+        middle_chapter.chapter_content = element_text(content_div)
         return middle_chapter
 
 
@@ -226,6 +509,8 @@ class SpiderManager:
             self.spiders = self.spider_configs_to_spiders(spider_configs)
         # 数据库连接，默认不创建，按需创建
         self.session = None
+        # 章节写缓冲区，开始监听队列时创建
+        self.write_buffer: typing.Optional[ChapterWriteBuffer] = None
 
     @classmethod
     def spider_configs_to_spiders(cls,
@@ -276,12 +561,102 @@ class SpiderManager:
         Returns:
             typing.List[FictionSearchItem]
         """
-        fiction_search_items = []
-        for site, spider in self.spiders.items():
-            fiction_search_items.extend(
-                spider.search_fictions_by_name(fiction_name))
+        fiction_search_items, _ = self.search_fictions_concurrently(fiction_name)
         return fiction_search_items
 
+    @classmethod
+    def normalize_fiction_name(cls, fiction_name: str):
+        """
+        规范化小说名称，统一全半角、大小写和空白字符，用作检索缓存的键
+        """
+        fiction_name = unicodedata.normalize('NFKC', fiction_name or '')
+        return ' '.join(fiction_name.lower().split())
+
+    @classmethod
+    def _search_site(cls, spider: BaseSpider, fiction_name: str, expires_at: float = None):
+        """
+        在单个网站上检索小说，并记录检索状态和耗时。检索结果会被缓存，相同的并发检索只请求一次网站。
+        传入expires_at时，检索中的请求在这个时间点之前结束，超时的检索不会继续占用线程池
+        """
+        start_time = time.time()
+        request_deadline.expires_at = expires_at
+        try:
+            return cls._search_site_before_deadline(spider, fiction_name, start_time)
+        finally:
+            request_deadline.expires_at = None
+
+    @classmethod
+    def _search_site_before_deadline(cls, spider: BaseSpider, fiction_name: str, start_time: float):
+        cache_key = '{}:{}'.format(spider.site, cls.normalize_fiction_name(fiction_name))
+
+        def load():
+            # 网站熔断中时跳过，只在真正请求网站时检查和记录
+            if circuit_breaker and not circuit_breaker.allow(spider.site):
+                raise SiteCircuitOpen(spider.site)
+            load_start_time = time.time()
+            try:
+                results = unstructure(spider.search_fictions_by_name(fiction_name))
+            except RequestDeadlineExceeded:
+                # 没有发起请求，不计入网站的失败次数
+                raise
+            except Exception:
+                if circuit_breaker:
+                    circuit_breaker.record(spider.site, False, time.time() - load_start_time)
+                raise
+            if circuit_breaker:
+                circuit_breaker.record(spider.site, True, time.time() - load_start_time)
+            return results
+
+        try:
+            items = search_cache.get_or_load(cache_key, load)
+            fiction_search_items = structure(items, typing.List[FictionSearchItem])
+            status = 'ok'
+        except SiteCircuitOpen:
+            fiction_search_items = []
+            status = 'open'
+        except RequestDeadlineExceeded:
+            fiction_search_items = []
+            status = 'timeout'
+        except Exception as e:
+            logger.error('{} 检索失败：{}'.format(spider.site, e))
+            fiction_search_items = []
+            # 截止时间截短了请求的超时时间，这时的失败按超时统计
+            status = 'timeout' if request_deadline_passed(None) else 'error'
+        site_status = SiteSearchStatus(site=spider.site, status=status, elapsed=round(time.time() - start_time, 3),
+                                       total=len(fiction_search_items))
+        return fiction_search_items, site_status
+
+    def search_fictions_concurrently(self, fiction_name: str, deadline: float = None):
+        """
+        并发地在全部网站上检索小说，超过deadline秒仍未返回的网站会被跳过，只返回已完成网站的结果
+
+        Args:
+            fiction_name: 小说名称
+            deadline: 最长等待时间，单位秒，默认使用Config.SEARCH_DEADLINE
+
+        Returns:
+            typing.Tuple[typing.List[FictionSearchItem], typing.List[SiteSearchStatus]]
+        """
+        if deadline is None:
+            deadline = Config.SEARCH_DEADLINE
+        # 每个请求的超时时间不超过剩余时间，超时的检索很快就会结束，不会堆积在线程池中
+        expires_at = time.time() + deadline
+        futures = {search_executor.submit(self._search_site, spider, fiction_name, expires_at): site
+                   for site, spider in self.spiders.items()}
+        done, _ = wait(futures, timeout=deadline)
+        fiction_search_items = []
+        site_statuses = []
+        for future, site in futures.items():
+            if future in done:
+                site_items, site_status = future.result()
+                fiction_search_items.extend(site_items)
+            else:
+                # 未完成的检索不再等待，还没开始的直接取消，正在进行的请求到截止时间后结束，结果直接丢弃
+                future.cancel()
+                site_status = SiteSearchStatus(site=site, status='timeout', elapsed=deadline)
+            site_statuses.append(site_status)
+        return fiction_search_items, site_statuses
+
     def get_chapters(self, fiction_url: str, fiction_name, site: str):
         """
         根据给定的小说主页地址和网站名称，抓取小说的章节列表
@@ -294,38 +669,238 @@ class SpiderManager:
             typing.List[SimpleChapter]
         """
         spider: BaseSpider = self.spiders.get(site)
-        if spider:
-            return spider.get_chapters(fiction_url, fiction_name)
+        if not spider:
+            return []
+        if circuit_breaker and not circuit_breaker.allow(site):
+            raise SiteCircuitOpen(site)
+        start_time = time.time()
+        chapters = spider.get_chapters(fiction_url, fiction_name)
+        # get_chapters在重试失败后返回空列表
+        if circuit_breaker:
+            circuit_breaker.record(site, bool(chapters), time.time() - start_time)
+        return chapters
+
+    def get_toc(self, fiction_url: str, fiction_name, site: str, etag: str = '', last_modified: str = '',
+                toc_hash: str = ''):
+        """
+        根据给定的小说主页地址和网站名称，带条件地请求小说章节目录
+
+        Args:
+            fiction_url: 小说主页地址
+            fiction_name: 小说名称
+            site: 网站名称
+            etag: 上次响应的ETag
+            last_modified: 上次响应的Last-Modified
+            toc_hash: 上次章节列表的摘要
+
+        Returns:
+            TocResult
+        """
+        spider: BaseSpider = self.spiders.get(site)
+        if not spider:
+            raise Exception('找不到网站{}对应的爬虫！'.format(site))
+        if circuit_breaker and not circuit_breaker.allow(site):
+            raise SiteCircuitOpen(site)
+        start_time = time.time()
+        try:
+            result = spider.get_toc(fiction_url, fiction_name, etag, last_modified, toc_hash)
+        except Exception:
+            if circuit_breaker:
+                circuit_breaker.record(site, False, time.time() - start_time)
+            raise
+        if circuit_breaker:
+            circuit_breaker.record(site, result.not_modified or bool(result.chapters), time.time() - start_time)
+        return result
+
+    @classmethod
+    def make_publish_callback(cls, job_id, fiction_id):
+        """
+        创建发布章节消息的回调函数，在后台发布线程中更新任务状态。
+        发布失败时清空小说的目录校验信息和排队中的章节登记，下次更新时重新比对全部章节，避免漏掉这批章节
+
+        Args:
+            job_id: 任务编号
+            fiction_id: 小说编号
+        """
+        app = current_app._get_current_object()
+
+        def callback(finished_number, finished, error):
+            if error:
+                status, msg = 'failed', str(error)[:255]
+            else:
+                status, msg = ('done' if finished else 'running'), ''
+            try:
+                with app.app_context():
+                    TaskJobs.update_job(job_id, status=status, finished=finished_number, msg=msg)
+                    if error:
+                        Fictions.release_unpublished(fiction_id)
+                        db.session.commit()
+            except Exception as e:
+                logger.error(e)
+
+        return callback
+
+    def refresh_fiction(self, fiction: Fictions, full=False):
+        """
+        带条件地请求小说的章节目录，更新小说的目录信息，并找出需要采集的章节。
+        章节目录没有变化时不查询已缓存的章节；有变化时只比对连续已缓存的最后一个章节之后的部分，
+        找不到这个章节时（比如网站重排了目录）比对全部章节。
+        还有章节没有缓存时（比如下载失败的章节），不带条件地请求目录，目录没有变化也重新推送这些章节
+
+        Args:
+            fiction: 小说
+            full: 为True时忽略目录缓存校验信息，重新比对全部章节
+
+        Returns:
+            typing.Tuple[TocResult, typing.List[MiddleChapter]]，目录请求结果和需要采集的章节
+        """
+        if full or fiction.cached_chapters_count < fiction.fiction_chapters_total:
+            toc: TocResult = self.get_toc(fiction.fiction_url, fiction.fiction_name, fiction.site)
         else:
+            toc: TocResult = self.get_toc(fiction.fiction_url, fiction.fiction_name, fiction.site,
+                                          fiction.toc_etag, fiction.toc_last_modified, fiction.toc_hash)
+        return toc, self.apply_toc(fiction, toc, full)
+
+    @classmethod
+    def apply_toc(cls, fiction: Fictions, toc: TocResult, full=False):
+        """
+        根据章节目录请求结果更新小说信息，并返回需要采集的章节
+
+        Args:
+            fiction: 小说
+            toc: 章节目录请求结果
+            full: 是否比对全部章节
+
+        Returns:
+            typing.List[MiddleChapter]
+        """
+        fiction.toc_etag = toc.etag
+        fiction.toc_last_modified = toc.last_modified
+        if toc.not_modified:
+            db.session.commit()
             return []
+        simple_chapters: typing.List[SimpleChapter] = toc.chapters
+        tail_chapters = simple_chapters
+        if not full and fiction.toc_last_origin_id:
+            for index, chapter in enumerate(simple_chapters):
+                if chapter.origin_id == fiction.toc_last_origin_id:
+                    tail_chapters = simple_chapters[index + 1:]
+                    break
+        if tail_chapters is simple_chapters:
+            chapter_origin_ids = {item[0] for item in fiction.cached_chapter_origin_ids}
+        else:
+            chapter_origin_ids = fiction.cached_chapter_origin_ids_in([chapter.origin_id for chapter in tail_chapters])
+        # 只有目录中出现了新章节才更新小说的更新时间，否则书架排序和分页游标会在每次定时检查后打乱
+        if len(simple_chapters) > (fiction.fiction_chapters_total or 0):
+            fiction.update_time = datetime.now()
+        # 更新完整章节数和目录校验信息
+        fiction.fiction_chapters_total = len(simple_chapters)
+        fiction.toc_hash = toc.toc_hash
+        # 比对水位只推进到连续已缓存的最后一个章节，这次推送的和之前下载失败的章节下次更新时还会比对
+        last_origin_id = 0 if tail_chapters is simple_chapters else fiction.toc_last_origin_id
+        for chapter in tail_chapters:
+            if chapter.origin_id not in chapter_origin_ids:
+                break
+            last_origin_id = chapter.origin_id
+        fiction.toc_last_origin_id = last_origin_id
+        uncached_chapters = []
+        for chapter in tail_chapters:
+            if chapter.origin_id in chapter_origin_ids:
+                continue
+            uncached_chapters.append(MiddleChapter(origin_id=chapter.origin_id, chapter_name=chapter.chapter_name,
+                                                   chapter_url=chapter.chapter_url,
+                                                   chapter_order=chapter.chapter_order, fiction_id=fiction.fid,
+                                                   chapter_content='', site=fiction.site,
+                                                   fiction_url=fiction.fiction_url))
+        if uncached_chapters:
+            fiction.last_new_chapter_time = datetime.now()
+        # 过滤掉已经在采集队列中的章节
+        uncached_chapters = ChapterJobs.register(fiction.fid, uncached_chapters, Config.CHAPTER_JOB_TTL)
+        db.session.commit()
+        return uncached_chapters
 
-    @retry(stop = stop_after_attempt(3), wait = wait_fixed(2), retry_error_callback = retry_exception_log_callback)
     def _crawl_chapter_content(self, channel, method_frame, header_frame, body):
         # 抓取章节内容
         data = json.loads(body)
         middle_chapter = structure(data, MiddleChapter)
         spider = self.spiders.get(middle_chapter.site)
-        chapter: MiddleChapter = spider.download_chapter(middle_chapter)
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-        # 写入数据库
-        if chapter:
-            fiction_chapter = FictionChapters(
-                fiction_id=chapter.fiction_id,
-                chapter_name=chapter.chapter_name,
-                chapter_content=chapter.chapter_content,
-                chapter_order=chapter.chapter_order,
-                origin_url=chapter.chapter_url,
-                origin_id=chapter.origin_id)
-            try:
-                self.session.add(fiction_chapter)
-                self.session.commit()
-            except Exception as e:
-                self.session.rollback()
-                raise e
-            logger.info('已缓存章节 {}!'.format(chapter.chapter_name))
-        
+        self.write_buffer.mark_started(middle_chapter)
+        if circuit_breaker and not circuit_breaker.allow(middle_chapter.site):
+            # 网站熔断中，放入暂存队列等网站恢复后再处理，不消耗重试次数
+            rabbitmq.send_parked_msg(channel, body, circuit_breaker.retry_after(middle_chapter.site),
+                                     rabbitmq.get_retry_count(header_frame))
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            return
+        start_time = time.time()
+        try:
+            chapter: MiddleChapter = spider.download_chapter(middle_chapter)
+        except Exception:
+            if circuit_breaker:
+                circuit_breaker.record(middle_chapter.site, False, time.time() - start_time)
+            raise
+        if circuit_breaker:
+            circuit_breaker.record(middle_chapter.site, True, time.time() - start_time)
+        # 先放入写缓冲区，批量写入数据库之后再确认消息
+        self.write_buffer.add(chapter, method_frame.delivery_tag)
+
+    def _mark_failed(self, body):
+        """
+        记录放入死信队列的章节，计入小说的失败章节数
+        """
+        try:
+            self.write_buffer.mark_failed(structure(json.loads(body), MiddleChapter))
+        except Exception as e:
+            logger.error(e)
+
     def crawl_chapter_content(self, channel, method_frame, header_frame, body):
-        self._crawl_chapter_content(channel, method_frame, header_frame, body)
+        try:
+            self._crawl_chapter_content(channel, method_frame, header_frame, body)
+        except Exception as e:
+            logger.error(e)
+            # 放入延迟重试队列后立即确认，继续处理下一条消息
+            retry_count = rabbitmq.get_retry_count(header_frame)
+            if rabbitmq.send_retry_msg(channel, body, retry_count):
+                metrics.chapter_retries.inc()
+            else:
+                logger.error('重试{}次仍然失败，已放入死信队列：{}'.format(retry_count, body))
+                metrics.chapter_failures.inc()
+                self._mark_failed(body)
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        # 未确认的消息都在写缓冲区中
+        metrics.messages_in_flight.set(value=len(self.write_buffer))
+
+    @classmethod
+    def rejected_message_body(cls, chapter: MiddleChapter):
+        """
+        被拒绝写入的章节放入死信队列的消息内容，和采集消息一样不包含章节内容
+        """
+        data = unstructure(chapter)
+        data['chapter_content'] = ''
+        return json.dumps(data)
+
+    def flush_write_buffer(self, channel, force=False):
+        """
+        缓冲区满了或等待超时后，将章节批量写入数据库，并一次性确认这批章节对应的全部消息
+
+        Args:
+            channel: 信道
+            force: 是否忽略缓冲区状态，强制写入
+        """
+        if not force and not self.write_buffer.due():
+            return
+        try:
+            delivery_tags = self.write_buffer.flush()
+        except Exception as e:
+            # 写入失败的章节留在缓冲区中，稍后重试
+            logger.error(e)
+            return
+        for chapter, _ in self.write_buffer.take_rejected():
+            # 无法写入数据库的章节重试也不会成功，直接放入死信队列，消息和已写入的章节一起确认
+            rabbitmq.send_retry_msg(channel, self.rejected_message_body(chapter), Config.RETRY_MAX_ATTEMPTS)
+            metrics.chapter_failures.inc()
+        if delivery_tags:
+            channel.basic_ack(delivery_tag=max(delivery_tags), multiple=True)
+            metrics.messages_in_flight.set(value=len(self.write_buffer))
 
     def listen_and_crawl_chapter_contents(self, session):
         """
@@ -335,13 +910,20 @@ class SpiderManager:
             session: 数据库会话
         """
         connection, channel = rabbitmq.create_rabbitmq_connection()
-        channel.basic_consume('standard', self.crawl_chapter_content)
+        # 预取数量不小于缓冲区大小，才能攒满一批
+        channel.basic_qos(prefetch_count=Config.CHAPTER_FLUSH_SIZE)
         self.session = session
+        self.write_buffer = ChapterWriteBuffer(session)
         while True:
             try:
-                channel.start_consuming()
+                # 队列空闲时每秒返回一次(None, None, None)，用于按时间写入缓冲区
+                for method_frame, header_frame, body in channel.consume(Config.RABBITMQ_QUEUE, inactivity_timeout=1):
+                    if method_frame is not None:
+                        self.crawl_chapter_content(channel, method_frame, header_frame, body)
+                    self.flush_write_buffer(channel)
             except KeyboardInterrupt:
-                channel.stop_consuming()
+                self.flush_write_buffer(channel, force=True)
+                channel.cancel()
                 break
             except Exception as e:
                 logger.error(e)
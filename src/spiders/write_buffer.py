@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# @File    : write_buffer.py
+# @Author  : AaronJny
+# @Time    : 2020/03/17
+# @Desc    : 章节批量写入缓冲区
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+import time
+import typing
+from loguru import logger
+from sqlalchemy import tuple_
+from sqlalchemy.exc import OperationalError
+from config import Config
+from models import MiddleChapter, FictionChapters, Fictions, ChapterJobs
+from utils import metrics
+from utils.segment_store import store as segment_store
+
+
+class ChapterWriteBuffer:
+    """
+    章节写缓冲区。
+    下载好的章节先放入缓冲区，数量达到max_size或等待超过max_delay秒后一次性批量写入数据库，
+    写入成功后返回这批章节对应的消息标识，由调用方统一确认
+    """
+
+    def __init__(self, session, max_size: int = None, max_delay: float = None, max_attempts: int = None):
+        self.session = session
+        self.max_size = max_size or Config.CHAPTER_FLUSH_SIZE
+        self.max_delay = max_delay or Config.CHAPTER_FLUSH_INTERVAL
+        self.max_attempts = max_attempts or Config.CHAPTER_FLUSH_MAX_ATTEMPTS
+        # 连续写入失败的次数
+        self._failed_attempts = 0
+        # 无法写入数据库的章节和对应的消息标识，由调用方放入死信队列
+        self.rejected: typing.List[typing.Tuple[MiddleChapter, typing.Any]] = []
+        self._chapters: typing.List[MiddleChapter] = []
+        self._tokens = []
+        self._first_add_time = 0
+        # 已开始下载的章节，随下一次写入一起标记为下载中
+        self._started: typing.List[typing.Tuple[int, int]] = []
+        # 重试次数用完的章节，随下一次写入一起标记为失败
+        self._failed: typing.List[typing.Tuple[int, int]] = []
+
+    def __len__(self):
+        return len(self._chapters)
+
+    def add(self, chapter: MiddleChapter, token):
+        """
+        放入一个已下载的章节
+
+        Args:
+            chapter: 已下载内容的章节
+            token: 章节对应的消息标识，写入成功后原样返回
+        """
+        if not self._chapters and not self._started and not self._failed:
+            self._first_add_time = time.time()
+        self._chapters.append(chapter)
+        self._tokens.append(token)
+
+    def mark_started(self, chapter: MiddleChapter):
+        """
+        记录一个开始下载的章节，不单独访问数据库，在下一次写入时批量更新章节状态
+
+        Args:
+            chapter: 开始下载的章节
+        """
+        if not self._chapters and not self._started and not self._failed:
+            self._first_add_time = time.time()
+        self._started.append((chapter.fiction_id, chapter.origin_id))
+
+    def mark_failed(self, chapter: MiddleChapter):
+        """
+        记录一个重试次数用完、放入死信队列的章节，在下一次写入时批量更新章节状态
+
+        Args:
+            chapter: 下载失败的章节
+        """
+        if not self._chapters and not self._started and not self._failed:
+            self._first_add_time = time.time()
+        self._failed.append((chapter.fiction_id, chapter.origin_id))
+
+    def _update_chapter_jobs(self, written_keys):
+        if self._started:
+            # 下载中的章节延长有效期，避免下载和重试过程中被当作丢失的章节重新推送
+            self.session.execute(ChapterJobs.__table__.update().where(
+                tuple_(ChapterJobs.fiction_id, ChapterJobs.origin_id).in_(self._started)).values(
+                status='running', expire_at=datetime.now() + timedelta(seconds=Config.CHAPTER_JOB_TTL)))
+        if self._failed:
+            # 失败的章节立即过期，下次更新时可以重新推送，在此之前计入失败章节数
+            self.session.execute(ChapterJobs.__table__.update().where(
+                tuple_(ChapterJobs.fiction_id, ChapterJobs.origin_id).in_(self._failed)).values(
+                status='failed', expire_at=datetime.now()))
+        if written_keys:
+            self.session.execute(ChapterJobs.__table__.delete().where(
+                tuple_(ChapterJobs.fiction_id, ChapterJobs.origin_id).in_(written_keys)))
+
+    def _append_segments(self, fiction_id, rows):
+        """
+        把一本小说的章节内容追加到段文件，数据库中只保存位置。
+        已经写入过的章节不再追加，避免重复投递的消息在段文件中留下无效内容
+
+        Returns:
+            需要插入数据库的章节行
+        """
+        existing = {row[0] for row in self.session.query(FictionChapters.origin_id).filter(
+            FictionChapters.fiction_id == fiction_id,
+            FictionChapters.origin_id.in_([row['origin_id'] for row in rows]))}
+        new_rows = {}
+        for row in rows:
+            if row['origin_id'] not in existing:
+                new_rows.setdefault(row['origin_id'], row)
+        rows = list(new_rows.values())
+        if not rows:
+            return rows
+        generation, locations = segment_store.append(fiction_id, [FictionChapters.content_bytes(row) for row in rows])
+        for row, (offset, length, content_hash) in zip(rows, locations):
+            row.update(chapter_content='', content_blob=None, segment_id=generation, segment_offset=offset,
+                       segment_length=length, content_hash=content_hash)
+        return rows
+
+    def due(self):
+        """
+        缓冲区是否需要写入数据库了
+        """
+        if not self._chapters and not self._started and not self._failed:
+            return False
+        return len(self._chapters) >= self.max_size or time.time() - self._first_add_time >= self.max_delay
+
+    def _write(self, chapters: typing.List[MiddleChapter]):
+        """
+        在一个事务中写入章节，并更新章节的采集登记。写入失败时回滚并抛出异常
+        """
+        start_time = time.time()
+        # 按小说分组写入，根据每组实际写入的行数累加已缓存章节数，重复投递的章节不计数
+        fiction_rows = defaultdict(list)
+        use_segments = Config.CHAPTER_STORAGE == 'segments'
+        # 写入段文件时，持有这批小说的段文件锁直到事务提交，按小说编号顺序加锁避免死锁
+        with ExitStack() as stack:
+            try:
+                for chapter in chapters:
+                    row = {
+                        'fiction_id': chapter.fiction_id,
+                        'chapter_name': chapter.chapter_name,
+                        'chapter_order': chapter.chapter_order,
+                        'origin_url': chapter.chapter_url,
+                        'origin_id': chapter.origin_id
+                    }
+                    # 按配置压缩章节内容
+                    row.update(FictionChapters.encode_content(self.session, chapter.site, chapter.chapter_content))
+                    fiction_rows[chapter.fiction_id].append(row)
+                for fiction_id, rows in sorted(fiction_rows.items()):
+                    if use_segments:
+                        stack.enter_context(segment_store.lock(fiction_id))
+                        rows = self._append_segments(fiction_id, rows)
+                    inserted = FictionChapters.insert_ignore(self.session, rows)
+                    if inserted:
+                        self.session.execute(Fictions.__table__.update().where(Fictions.fid == fiction_id).values(
+                            cached_chapters_count=Fictions.cached_chapters_count + inserted))
+                # 已写入的章节不再需要登记
+                self._update_chapter_jobs([(chapter.fiction_id, chapter.origin_id) for chapter in chapters])
+                self.session.commit()
+            except Exception as e:
+                self.session.rollback()
+                raise e
+        self._started = []
+        self._failed = []
+        metrics.flush_seconds.observe(value=time.time() - start_time)
+        for chapter in chapters:
+            metrics.chapters_written.inc(chapter.site)
+        metrics.chapters_per_second.mark(len(chapters))
+        if chapters:
+            logger.info('已缓存章节 {}!'.format('、'.join(chapter.chapter_name for chapter in chapters)))
+
+    def _write_one_by_one(self):
+        """
+        批量写入多次失败后，逐个写入缓冲区中的章节，找出无法写入的章节放入rejected，其余章节正常写入。
+        数据库连接出错时不再继续，剩下的章节留在缓冲区中稍后重试，一个章节都没有处理时抛出异常
+
+        Returns:
+            已写入和被拒绝的章节对应的消息标识列表
+        """
+        self._write([])
+        tokens = []
+        chapters = list(zip(self._chapters, self._tokens))
+        for index, (chapter, token) in enumerate(chapters):
+            try:
+                self._write([chapter])
+            except OperationalError as e:
+                self._chapters = [item[0] for item in chapters[index:]]
+                self._tokens = [item[1] for item in chapters[index:]]
+                if not tokens:
+                    raise e
+                logger.error(e)
+                return tokens
+            except Exception as e:
+                logger.error('章节 {} 无法写入数据库，放入死信队列：{}'.format(chapter.chapter_name, e))
+                self.rejected.append((chapter, token))
+                # 随下一次写入一起标记为失败
+                self.mark_failed(chapter)
+            tokens.append(token)
+        self._chapters = []
+        self._tokens = []
+        return tokens
+
+    def flush(self):
+        """
+        将缓冲区中的章节批量写入数据库。写入失败时保留缓冲区中的章节，并抛出异常。
+        连续失败max_attempts次后逐个写入，无法写入的章节放入rejected，由调用方放入死信队列并确认消息，
+        避免一个坏章节让整批章节一直重试，挡住之后的全部消息
+
+        Returns:
+            已写入和被拒绝的章节对应的消息标识列表
+        """
+        if not self._chapters and not self._started and not self._failed:
+            return []
+        try:
+            self._write(self._chapters)
+        except Exception as e:
+            self._failed_attempts += 1
+            if self._failed_attempts < self.max_attempts:
+                raise e
+            logger.error('批量写入连续失败{}次，逐个写入章节：{}'.format(self._failed_attempts, e))
+            self._failed_attempts = 0
+            return self._write_one_by_one()
+        self._failed_attempts = 0
+        tokens = self._tokens
+        self._chapters = []
+        self._tokens = []
+        return tokens
+
+    def take_rejected(self):
+        """
+        取出被拒绝写入的章节
+
+        Returns:
+            typing.List[typing.Tuple[MiddleChapter, typing.Any]]，章节和对应的消息标识
+        """
+        rejected = self.rejected
+        self.rejected = []
+        return rejected
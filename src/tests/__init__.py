@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+# @File    : __init__.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 测试使用临时的sqlite数据库和缓存文件夹，在src目录下执行 python -m unittest discover tests
+import os
+import tempfile
+from config import Config
+
+TEST_ROOT = tempfile.mkdtemp(prefix='web_fiction_test_')
+Config.SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(os.path.join(TEST_ROOT, 'test.db'))
+Config.CACHE_PATH = TEST_ROOT
+Config.TEMPORARY_FILE_PATH = os.path.join(TEST_ROOT, 'tmp')
+Config.EXPORT_CACHE_PATH = os.path.join(TEST_ROOT, 'exports')
+Config.SEGMENT_PATH = os.path.join(TEST_ROOT, 'segments')
+Config.EPUB_FRAGMENT_DB_PATH = os.path.join(TEST_ROOT, 'epub_fragments.db')
+Config.RATE_LIMIT_DB_PATH = os.path.join(TEST_ROOT, 'rate_limit.db')
+Config.BREAKER_DB_PATH = os.path.join(TEST_ROOT, 'circuit_breaker.db')
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# @File    : test_apply_toc.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 根据章节目录找出需要采集的章节的测试
+from datetime import datetime, timedelta
+import unittest
+import tests
+from app import app
+from models import db, Fictions, FictionChapters, ChapterJobs, SimpleChapter, TocResult
+from spiders.spider import SpiderManager
+
+
+def make_toc(number, toc_hash):
+    chapters = [SimpleChapter(origin_id=order + 1, chapter_name='第{}章'.format(order + 1),
+                              chapter_url='http://test/{}.html'.format(order + 1), chapter_order=order)
+                for order in range(number)]
+    return TocResult(chapters=chapters, toc_hash=toc_hash)
+
+
+class ApplyTocTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        self.fiction = Fictions(site='测试', origin_id='1', fiction_name='测试小说')
+        db.session.add(self.fiction)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def cache(self, origin_ids):
+        FictionChapters.insert_ignore(db.session, [
+            {'fiction_id': self.fiction.fid, 'origin_id': origin_id, 'chapter_order': origin_id - 1,
+             'chapter_name': '第{}章'.format(origin_id), 'chapter_content': '正文'} for origin_id in origin_ids])
+        ChapterJobs.query.filter(ChapterJobs.origin_id.in_(origin_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    def fail(self, origin_ids):
+        ChapterJobs.query.filter(ChapterJobs.origin_id.in_(origin_ids)).update(
+            {'status': 'failed', 'expire_at': db.func.now()}, synchronize_session=False)
+        db.session.commit()
+
+    def test_failed_chapter_is_compared_again_after_toc_grows(self):
+        chapters = SpiderManager.apply_toc(self.fiction, make_toc(5, 'a'))
+        self.assertEqual([chapter.origin_id for chapter in chapters], [1, 2, 3, 4, 5])
+        # 第3章下载失败，其余章节已缓存
+        self.cache([1, 2, 4, 5])
+        self.fail([3])
+        self.assertEqual(self.fiction.toc_last_origin_id, 0)
+        chapters = SpiderManager.apply_toc(self.fiction, make_toc(6, 'b'))
+        self.assertEqual([chapter.origin_id for chapter in chapters], [3, 6])
+        # 水位停在第一个没有缓存的章节之前
+        self.assertEqual(self.fiction.toc_last_origin_id, 2)
+        self.cache([3, 6])
+        chapters = SpiderManager.apply_toc(self.fiction, make_toc(7, 'c'))
+        self.assertEqual([chapter.origin_id for chapter in chapters], [7])
+        self.assertEqual(self.fiction.toc_last_origin_id, 6)
+
+    def test_update_time_changes_only_when_new_chapters_found(self):
+        SpiderManager.apply_toc(self.fiction, make_toc(2, 'a'))
+        self.cache([1, 2])
+        update_time = datetime.now() - timedelta(days=1)
+        self.fiction.update_time = update_time
+        db.session.commit()
+        # 目录没有变化和目录中章节没有增加时都不更新
+        SpiderManager.apply_toc(self.fiction, TocResult(chapters=[], toc_hash='a', not_modified=True))
+        self.assertEqual(self.fiction.update_time, update_time)
+        SpiderManager.apply_toc(self.fiction, make_toc(2, 'b'))
+        self.assertEqual(self.fiction.update_time, update_time)
+        SpiderManager.apply_toc(self.fiction, make_toc(3, 'c'))
+        self.assertGreater(self.fiction.update_time, update_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
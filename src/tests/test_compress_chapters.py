@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# @File    : test_compress_chapters.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 压缩已有章节脚本的测试
+import unittest
+import tests
+from app import app
+from compress_chapters import compress_site, sample_chapter_contents
+from models import db, Fictions, FictionChapters, ChapterDictionaries
+from utils import compression
+
+
+def chapter_content(order):
+    return '第{}章的正文。\n'.format(order) + '这是第一段正文，这是第二段正文。\n' * 20
+
+
+class CompressChaptersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        ChapterDictionaries._data_cache.clear()
+        ChapterDictionaries._latest_cache.clear()
+        self.codec = compression.default_codec()
+        db.session.add(ChapterDictionaries(site='测试', codec=self.codec,
+                                           data='这是第一段正文，这是第二段正文。\n'.encode('utf8') * 64))
+        fiction = Fictions(site='测试', origin_id='1', fiction_name='测试小说')
+        db.session.add(fiction)
+        db.session.commit()
+        self.fiction_id = fiction.fid
+        # 前5章迁移到段文件，其中前3章压缩保存，后3章以原文保存在数据库中
+        rows = []
+        for order in range(5):
+            row = {'fiction_id': fiction.fid, 'chapter_name': '第{}章'.format(order), 'chapter_order': order,
+                   'origin_id': order, 'chapter_content': chapter_content(order), 'content_codec': '',
+                   'content_dict_id': 0, 'content_blob': None}
+            if order < 3:
+                row.update(FictionChapters.encode_content(db.session, '测试', chapter_content(order)))
+            rows.append(row)
+        FictionChapters.insert_ignore(db.session, rows)
+        db.session.commit()
+        FictionChapters.compact_segments(fiction.fid)
+        FictionChapters.insert_ignore(db.session, [
+            {'fiction_id': fiction.fid, 'chapter_name': '第{}章'.format(order), 'chapter_order': order,
+             'origin_id': order, 'chapter_content': chapter_content(order)} for order in range(5, 8)])
+        # 训练了新字典，段文件中的压缩章节不再使用最新字典
+        db.session.add(ChapterDictionaries(site='测试', codec=self.codec,
+                                           data='这是第二段正文，这是第一段正文。\n'.encode('utf8') * 64))
+        db.session.commit()
+        ChapterDictionaries._latest_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_segment_chapters_are_skipped(self):
+        for recompress in (False, True):
+            chapters, _, _ = compress_site('测试', self.codec, 2, recompress)
+            self.assertEqual(chapters, 0 if recompress else 3)
+        db.session.expire_all()
+        segment_rows = FictionChapters.query.with_entities(FictionChapters.content_codec).filter(
+            FictionChapters.segment_id > 0).all()
+        self.assertEqual(sorted(row[0] for row in segment_rows), ['', ''] + [self.codec] * 3)
+        fiction = Fictions.query.get(self.fiction_id)
+        self.assertEqual([content for _, content in fiction.iter_chapters()],
+                         [chapter_content(order) for order in range(8)])
+
+    def test_samples_read_segment_chapters(self):
+        samples = sample_chapter_contents('测试', 10)
+        self.assertEqual(sorted(samples), sorted(chapter_content(order).encode('utf8') for order in range(8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# @File    : test_export_cache.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 导出文件缓存的测试
+import os
+import tempfile
+import unittest
+import tests
+from config import Config
+from utils import export_cache
+from utils.export_cache import SizedFile
+
+
+class SizedFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'fiction.txt')
+        with open(self.path, 'wb') as f:
+            f.write(b'0123456789')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_stops_at_size_while_file_grows(self):
+        f = SizedFile(open(self.path, 'rb'), 10)
+        try:
+            self.assertEqual(f.read(4), b'0123')
+            # 并发的更新在末尾追加了新章节
+            with open(self.path, 'ab') as writer:
+                writer.write(b'abcdef')
+            self.assertEqual(f.read(), b'456789')
+            self.assertEqual(f.read(4), b'')
+            f.seek(-3, os.SEEK_END)
+            self.assertEqual(f.read(100), b'789')
+        finally:
+            f.close()
+
+
+class RemoveCachedFilesTestCase(unittest.TestCase):
+
+    def test_lock_file_is_removed(self):
+        lock_path = os.path.join(Config.EXPORT_CACHE_PATH, '1.lock')
+        with export_cache._fiction_lock(1):
+            self.assertTrue(os.path.exists(lock_path))
+        export_cache.remove_cached_files(1)
+        self.assertFalse(os.path.exists(lock_path))
+        # 删除后还能重新加锁
+        with export_cache._fiction_lock(1):
+            self.assertTrue(os.path.exists(lock_path))
+        export_cache.remove_cached_files(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# @File    : test_export_range.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 推送水位和导出范围的测试
+from datetime import datetime, timedelta
+import unittest
+import tests
+from app import app
+from models import db, Fictions, FictionChapters
+
+
+class ExportRangeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        fiction = Fictions(site='测试', origin_id='1', fiction_name='测试小说')
+        db.session.add(fiction)
+        db.session.commit()
+        self.fiction_id = fiction.fid
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def cache(self, orders, add_time=None):
+        FictionChapters.insert_ignore(db.session, [
+            {'fiction_id': self.fiction_id, 'origin_id': order + 1, 'chapter_order': order,
+             'chapter_name': '第{}章'.format(order + 1), 'chapter_content': '正文',
+             'add_time': add_time or datetime.now()} for order in orders])
+        db.session.commit()
+
+    def deliver(self, mode, start=None, end=None):
+        fiction = Fictions.query.get(self.fiction_id)
+        export_range = fiction.resolve_export_range(mode, start, end)
+        if export_range:
+            lower, _, _, delivered = export_range
+            Fictions.mark_delivered(self.fiction_id, lower, delivered)
+            db.session.commit()
+            db.session.expire_all()
+        return export_range
+
+    def watermark(self):
+        return Fictions.query.get(self.fiction_id).delivered_chapter_order
+
+    def test_delta_stops_before_uncached_chapter(self):
+        # 第3章还没有缓存，后面的章节已经缓存
+        self.cache([0, 1, 3, 4])
+        self.assertEqual(self.deliver('delta'), (0, 0, 1, 1))
+        self.assertEqual(self.watermark(), 1)
+        self.assertIsNone(self.deliver('delta'))
+        self.cache([2])
+        self.assertEqual(self.deliver('delta'), (2, 2, 4, 4))
+        self.assertEqual(self.watermark(), 4)
+
+    def test_full_and_range_advance_only_over_contiguous_chapters(self):
+        self.cache([0, 1, 3])
+        self.assertEqual(self.deliver('full'), (None, 0, 3, 1))
+        self.assertEqual(self.watermark(), 1)
+        self.assertEqual(self.deliver('range', 2, 3), (2, 3, 3, 1))
+        self.assertEqual(self.watermark(), 1)
+
+    def test_delta_skips_long_standing_gap(self):
+        # 第3章一直没有缓存上，之后的章节已经缓存了两天
+        self.cache([0, 1, 3, 4], datetime.now() - timedelta(days=2))
+        self.cache([6])
+        fiction = Fictions.query.get(self.fiction_id)
+        self.assertEqual(self.deliver('delta'), (0, 0, 4, 4))
+        self.assertEqual(fiction.missing_chapter_ranges(0, 4), [[2, 2]])
+        # 第6章刚刚缓存，第6章之前的缺口还在等待
+        self.assertIsNone(self.deliver('delta'))
+        fiction = Fictions.query.get(self.fiction_id)
+        self.assertEqual(fiction.waiting_chapter_order(), 5)
+        self.cache([5])
+        self.assertEqual(self.deliver('delta'), (5, 5, 6, 6))
+        self.assertIsNone(Fictions.query.get(self.fiction_id).waiting_chapter_order())
+
+    def test_download_advances_watermark_only_when_asked(self):
+        self.cache([0, 1])
+        url = '/api/v1/fictions/download/{}/?mode=delta'.format(self.fiction_id)
+        client = app.test_client()
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('第1章'.encode('utf8'), response.data)
+        db.session.expire_all()
+        self.assertEqual(self.watermark(), -1)
+        client.get(url + '&mark_delivered=1').get_data()
+        db.session.expire_all()
+        self.assertEqual(self.watermark(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# @File    : test_iter_chapters.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 流式导出章节的测试
+import unittest
+from sqlalchemy import event
+import tests
+from app import app
+from models import db, Fictions, FictionChapters, ChapterDictionaries
+from utils import compression
+
+BATCH_SIZE = 20
+CHAPTERS_NUMBER = BATCH_SIZE * 3 + 7
+
+
+class IterChaptersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        ChapterDictionaries._data_cache.clear()
+        ChapterDictionaries._latest_cache.clear()
+        codec = compression.default_codec()
+        db.session.add(ChapterDictionaries(site='测试', codec=codec, data='这是第一段正文，这是第二段正文。\n'.encode('utf8') * 64))
+        fiction = Fictions(site='测试', origin_id='1', fiction_name='测试小说')
+        db.session.add(fiction)
+        db.session.commit()
+        self.fiction_id = fiction.fid
+        rows = []
+        for order in range(CHAPTERS_NUMBER):
+            content = '第{}章的正文。\n'.format(order) + '这是第一段正文，这是第二段正文。\n' * 20
+            row = {'fiction_id': fiction.fid, 'chapter_name': '第{}章'.format(order), 'chapter_order': order,
+                   'origin_id': order}
+            row.update(FictionChapters.encode_content(db.session, '测试', content))
+            rows.append(row)
+        FictionChapters.insert_ignore(db.session, rows)
+        db.session.commit()
+        # 模拟刚启动的进程，字典还没有缓存
+        ChapterDictionaries._data_cache.clear()
+        ChapterDictionaries._latest_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def iter_recording(self):
+        """
+        读取全部章节，同时记录开始流式读取后在同一个连接上执行的其他语句
+        """
+        statements = []
+        stream_connection = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if stream_connection and conn.connection.connection is stream_connection[0]:
+                statements.append(statement)
+            elif 'ORDER BY fiction_chapters.chapter_order' in statement:
+                stream_connection.append(conn.connection.connection)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            fiction = Fictions.query.get(self.fiction_id)
+            chapters = list(fiction.iter_chapters(BATCH_SIZE))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return chapters, statements
+
+    def assert_all_chapters(self, chapters):
+        self.assertEqual(len(chapters), CHAPTERS_NUMBER)
+        for order, (chapter_name, chapter_content) in enumerate(chapters):
+            self.assertEqual(chapter_name, '第{}章'.format(order))
+            self.assertTrue(chapter_content.startswith('第{}章的正文。'.format(order)))
+
+    def test_compressed_chapters_do_not_interrupt_stream(self):
+        self.assertTrue(all(row[0] for row in FictionChapters.query.with_entities(FictionChapters.content_dict_id)))
+        chapters, statements = self.iter_recording()
+        self.assert_all_chapters(chapters)
+        # pymysql在流式读取中途执行其他查询时会丢弃剩余结果，流式读取期间不能有其他语句
+        self.assertEqual(statements, [])
+
+    def test_segment_chapters_do_not_interrupt_stream(self):
+        FictionChapters.compact_segments(self.fiction_id)
+        ChapterDictionaries._data_cache.clear()
+        self.assertEqual(FictionChapters.query.filter(FictionChapters.segment_id == 0).count(), 0)
+        chapters, statements = self.iter_recording()
+        self.assert_all_chapters(chapters)
+        self.assertEqual(statements, [])
+
+    def test_dictionary_missing_from_cache_uses_separate_connection(self):
+        dict_id = FictionChapters.query.with_entities(FictionChapters.content_dict_id).first()[0]
+        # 会话正在占用的连接，相当于流式读取章节的连接
+        session_connection = db.session.connection().connection.connection
+        connections = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if 'FROM chapter_dictionaries' in statement:
+                connections.append(conn.connection.connection)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertTrue(ChapterDictionaries.get_data(None, dict_id))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(len(connections), 1)
+        self.assertIsNot(connections[0], session_connection)
+        self.assertIn(dict_id, ChapterDictionaries._data_cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
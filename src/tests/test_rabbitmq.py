@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# @File    : test_rabbitmq.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 消息队列辅助方法的测试
+import unittest
+import tests
+from config import Config
+from utils import rabbitmq
+
+
+class ParkedQueueTestCase(unittest.TestCase):
+
+    def test_delays_are_grouped_by_level(self):
+        levels = rabbitmq.parked_queue_levels()
+        # 最后一级可以容纳熔断的全部时间
+        self.assertGreaterEqual(2 ** (levels - 1), Config.BREAKER_OPEN_SECONDS)
+        self.assertEqual(rabbitmq.parked_queue_level(0.5), 0)
+        self.assertEqual(rabbitmq.parked_queue_level(1), 0)
+        self.assertEqual(rabbitmq.parked_queue_level(3), 2)
+        self.assertEqual(rabbitmq.parked_queue_level(Config.BREAKER_OPEN_SECONDS * 10), levels - 1)
+        for delay in range(1, Config.BREAKER_OPEN_SECONDS + 1):
+            level = rabbitmq.parked_queue_level(delay)
+            # 同一级中的等待时间相差不超过一倍，短等待的消息不会被挡住太久
+            self.assertLessEqual(delay, 2 ** level)
+            self.assertGreater(delay * 2, 2 ** level)
+
+
+if __name__ == '__main__':
+    unittest.main()
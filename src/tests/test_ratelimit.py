@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# @File    : test_ratelimit.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 按域名限流器的测试
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+import tests
+from models import MiddleChapter
+from spiders.spider import BaseSpider
+from utils.ratelimit import DomainRateLimiter
+
+
+class DomainRateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.limiter = DomainRateLimiter(os.path.join(self.directory.name, 'rate_limit.db'), burst=5)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        self.directory.cleanup()
+
+    def leases(self):
+        return self.limiter.fetchone('SELECT COUNT(*) FROM leases')[0]
+
+    def test_cancelled_download_returns_lease(self):
+        class HangingClient:
+            def get(self, url, headers=None):
+                return self
+
+            async def __aenter__(self):
+                await asyncio.sleep(10)
+
+            async def __aexit__(self, *args):
+                pass
+
+        spider = BaseSpider()
+        spider.domain = 'test.com'
+        chapter = MiddleChapter(chapter_url='http://test.com/1.html', fiction_url='http://test.com/')
+
+        async def run():
+            task = asyncio.ensure_future(spider.async_download_chapter(HangingClient(), chapter))
+            await asyncio.sleep(0.2)
+            self.assertEqual(self.leases(), 1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # 等待线程池中的归还完成
+            await asyncio.sleep(0.2)
+
+        with mock.patch('spiders.spider.rate_limiter', self.limiter):
+            self.loop.run_until_complete(run())
+        self.assertEqual(self.leases(), 0)
+
+    def test_cancelled_acquire_returns_lease(self):
+        async def run():
+            task = asyncio.ensure_future(self.limiter.acquire_async('test.com'))
+            # 在线程中的事务完成之前取消
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.2)
+
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.leases(), 0)
+
+    def test_rate_increases_about_one_step_per_second(self):
+        limiter = DomainRateLimiter(self.limiter.db_path, rate=10, burst=10, max_rate=100)
+        # 按速率连续请求一秒
+        for _ in range(10):
+            lease_id, _ = limiter.try_acquire('test.com')
+            limiter.release(lease_id, 'test.com', 0.1, 200)
+        rate = limiter.stats()[0]['rate']
+        self.assertAlmostEqual(rate, 10 + limiter.increase_step, delta=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# @File    : test_search_deadline.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 并发检索截止时间的测试
+import threading
+import time
+import unittest
+from unittest import mock
+import requests
+import tests
+from spiders import spider as spider_module
+from spiders.spider import BaseSpider, SpiderManager
+
+
+class SlowSession:
+    """
+    每个请求都等到超时时间用完才失败的会话
+    """
+
+    def __init__(self):
+        self.timeouts = []
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        time.sleep(timeout)
+        raise requests.Timeout('请求超时！')
+
+
+class SlowSpider(BaseSpider):
+    domain = 'slow.test'
+    site = '慢速网站'
+
+    def __init__(self, session):
+        self.session = session
+
+    @property
+    def http_session(self):
+        return self.session
+
+    def _search_fictions_by_name(self, fiction_name):
+        self.fetch('https://slow.test/search.php', params={'q': fiction_name})
+        return []
+
+
+class SearchDeadlineTestCase(unittest.TestCase):
+
+    def test_running_search_stops_at_deadline(self):
+        session = SlowSession()
+        manager = SpiderManager({SlowSpider.site: SlowSpider(session)})
+        finished = threading.Event()
+        search_site = SpiderManager._search_site
+
+        def tracked_search_site(*args):
+            try:
+                return search_site(*args)
+            finally:
+                finished.set()
+
+        with mock.patch.object(spider_module, 'rate_limiter', None), \
+                mock.patch.object(spider_module, 'circuit_breaker', None), \
+                mock.patch.object(SpiderManager, '_search_site', side_effect=tracked_search_site):
+            start_time = time.time()
+            _, site_statuses = manager.search_fictions_concurrently('截止时间测试', deadline=0.3)
+            self.assertEqual(site_statuses[0].status, 'timeout')
+            # 正在进行的检索在截止时间后很快结束，不会继续重试占用线程池
+            self.assertTrue(finished.wait(1))
+        self.assertLess(time.time() - start_time, 1)
+        self.assertEqual(len(session.timeouts), 1)
+        self.assertLessEqual(session.timeouts[0], 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# @File    : test_segment_store.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 段文件存储的测试
+import os
+import tempfile
+import time
+import unittest
+import tests
+from utils.segment_store import SegmentStore
+
+
+class SegmentStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SegmentStore(self.directory.name, retain_seconds=60)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def compact(self, blobs):
+        with self.store.lock(1):
+            generation, locations = self.store.compact(1, enumerate(blobs))
+            self.store.activate(1, generation)
+        return generation, locations
+
+    def test_reader_survives_consecutive_compactions(self):
+        with self.store.lock(1):
+            generation, locations = self.store.append(1, [b'first', b'second'])
+        reader = self.store.reader()
+        try:
+            self.assertEqual(reader.read(1, generation, *locations[0]), b'first')
+            # 导出还没有读到第二个章节时，连续整理两次
+            self.compact([b'first', b'second'])
+            self.compact([b'first', b'second'])
+            self.assertEqual(reader.read(1, generation, *locations[1]), b'second')
+        finally:
+            reader.close()
+        # 新打开的读取器也还能读取保留期内的旧段文件
+        reader = self.store.reader()
+        try:
+            self.assertEqual(reader.read(1, generation, *locations[1]), b'second')
+        finally:
+            reader.close()
+
+    def test_expired_generations_are_removed(self):
+        generation, _ = self.compact([b'first'])
+        self.compact([b'first'])
+        # 模拟被替换超过保留时间的段文件
+        old_time = time.time() - 120
+        os.utime(self.store.segment_path(1, generation), (old_time, old_time))
+        latest, _ = self.compact([b'first'])
+        self.assertEqual(sorted(self.store.segment_sizes(1)), [latest - 1, latest])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# @File    : test_sqlite_store.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : sqlite共享存储的测试
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import tests
+from utils import sqlite_store
+from utils.sqlite_store import SqliteStore
+
+
+class CounterStore(SqliteStore):
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.schema_inits = 0
+
+    def init_schema(self, conn):
+        self.schema_inits += 1
+        conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+
+class SqliteStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, 'store.db')
+        self.store = CounterStore(self.db_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_connections_are_shared_between_threads(self):
+        connections = []
+
+        def use_store():
+            with self.store.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                             (threading.current_thread().name, 1))
+                connections.append(conn)
+
+        for _ in range(5):
+            thread = threading.Thread(target=use_store)
+            thread.start()
+            thread.join()
+        self.assertEqual(len(set(map(id, connections))), 1)
+        self.assertEqual(self.store.schema_inits, 1)
+        self.assertEqual(self.store.fetchone('SELECT COUNT(*) FROM counters')[0], 5)
+
+    def test_waits_for_write_lock_by_sleeping(self):
+        self.store.fetchone('SELECT COUNT(*) FROM counters')
+        other = sqlite3.connect(self.db_path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        sleeps = []
+        real_sleep = time.sleep
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 5:
+                other.execute('COMMIT')
+            real_sleep(seconds)
+
+        with mock.patch.object(sqlite_store.time, 'sleep', side_effect=sleep):
+            with self.store.transaction() as conn:
+                conn.execute('INSERT INTO counters (name, value) VALUES (?, ?)', ('a', 1))
+        other.close()
+        self.assertGreaterEqual(len(sleeps), 5)
+        self.assertEqual(self.store.fetchone('SELECT value FROM counters WHERE name = ?', ('a',))[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
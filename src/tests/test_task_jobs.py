@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# @File    : test_task_jobs.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 后台任务的测试
+from datetime import datetime, timedelta
+import os
+import socket
+import subprocess
+import sys
+import unittest
+from unittest import mock
+import tests
+from app import app
+from config import Config
+from models import db, TaskJobs, Fictions, ChapterJobs
+from spiders import SpiderManager
+from utils.delivery import KindleDelivery, job_directory, remove_orphaned_files
+
+
+class TaskJobsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_jobs_of_exited_process_are_failed(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        dead_job = TaskJobs.create_job('delivery', fiction_id=1)
+        TaskJobs.update_job(dead_job.job_id, owner='{}:{}'.format(socket.gethostname(), process.pid))
+        live_job = TaskJobs.create_job('delivery', fiction_id=1)
+        remote_job = TaskJobs.create_job('delivery', fiction_id=1)
+        TaskJobs.update_job(remote_job.job_id, owner='other-host:1')
+        stale_job = TaskJobs.create_job('delivery', fiction_id=1)
+        TaskJobs.query.filter(TaskJobs.job_id == stale_job.job_id).update(
+            {'owner': 'other-host:1', 'update_time': datetime.now() - timedelta(days=1)})
+        db.session.commit()
+        failed_jobs = TaskJobs.fail_orphaned_jobs()
+        self.assertEqual({job.job_id for job in failed_jobs}, {dead_job.job_id, stale_job.job_id})
+        db.session.expire_all()
+        self.assertEqual(TaskJobs.query.get(dead_job.job_id).status, 'failed')
+        self.assertEqual(TaskJobs.query.get(live_job.job_id).status, 'pending')
+        self.assertEqual(TaskJobs.query.get(remote_job.job_id).status, 'pending')
+
+    def test_waiting_job_of_live_process_is_kept(self):
+        job = TaskJobs.create_job('enqueue', fiction_id=1)
+        TaskJobs.query.filter(TaskJobs.job_id == job.job_id).update(
+            {'update_time': datetime.now() - timedelta(days=1)})
+        db.session.commit()
+        self.assertEqual(TaskJobs.fail_orphaned_jobs(), [])
+        db.session.expire_all()
+        self.assertEqual(TaskJobs.query.get(job.job_id).status, 'pending')
+
+    def test_orphaned_delivery_files_are_removed(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        job = TaskJobs.create_job('delivery', fiction_id=1)
+        TaskJobs.update_job(job.job_id, status='running', owner='{}:{}'.format(socket.gethostname(), process.pid))
+        directory = job_directory(job.job_id)
+        os.makedirs(directory)
+        enqueue_job = TaskJobs.create_job('enqueue', fiction_id=1)
+        TaskJobs.update_job(enqueue_job.job_id, owner='{}:{}'.format(socket.gethostname(), process.pid))
+        remove_orphaned_files(TaskJobs.fail_orphaned_jobs(kind='delivery'))
+        self.assertFalse(os.path.exists(directory))
+        db.session.expire_all()
+        self.assertEqual(TaskJobs.query.get(job.job_id).status, 'failed')
+        self.assertEqual(TaskJobs.query.get(enqueue_job.job_id).status, 'pending')
+
+    def test_failed_publish_releases_unpublished_chapters(self):
+        fiction = Fictions(site='测试', origin_id='1', fiction_name='测试小说', toc_etag='"1"',
+                           toc_last_modified='Sat, 28 Mar 2020 00:00:00 GMT', toc_hash='1' * 40, toc_last_origin_id=10)
+        db.session.add(fiction)
+        db.session.commit()
+        fiction_id = fiction.fid
+        db.session.add(ChapterJobs(fiction_id=fiction_id, origin_id=11, expire_at=datetime.now() + timedelta(days=1)))
+        job_id = TaskJobs.create_job('enqueue', fiction_id=fiction_id, total=1).job_id
+        with app.test_request_context():
+            callback = SpiderManager.make_publish_callback(job_id, fiction_id)
+        callback(0, False, Exception('发布失败'))
+        db.session.expire_all()
+        fiction = Fictions.query.get(fiction_id)
+        self.assertEqual((fiction.toc_etag, fiction.toc_last_modified, fiction.toc_hash, fiction.toc_last_origin_id),
+                         ('', '', '', 0))
+        self.assertEqual(ChapterJobs.query.filter(ChapterJobs.fiction_id == fiction_id).count(), 0)
+        self.assertEqual(TaskJobs.query.get(job_id).status, 'failed')
+
+    def test_delivery_heartbeat_refreshes_current_and_queued_jobs(self):
+        old_time = datetime.now() - timedelta(days=1)
+        job_ids = [TaskJobs.create_job('delivery', fiction_id=1).job_id for _ in range(3)]
+        TaskJobs.query.update({'update_time': old_time})
+        db.session.commit()
+        delivery = KindleDelivery()
+        delivery._pending.add(job_ids[1])
+        with mock.patch.object(Config, 'DELIVERY_HEARTBEAT_INTERVAL', 0):
+            self.assertEqual(list(delivery._with_heartbeat(job_ids[0], range(3))), [0, 1, 2])
+        db.session.expire_all()
+        update_times = [TaskJobs.query.get(job_id).update_time for job_id in job_ids]
+        self.assertGreater(update_times[0], old_time)
+        self.assertGreater(update_times[1], old_time)
+        self.assertEqual(update_times[2], old_time)
+
+
+if __name__ == '__main__':
+    unittest.main()
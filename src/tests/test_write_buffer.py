@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# @File    : test_write_buffer.py
+# @Author  : AaronJny
+# @Time    : 2020/03/28
+# @Desc    : 章节写缓冲区的测试
+import unittest
+from unittest import mock
+import tests
+from app import app
+from models import db, Fictions, FictionChapters, MiddleChapter
+from spiders.write_buffer import ChapterWriteBuffer
+from sqlalchemy.exc import OperationalError
+
+
+class ChapterWriteBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        fiction = Fictions(site='测试', origin_id='1', fiction_name='测试小说')
+        db.session.add(fiction)
+        db.session.commit()
+        self.fiction_id = fiction.fid
+        self.buffer = ChapterWriteBuffer(db.session, max_attempts=2)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def add_chapters(self, number):
+        for order in range(number):
+            self.buffer.add(MiddleChapter(fiction_id=self.fiction_id, origin_id=order + 1, chapter_order=order,
+                                          chapter_name='第{}章'.format(order + 1), chapter_content='正文',
+                                          site='测试'), order + 1)
+
+    def test_bad_chapter_is_rejected_after_max_attempts(self):
+        self.add_chapters(5)
+        encode_content = FictionChapters.encode_content
+
+        def failing_encode_content(session, site, chapter_content):
+            if chapter_content == '坏章节':
+                raise ValueError('无法压缩')
+            return encode_content(session, site, chapter_content)
+
+        self.buffer._chapters[2].chapter_content = '坏章节'
+        with mock.patch.object(FictionChapters, 'encode_content', side_effect=failing_encode_content):
+            with self.assertRaises(ValueError):
+                self.buffer.flush()
+            self.assertEqual(len(self.buffer), 5)
+            tokens = self.buffer.flush()
+        self.assertEqual(tokens, [1, 2, 3, 4, 5])
+        self.assertEqual([token for _, token in self.buffer.take_rejected()], [3])
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(FictionChapters.query.count(), 4)
+        self.assertEqual(Fictions.query.get(self.fiction_id).cached_chapters_count, 4)
+
+    def test_database_errors_keep_chapters_in_buffer(self):
+        self.add_chapters(3)
+        error = OperationalError('INSERT', {}, Exception('连接已断开'))
+        with mock.patch.object(FictionChapters, 'insert_ignore', side_effect=error):
+            for _ in range(3):
+                with self.assertRaises(OperationalError):
+                    self.buffer.flush()
+        self.assertEqual(len(self.buffer), 3)
+        self.assertEqual(self.buffer.take_rejected(), [])
+        self.assertEqual(self.buffer.flush(), [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
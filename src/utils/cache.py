@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# @File    : cache.py
+# @Author  : AaronJny
+# @Time    : 2020/03/15
+# @Desc    : 带过期时间和LRU淘汰的缓存
+from collections import OrderedDict
+import json
+import threading
+import time
+from .sqlite_store import SqliteStore
+
+
+class SqliteCacheBackend(SqliteStore):
+    """
+    基于sqlite文件的共享缓存，同一台机器上的多个进程可以共用。缓存值需要能被json序列化
+    """
+
+    def __init__(self, db_path, max_size=10000):
+        super().__init__(db_path)
+        self.max_size = max_size
+        self._set_count = 0
+
+    def init_schema(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_items '
+                     '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expire_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_items_expire_at ON cache_items (expire_at)')
+
+    def get(self, key):
+        row = self.fetchone('SELECT value, expire_at FROM cache_items WHERE key = ?', (key,))
+        if not row or row[1] < time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expire_at):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO cache_items (key, value, expire_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), expire_at))
+            # 每写入一定次数，清理一次过期数据和超出容量的数据
+            self._set_count += 1
+            if self._set_count % 100 == 0:
+                conn.execute('DELETE FROM cache_items WHERE expire_at < ?', (time.time(),))
+                conn.execute('DELETE FROM cache_items WHERE key IN (SELECT key FROM cache_items '
+                             'ORDER BY expire_at DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+
+class _Flight:
+    """
+    一次正在进行中的加载，相同key的并发请求等待并共享它的结果
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    进程内缓存，支持过期时间、按容量的LRU淘汰，以及相同key并发加载时只加载一次。
+    可选地使用backend在多个进程之间共享缓存
+    """
+
+    def __init__(self, max_size=256, ttl=600, backend: SqliteCacheBackend = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self._items = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        读取缓存，不存在或已过期时返回None
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item:
+                value, expire_at = item
+                if expire_at >= now:
+                    self._items.move_to_end(key)
+                    return value
+                del self._items[key]
+        if self.backend:
+            item = self.backend.get(key)
+            if item:
+                self._set_local(key, *item)
+                return item[0]
+        return None
+
+    def _set_local(self, key, value, expire_at):
+        with self._lock:
+            self._items[key] = (value, expire_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def set(self, key, value):
+        expire_at = time.time() + self.ttl
+        self._set_local(key, value, expire_at)
+        if self.backend:
+            self.backend.set(key, value, expire_at)
+
+    def get_or_load(self, key, loader):
+        """
+        读取缓存，缓存不存在时调用loader加载并写入缓存。
+        相同key的并发调用只会执行一次loader，其余调用等待并共享结果
+
+        Args:
+            key: 缓存键
+            loader: 无参数的加载函数
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = loader()
+            self.set(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
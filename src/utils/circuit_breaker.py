@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# @File    : circuit_breaker.py
+# @Author  : AaronJny
+# @Time    : 2020/03/20
+# @Desc    : 多进程共享的按网站熔断器
+import time
+from config import Config
+from .sqlite_store import SqliteStore
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class SiteCircuitBreaker(SqliteStore):
+    """
+    按网站统计请求结果的熔断器，同一台机器上的多个进程通过同一个sqlite文件共享状态。
+
+    - closed: 正常放行，统计窗口内失败率（含慢请求）超过阈值时转为open
+    - open: 拒绝全部请求，持续open_seconds秒后转为half_open
+    - half_open: 只放行half_open_calls个探测请求，全部成功则恢复closed，任意一个失败则重新open
+    """
+
+    def __init__(self, db_path, window_seconds=None, min_calls=None, failure_rate=None, slow_seconds=None,
+                 open_seconds=None, half_open_calls=None):
+        super().__init__(db_path)
+        self.window_seconds = window_seconds or Config.BREAKER_WINDOW_SECONDS
+        self.min_calls = min_calls or Config.BREAKER_MIN_CALLS
+        self.failure_rate = failure_rate or Config.BREAKER_FAILURE_RATE
+        self.slow_seconds = slow_seconds or Config.BREAKER_SLOW_SECONDS
+        self.open_seconds = open_seconds or Config.BREAKER_OPEN_SECONDS
+        self.half_open_calls = half_open_calls or Config.BREAKER_HALF_OPEN_CALLS
+
+    def init_schema(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS breakers (site TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                     'changed_at REAL NOT NULL, window_start REAL NOT NULL, calls INTEGER NOT NULL, '
+                     'failures INTEGER NOT NULL, probes INTEGER NOT NULL, successes INTEGER NOT NULL)')
+
+    def _load(self, conn, site, now):
+        row = conn.execute('SELECT state, changed_at, window_start, calls, failures, probes, successes '
+                           'FROM breakers WHERE site = ?', (site,)).fetchone()
+        if not row:
+            row = (CLOSED, now, now, 0, 0, 0, 0)
+            conn.execute('INSERT INTO breakers (site, state, changed_at, window_start, calls, failures, probes, '
+                         'successes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (site,) + row)
+        return dict(zip(('state', 'changed_at', 'window_start', 'calls', 'failures', 'probes', 'successes'), row))
+
+    @classmethod
+    def _save(cls, conn, site, breaker):
+        conn.execute('UPDATE breakers SET state = ?, changed_at = ?, window_start = ?, calls = ?, failures = ?, '
+                     'probes = ?, successes = ? WHERE site = ?',
+                     (breaker['state'], breaker['changed_at'], breaker['window_start'], breaker['calls'],
+                      breaker['failures'], breaker['probes'], breaker['successes'], site))
+
+    @classmethod
+    def _transit(cls, breaker, state, now):
+        breaker.update(state=state, changed_at=now, window_start=now, calls=0, failures=0, probes=0, successes=0)
+
+    def allow(self, site):
+        """
+        是否允许向该网站发起请求
+
+        Args:
+            site: 网站名称
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            breaker = self._load(conn, site, now)
+            if breaker['state'] == CLOSED:
+                return True
+            # open超时后转为half_open；half_open的探测请求迟迟没有结果时（比如进程退出了），也重新开始探测
+            if now - breaker['changed_at'] >= self.open_seconds:
+                self._transit(breaker, HALF_OPEN, now)
+            if breaker['state'] == HALF_OPEN and breaker['probes'] < self.half_open_calls:
+                breaker['probes'] += 1
+                self._save(conn, site, breaker)
+                return True
+            self._save(conn, site, breaker)
+            return False
+
+    def record(self, site, success, elapsed=0.0):
+        """
+        记录一次请求结果
+
+        Args:
+            site: 网站名称
+            success: 请求是否成功
+            elapsed: 请求耗时，单位秒，超过slow_seconds的请求按失败计算
+        """
+        now = time.time()
+        failed = not success or elapsed > self.slow_seconds
+        with self.transaction() as conn:
+            breaker = self._load(conn, site, now)
+            if breaker['state'] == HALF_OPEN:
+                if failed:
+                    self._transit(breaker, OPEN, now)
+                else:
+                    breaker['successes'] += 1
+                    if breaker['successes'] >= self.half_open_calls:
+                        self._transit(breaker, CLOSED, now)
+            elif breaker['state'] == CLOSED:
+                if now - breaker['window_start'] >= self.window_seconds:
+                    breaker.update(window_start=now, calls=0, failures=0)
+                breaker['calls'] += 1
+                breaker['failures'] += 1 if failed else 0
+                if breaker['calls'] >= self.min_calls and \
+                        breaker['failures'] / breaker['calls'] >= self.failure_rate:
+                    self._transit(breaker, OPEN, now)
+            self._save(conn, site, breaker)
+
+    def retry_after(self, site):
+        """
+        距离下次允许探测还有多少秒，closed状态下为0
+        """
+        row = self.fetchone('SELECT state, changed_at FROM breakers WHERE site = ?', (site,))
+        if not row or row[0] == CLOSED:
+            return 0
+        return max(self.open_seconds - (time.time() - row[1]), 1)
+
+    def states(self):
+        """
+        查询全部网站的熔断状态
+
+        Returns:
+            typing.Dict[str, dict]，网站名称到熔断状态的映射
+        """
+        rows = self.fetchall('SELECT site, state, changed_at, calls, failures FROM breakers')
+        states = {}
+        for site, state, changed_at, calls, failures in rows:
+            states[site] = {
+                'site': site,
+                'state': state,
+                'since': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(changed_at)),
+                'calls': calls,
+                'failures': failures,
+                'retry_after': round(self.retry_after(site), 1)
+            }
+        return states
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# @File    : compression.py
+# @Author  : AaronJny
+# @Time    : 2020/03/22
+# @Desc    : 章节内容压缩，安装了zstandard时使用zstd，否则使用zlib
+from collections import Counter
+import threading
+import typing
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 压缩方式的名称，保存在章节表中
+ZSTD = 'zstd'
+ZLIB = 'zlib'
+# zlib的预置字典最多使用最后32KB
+ZLIB_MAX_DICT_SIZE = 32 * 1024
+
+# zstd的压缩器和解压器创建时要处理字典，开销较大，按线程缓存复用（zstandard的实例不是线程安全的）
+_local = threading.local()
+
+
+def _zstd_instance(kind, dictionary: bytes, level: int = 0):
+    cache = getattr(_local, 'zstd', None)
+    if cache is None:
+        cache = _local.zstd = {}
+    key = (kind, dictionary, level)
+    instance = cache.get(key)
+    if instance is None:
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        if kind == 'compressor':
+            instance = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+        else:
+            instance = zstandard.ZstdDecompressor(dict_data=dict_data)
+        if len(cache) >= 32:
+            cache.clear()
+        cache[key] = instance
+    return instance
+
+
+def default_codec():
+    """
+    当前环境下默认使用的压缩方式
+    """
+    return ZSTD if zstandard else ZLIB
+
+
+def train_dictionary(codec: str, samples: typing.List[bytes], dict_size: int):
+    """
+    用同一网站的章节样本训练压缩字典
+
+    Args:
+        codec: 压缩方式
+        samples: 章节内容样本
+        dict_size: 字典大小上限，单位字节
+
+    Returns:
+        字典字节序列，样本太少无法训练时返回b''
+    """
+    if not samples:
+        return b''
+    if codec == ZSTD:
+        try:
+            return zstandard.train_dictionary(dict_size, samples).as_bytes()
+        except zstandard.ZstdError:
+            return b''
+    # zlib没有训练方法，把多个章节中重复出现的行拼成预置字典，越常见的行越靠后，离待压缩数据越近
+    line_counter = Counter()
+    for sample in samples:
+        line_counter.update(set(sample.splitlines(keepends=True)))
+    common_lines = [line for line, count in line_counter.most_common() if count > 1 and line.strip()]
+    dict_size = min(dict_size, ZLIB_MAX_DICT_SIZE)
+    selected = []
+    size = 0
+    for line in common_lines:
+        if size + len(line) > dict_size:
+            break
+        selected.append(line)
+        size += len(line)
+    return b''.join(reversed(selected))
+
+
+def compress(codec: str, data: bytes, dictionary: bytes = b'', level: int = None):
+    """
+    压缩数据
+
+    Args:
+        codec: 压缩方式
+        data: 原始数据
+        dictionary: 压缩字典，为空时不使用字典
+        level: 压缩级别，为None时使用默认级别
+
+    Returns:
+        压缩后的字节序列
+    """
+    if codec == ZSTD:
+        return _zstd_instance('compressor', dictionary, level or 3).compress(data)
+    if codec == ZLIB:
+        kwargs = {'zdict': dictionary} if dictionary else {}
+        compressor = zlib.compressobj(level if level is not None else 6, **kwargs)
+        return compressor.compress(data) + compressor.flush()
+    raise Exception('不支持的压缩方式：{}！'.format(codec))
+
+
+def decompress(codec: str, data: bytes, dictionary: bytes = b''):
+    """
+    解压数据，参数与compress相对应
+
+    Args:
+        codec: 压缩方式
+        data: 压缩后的数据
+        dictionary: 压缩时使用的字典
+
+    Returns:
+        原始数据
+    """
+    if codec == ZSTD:
+        if not zstandard:
+            raise Exception('解压章节内容需要安装zstandard！')
+        return _zstd_instance('decompressor', dictionary).decompress(data)
+    if codec == ZLIB:
+        kwargs = {'zdict': dictionary} if dictionary else {}
+        decompressor = zlib.decompressobj(**kwargs)
+        return decompressor.decompress(data) + decompressor.flush()
+    raise Exception('不支持的压缩方式：{}！'.format(codec))
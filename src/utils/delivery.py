@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+# @File    : delivery.py
+# @Author  : AaronJny
+# @Time    : 2020/03/24
+# @Desc    : 在后台把小说分卷推送到kindle
+import os
+import queue
+import shutil
+import threading
+import time
+import typing
+import zipfile
+from loguru import logger
+from config import Config
+from models import db, Fictions, EmailConfig, TaskJobs
+from utils import email
+from utils.epub import EpubWriter, Fragment
+
+# zip压缩器内部缓冲的数据还没有写入文件，判断分卷大小时预留的余量
+ZIP_BUFFER_MARGIN = 64 * 1024
+# epub最后写入的opf、目录和zip中央目录的预估大小，每个章节预留的字节数和固定预留的字节数
+EPUB_TAIL_PER_CHAPTER = 512
+EPUB_TAIL_MARGIN = 16 * 1024
+
+
+class VolumeWriter:
+    """
+    一卷小说的附件文件，压缩时写成只包含一个txt文件的zip
+    """
+
+    def __init__(self, directory, name, compress):
+        self.path = os.path.join(directory, '{}.{}'.format(name, 'zip' if compress else 'txt'))
+        self.raw_size = 0
+        self._file = open(self.path, 'wb')
+        self._zip = None
+        self._stream = self._file
+        if compress:
+            self._zip = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_DEFLATED)
+            self._stream = self._zip.open('{}.txt'.format(name), 'w')
+
+    @property
+    def size(self):
+        """
+        已写入文件的字节数，压缩时还要加上压缩器中缓冲的余量
+        """
+        return self._file.tell() + (ZIP_BUFFER_MARGIN if self._zip else 0)
+
+    def write(self, data: bytes):
+        self._stream.write(data)
+        self.raw_size += len(data)
+
+    def close(self):
+        if self._zip is not None:
+            self._stream.close()
+            self._zip.close()
+        self._file.close()
+
+
+def write_volumes(chunks: typing.Iterable[bytes], directory, fiction_name, max_size, compress):
+    """
+    把小说文本按章节写成若干卷附件，每卷不超过max_size字节。单个章节超过上限时单独成卷
+
+    Args:
+        chunks: 逐个章节的文本字节序列
+        directory: 附件保存的文件夹
+        fiction_name: 小说名称，第一卷使用小说名称，之后的卷加上序号
+        max_size: 每卷附件的大小上限，单位字节
+        compress: 是否压缩成zip
+
+    Returns:
+        typing.List[str]，各卷附件的路径
+    """
+    paths = []
+    volume = None
+    try:
+        for chunk in chunks:
+            # 压缩后的大小不会明显超过原始大小，按未压缩的长度预估写入这个章节后的大小
+            if volume is not None and volume.raw_size and volume.size + len(chunk) > max_size:
+                volume.close()
+                volume = None
+            if volume is None:
+                name = volume_name(fiction_name, len(paths) + 1)
+                volume = VolumeWriter(directory, name, compress)
+                paths.append(volume.path)
+            volume.write(chunk)
+    finally:
+        if volume is not None:
+            volume.close()
+    return paths
+
+
+def volume_name(name, index):
+    """
+    第一卷使用原名称，之后的卷加上序号
+    """
+    return name if index == 1 else '{}_{}'.format(name, index)
+
+
+def write_epub_volumes(chapters: typing.Iterable[typing.Tuple[typing.Any, str, Fragment]], directory, name, author,
+                       identifier, max_size):
+    """
+    把章节片段写成若干卷epub，每卷不超过max_size字节。epub本身已经压缩，不再打包成zip
+
+    Args:
+        chapters: Fictions.iter_chapter_fragments生成的章节片段
+        directory: 附件保存的文件夹
+        name: 文件名称和书名
+        author: 作者
+        identifier: 书的唯一标识，分卷时加上序号
+        max_size: 每卷附件的大小上限，单位字节
+
+    Returns:
+        typing.List[str]，各卷附件的路径
+    """
+    paths = []
+    writer, f = None, None
+    try:
+        for key, chapter_name, fragment in chapters:
+            tail_size = EPUB_TAIL_PER_CHAPTER * (len(writer) + 1) + EPUB_TAIL_MARGIN if writer else 0
+            if writer is not None and len(writer) and writer.size + len(fragment.data) + tail_size > max_size:
+                f.write(writer.finish())
+                f.close()
+                writer, f = None, None
+            if writer is None:
+                index = len(paths) + 1
+                volume = volume_name(name, index)
+                paths.append(os.path.join(directory, '{}.epub'.format(volume)))
+                f = open(paths[-1], 'wb')
+                writer = EpubWriter(volume, author, identifier if index == 1 else '{}:{}'.format(identifier, index))
+                f.write(writer.start())
+            f.write(writer.add_chapter(key, chapter_name, fragment))
+        if writer is not None:
+            f.write(writer.finish())
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+def export_file_name(fiction: Fictions, lower, first, last):
+    """
+    导出文件的名称，只导出部分章节时加上章节序号范围
+    """
+    if lower is None:
+        return fiction.fiction_name
+    return '{}_{}-{}'.format(fiction.fiction_name, first + 1, last + 1)
+
+
+def job_directory(job_id):
+    """
+    推送任务生成附件使用的临时文件夹
+    """
+    return os.path.join(Config.TEMPORARY_FILE_PATH, job_id)
+
+
+def remove_orphaned_files(jobs: typing.List[TaskJobs]):
+    """
+    删除已丢失的推送任务留下的附件文件，执行任务的进程退出时来不及清理
+
+    Args:
+        jobs: TaskJobs.fail_orphaned_jobs返回的任务
+    """
+    for job in jobs:
+        if job.kind == 'delivery':
+            shutil.rmtree(job_directory(job.job_id), ignore_errors=True)
+
+
+def max_attachment_size():
+    """
+    根据邮件大小上限计算附件的大小上限，附件在邮件中按base64编码，体积变为4/3，并预留邮件头的空间
+    """
+    return Config.DELIVERY_MAX_MAIL_SIZE * 3 // 4 - 64 * 1024
+
+
+class KindleDelivery:
+    """
+    后台推送小说的投递器。
+    推送请求只创建任务并放入队列，后台线程生成分卷附件，同一次推送的所有分卷复用一个smtp连接依次发送，
+    发送进度记录在任务中。
+    任务队列只保存在内存中，后台线程启动时先把已退出的进程留下的推送任务标记为失败，并清理它们的附件。
+    生成和发送附件期间定时刷新当前任务和排队中任务的更新时间，避免排队较久的任务被当作已丢失的任务。
+    gunicorn使用gevent时，后台线程是同一个worker中的协程，解压章节、打包zip和epub都是CPU密集的操作，
+    生成附件时每写入一个章节主动让出一次，其他请求只需要等待一个章节的处理时间
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._recovered = False
+        # 排队中的任务编号
+        self._pending = set()
+
+    def submit(self, app, job_id, fiction_id, export_range, export_format='txt'):
+        """
+        提交一个推送任务，立即返回
+
+        Args:
+            app: flask应用，后台线程中使用它的应用上下文
+            job_id: 任务编号
+            fiction_id: 小说编号
+            export_range: Fictions.resolve_export_range返回的章节范围
+            export_format: 附件格式，txt或epub
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='kindle-delivery', daemon=True)
+                self._thread.start()
+            self._pending.add(job_id)
+        self._queue.put((app, job_id, fiction_id, export_range, export_format))
+
+    def _heartbeat(self, job_id):
+        """
+        刷新当前任务和全部排队中任务的更新时间
+        """
+        with self._lock:
+            job_ids = [job_id] + list(self._pending)
+        try:
+            TaskJobs.touch(job_ids)
+        except Exception as e:
+            logger.error(e)
+
+    def _with_heartbeat(self, job_id, items):
+        """
+        逐个产出items，期间定时刷新任务的更新时间，每个元素之后让出一次，不长时间占用gevent的事件循环
+        """
+        last_beat_time = time.time()
+        for item in items:
+            yield item
+            time.sleep(0)
+            if time.time() - last_beat_time >= Config.DELIVERY_HEARTBEAT_INTERVAL:
+                self._heartbeat(job_id)
+                last_beat_time = time.time()
+
+    def _send_volumes(self, email_config, job_id, subject, paths):
+        smtp = email.create_smtp_client(email_config)
+        try:
+            for index, path in enumerate(paths):
+                volume_subject = subject if len(paths) == 1 else '{} ({}/{})'.format(subject, index + 1, len(paths))
+                # yagmail在连接断开时只会原样重试，发送失败时重新建立连接再试一次
+                if smtp.send(to=email_config.recipient, subject=volume_subject, contents=[path, ]) is False:
+                    smtp.close()
+                    smtp = email.create_smtp_client(email_config)
+                    if smtp.send(to=email_config.recipient, subject=volume_subject, contents=[path, ]) is False:
+                        raise Exception('邮件发送失败，请确认邮箱配置！')
+                TaskJobs.update_job(job_id, finished=index + 1)
+                self._heartbeat(job_id)
+        finally:
+            smtp.close()
+
+    def _deliver(self, job_id, fiction_id, export_range, export_format):
+        fiction: Fictions = Fictions.query.get(fiction_id)
+        if not fiction:
+            raise Exception('指定小说不存在！')
+        email_config: EmailConfig = EmailConfig.query.first()
+        if not email_config:
+            raise Exception('邮箱信息不正确！请重新配置！')
+        TaskJobs.update_job(job_id, status='running')
+        directory = job_directory(job_id)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            lower, first, last, delivered = export_range
+            criterion = Fictions.export_range_criterion(first, last)
+            name = export_file_name(fiction, lower, first, last)
+            if export_format == 'epub':
+                chapters = self._with_heartbeat(job_id, fiction.iter_chapter_fragments(Config.EXPORT_BATCH_SIZE,
+                                                                                       criterion))
+                paths = write_epub_volumes(chapters, directory, name, fiction.fiction_author,
+                                           fiction.epub_identifier, max_attachment_size())
+            else:
+                chunks = (text.encode('utf8') for text in
+                          self._with_heartbeat(job_id, fiction.iter_chapter_texts(Config.EXPORT_BATCH_SIZE,
+                                                                                  criterion)))
+                paths = write_volumes(chunks, directory, name, max_attachment_size(), Config.DELIVERY_COMPRESS)
+            if not paths:
+                raise Exception('没有需要推送的章节！')
+            TaskJobs.update_job(job_id, total=len(paths))
+            self._send_volumes(email_config, job_id, name, paths)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        # 全部发送成功后推进推送水位，下次可以只推送新增章节
+        Fictions.mark_delivered(fiction_id, lower, delivered)
+        db.session.commit()
+        return len(paths)
+
+    def _run(self):
+        while True:
+            app, job_id, fiction_id, export_range, export_format = self._queue.get()
+            with self._lock:
+                self._pending.discard(job_id)
+            with app.app_context():
+                if not self._recovered:
+                    self._recover_orphaned_jobs()
+                self._heartbeat(job_id)
+                try:
+                    volumes = self._deliver(job_id, fiction_id, export_range, export_format)
+                    TaskJobs.update_job(job_id, status='done',
+                                        msg='邮件推送成功，共{}封，kindle更新有延迟，请耐心等待～'.format(volumes))
+                except Exception as e:
+                    logger.error(e)
+                    db.session.rollback()
+                    try:
+                        TaskJobs.update_job(job_id, status='failed', msg=str(e)[:255])
+                    except Exception as e:
+                        logger.error(e)
+                finally:
+                    db.session.remove()
+
+    def _recover_orphaned_jobs(self):
+        try:
+            remove_orphaned_files(TaskJobs.fail_orphaned_jobs(kind='delivery'))
+            self._recovered = True
+        except Exception as e:
+            logger.error(e)
+            db.session.rollback()
+
+
+# 进程内共享的推送投递器
+delivery = KindleDelivery()
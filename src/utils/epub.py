@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# @File    : epub.py
+# @Author  : AaronJny
+# @Time    : 2020/03/25
+# @Desc    : 流式生成epub，章节渲染后的xhtml片段压缩后缓存，重新导出时只渲染新章节
+from collections import namedtuple
+import re
+import sqlite3
+import struct
+import time
+import typing
+import zlib
+from xml.sax.saxutils import escape
+from config import Config
+from .sqlite_store import SqliteStore
+
+# 章节模板变化时加1，旧的缓存片段自动失效
+FRAGMENT_VERSION = 1
+# zip条目数和偏移的上限，超过时需要zip64，一本小说的epub不会达到
+ZIP_MAX_ENTRIES = 0xffff
+ZIP_MAX_OFFSET = 0xffffffff
+
+# 已经按deflate压缩好的zip条目内容
+Fragment = namedtuple('Fragment', ['data', 'crc', 'raw_size'])
+
+# xml中不允许出现的控制字符
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+CHAPTER_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" lang="zh-CN" xml:lang="zh-CN">
+<head>
+<meta charset="utf-8"/>
+<title>{title}</title>
+<link rel="stylesheet" type="text/css" href="style.css"/>
+</head>
+<body>
+<h2>{title}</h2>
+{paragraphs}
+</body>
+</html>
+'''
+
+CONTAINER_XML = '''<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+'''
+
+STYLE_CSS = '''h2 { text-align: center; margin: 1em 0; }
+p { text-indent: 2em; margin: 0.3em 0; line-height: 1.5; }
+'''
+
+OPF_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="zh-CN">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="book-id">{identifier}</dc:identifier>
+<dc:title>{title}</dc:title>
+<dc:creator>{author}</dc:creator>
+<dc:language>zh-CN</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+<item id="style" href="style.css" media-type="text/css"/>
+{items}
+</manifest>
+<spine toc="ncx">
+{itemrefs}
+</spine>
+</package>
+'''
+
+NAV_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh-CN" xml:lang="zh-CN">
+<head>
+<meta charset="utf-8"/>
+<title>{title}</title>
+</head>
+<body>
+<nav epub:type="toc" id="toc">
+<h1>目录</h1>
+<ol>
+{links}
+</ol>
+</nav>
+</body>
+</html>
+'''
+
+NCX_TEMPLATE = '''<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+<head>
+<meta name="dtb:uid" content="{identifier}"/>
+</head>
+<docTitle><text>{title}</text></docTitle>
+<navMap>
+{points}
+</navMap>
+</ncx>
+'''
+
+
+def _xml_text(text):
+    return escape(_INVALID_XML_CHARS.sub('', text))
+
+
+def deflate(data: bytes, level=6):
+    """
+    把数据压缩成zip条目使用的raw deflate格式
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return Fragment(compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data))
+
+
+def render_chapter(chapter_name, chapter_content):
+    """
+    把章节渲染成xhtml并压缩，每行正文一个段落
+
+    Returns:
+        Fragment
+    """
+    paragraphs = '\n'.join('<p>{}</p>'.format(_xml_text(line.strip()))
+                           for line in chapter_content.splitlines() if line.strip())
+    xhtml = CHAPTER_TEMPLATE.format(title=_xml_text(chapter_name), paragraphs=paragraphs)
+    return deflate(xhtml.encode('utf8'))
+
+
+class ZipStream:
+    """
+    只追加写入的zip生成器，每次返回需要输出的字节序列，不需要可以seek的文件，适合直接作为响应流。
+    条目内容在写入前已经压缩好、已知crc和大小，因此不需要数据描述符
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._central_directory = []
+        # zip使用dos时间
+        now = time.localtime()
+        self._dos_time = (now.tm_hour << 11) | (now.tm_min << 5) | (now.tm_sec // 2)
+        self._dos_date = ((now.tm_year - 1980) << 9) | (now.tm_mon << 5) | now.tm_mday
+
+    def add(self, name: str, fragment: Fragment, stored=False):
+        """
+        写入一个条目
+
+        Args:
+            name: 条目路径
+            fragment: 条目内容，stored为True时data是未压缩的原始数据
+            stored: 是否不压缩保存，epub的mimetype条目要求不压缩
+
+        Returns:
+            需要输出的字节序列
+        """
+        if len(self._central_directory) >= ZIP_MAX_ENTRIES or self.offset > ZIP_MAX_OFFSET:
+            raise Exception('导出文件过大！')
+        name_bytes = name.encode('utf8')
+        method = 0 if stored else 8
+        # 第11位表示文件名使用utf8编码
+        header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x0800, method, self._dos_time, self._dos_date,
+                             fragment.crc, len(fragment.data), fragment.raw_size, len(name_bytes), 0)
+        self._central_directory.append(
+            struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x0800, method, self._dos_time, self._dos_date,
+                        fragment.crc, len(fragment.data), fragment.raw_size, len(name_bytes), 0, 0, 0, 0, 0,
+                        self.offset) + name_bytes)
+        chunk = header + name_bytes + fragment.data
+        self.offset += len(chunk)
+        return chunk
+
+    def finish(self):
+        """
+        写入中央目录，结束zip文件
+
+        Returns:
+            需要输出的字节序列
+        """
+        central_directory = b''.join(self._central_directory)
+        end = struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self._central_directory), len(self._central_directory),
+                          len(central_directory), self.offset, 0)
+        chunk = central_directory + end
+        self.offset += len(chunk)
+        return chunk
+
+
+class EpubWriter:
+    """
+    流式生成epub，章节条目依次写出，目录和opf在最后根据已写入的章节生成，内存中只保留章节名称
+    """
+
+    def __init__(self, title, author, identifier):
+        self.title = title
+        self.author = author
+        self.identifier = identifier
+        self._zip = ZipStream()
+        self._chapters: typing.List[typing.Tuple[str, str]] = []
+
+    @property
+    def size(self):
+        """
+        已输出的字节数
+        """
+        return self._zip.offset
+
+    def __len__(self):
+        return len(self._chapters)
+
+    def start(self):
+        """
+        写入mimetype、container.xml和样式表
+        """
+        mimetype = b'application/epub+zip'
+        return b''.join([
+            self._zip.add('mimetype', Fragment(mimetype, zlib.crc32(mimetype), len(mimetype)), stored=True),
+            self._zip.add('META-INF/container.xml', deflate(CONTAINER_XML.encode('utf8'))),
+            self._zip.add('OEBPS/style.css', deflate(STYLE_CSS.encode('utf8')))
+        ])
+
+    def add_chapter(self, key, chapter_name, fragment: Fragment):
+        """
+        写入一个章节
+
+        Args:
+            key: 章节的唯一标识，用于生成条目名称
+            chapter_name: 章节名称，用于生成目录
+            fragment: render_chapter生成的章节片段
+        """
+        href = 'chapter_{}.xhtml'.format(key)
+        self._chapters.append((href, chapter_name))
+        return self._zip.add('OEBPS/' + href, fragment)
+
+    def finish(self):
+        """
+        写入opf、目录和zip中央目录
+        """
+        items, itemrefs, links, points = [], [], [], []
+        for index, (href, chapter_name) in enumerate(self._chapters):
+            item_id = 'c{}'.format(index)
+            chapter_name = _xml_text(chapter_name)
+            items.append('<item id="{}" href="{}" media-type="application/xhtml+xml"/>'.format(item_id, href))
+            itemrefs.append('<itemref idref="{}"/>'.format(item_id))
+            links.append('<li><a href="{}">{}</a></li>'.format(href, chapter_name))
+            points.append('<navPoint id="{0}" playOrder="{1}"><navLabel><text>{2}</text></navLabel>'
+                          '<content src="{3}"/></navPoint>'.format(item_id, index + 1, chapter_name, href))
+        title, author, identifier = _xml_text(self.title), _xml_text(self.author), _xml_text(self.identifier)
+        opf = OPF_TEMPLATE.format(identifier=identifier, title=title, author=author,
+                                  modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                                  items='\n'.join(items), itemrefs='\n'.join(itemrefs))
+        nav = NAV_TEMPLATE.format(title=title, links='\n'.join(links))
+        ncx = NCX_TEMPLATE.format(identifier=identifier, title=title, points='\n'.join(points))
+        return b''.join([
+            self._zip.add('OEBPS/content.opf', deflate(opf.encode('utf8'))),
+            self._zip.add('OEBPS/nav.xhtml', deflate(nav.encode('utf8'))),
+            self._zip.add('OEBPS/toc.ncx', deflate(ncx.encode('utf8'))),
+            self._zip.finish()
+        ])
+
+
+def iter_epub_bytes(title, author, identifier,
+                    chapters: typing.Iterable[typing.Tuple[typing.Any, str, Fragment]]):
+    """
+    逐个章节生成epub的字节序列
+
+    Args:
+        title: 书名
+        author: 作者
+        identifier: 唯一标识
+        chapters: (章节标识, 章节名称, 章节片段)，按阅读顺序排列
+    """
+    writer = EpubWriter(title, author, identifier)
+    yield writer.start()
+    for key, chapter_name, fragment in chapters:
+        yield writer.add_chapter(key, chapter_name, fragment)
+    yield writer.finish()
+
+
+class FragmentCache(SqliteStore):
+    """
+    章节片段缓存，章节写入后内容不再变化，以章节编号为键缓存渲染并压缩好的xhtml
+    """
+
+    def init_schema(self, conn: sqlite3.Connection):
+        conn.execute('CREATE TABLE IF NOT EXISTS fragments (fiction_id INTEGER NOT NULL, fcid INTEGER NOT NULL, '
+                     'version INTEGER NOT NULL, crc INTEGER NOT NULL, raw_size INTEGER NOT NULL, data BLOB NOT NULL, '
+                     'PRIMARY KEY (fiction_id, fcid))')
+
+    def get_many(self, fiction_id, fcids):
+        """
+        读取一批章节的片段
+
+        Returns:
+            typing.Dict[int, Fragment]，没有缓存的章节不在结果中
+        """
+        if not fcids:
+            return {}
+        rows = self.fetchall('SELECT fcid, data, crc, raw_size FROM fragments WHERE fiction_id = ? AND '
+                             'version = ? AND fcid IN ({})'.format(','.join('?' * len(fcids))),
+                             [fiction_id, FRAGMENT_VERSION] + list(fcids))
+        return {fcid: Fragment(data, crc, raw_size) for fcid, data, crc, raw_size in rows}
+
+    def put_many(self, fiction_id, fragments: typing.Dict[int, Fragment]):
+        """
+        保存一批章节的片段
+        """
+        if not fragments:
+            return
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO fragments (fiction_id, fcid, version, crc, raw_size, data) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             [(fiction_id, fcid, FRAGMENT_VERSION, fragment.crc, fragment.raw_size, fragment.data)
+                              for fcid, fragment in fragments.items()])
+
+    def remove(self, fiction_id):
+        """
+        删除小说的全部片段
+        """
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM fragments WHERE fiction_id = ?', (fiction_id,))
+
+
+# 进程内共享的章节片段缓存
+fragment_cache = FragmentCache(Config.EPUB_FRAGMENT_DB_PATH)
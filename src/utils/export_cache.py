@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# @File    : export_cache.py
+# @Author  : AaronJny
+# @Time    : 2020/03/14
+# @Desc    : 已导出小说文件的磁盘缓存
+import contextlib
+import fcntl
+import json
+import os
+import uuid
+from config import Config
+from models import db, FictionChapters
+
+
+def _cache_path(name):
+    os.makedirs(Config.EXPORT_CACHE_PATH, exist_ok=True)
+    return os.path.join(Config.EXPORT_CACHE_PATH, name)
+
+
+@contextlib.contextmanager
+def _fiction_lock(fiction_id, remove=False):
+    """
+    同一本小说的缓存文件同一时间只允许一个进程修改
+
+    Args:
+        fiction_id: 小说编号
+        remove: 是否在释放锁之前删除锁文件，删除小说的全部缓存文件时使用
+    """
+    path = _cache_path('{}.lock'.format(fiction_id))
+    while True:
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # 等待期间锁文件可能已经被删除，锁住的是已删除的文件时重新打开
+        try:
+            locked = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            locked = False
+        if locked:
+            break
+        f.close()
+    try:
+        yield
+    finally:
+        if remove:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+def _read_meta(fiction_id):
+    try:
+        with open(_cache_path('{}.json'.format(fiction_id)), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(fiction_id, meta):
+    meta_path = _cache_path('{}.json'.format(fiction_id))
+    tmp_path = '{}.{}'.format(meta_path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def read_content_version(fiction_id):
+    """
+    查询小说当前的内容版本，由已缓存章节数和最大章节记录编号组成
+
+    Args:
+        fiction_id: 小说编号
+
+    Returns:
+        typing.Tuple[int, int]
+    """
+    chapters_number, last_fcid = FictionChapters.query.with_entities(
+        db.func.count(FictionChapters.fcid), db.func.max(FictionChapters.fcid)).filter(
+        FictionChapters.fiction_id == fiction_id).first()
+    return chapters_number, last_fcid or 0
+
+
+def _is_fresh(meta, chapters_number, last_fcid):
+    return bool(meta) and meta['chapters_number'] == chapters_number and meta['last_fcid'] == last_fcid
+
+
+def _try_append(fiction, meta, chapters_number, last_fcid, batch_size):
+    """
+    如果自上次生成后只新增了排在末尾的章节，就把新增章节追加到已有的缓存文件后面
+
+    Returns:
+        追加成功时返回新的缓存信息，否则返回None
+    """
+    if not meta or chapters_number <= meta['chapters_number']:
+        return None
+    file_path = _cache_path(meta['file_name'])
+    if not os.path.exists(file_path):
+        return None
+    criterion = (FictionChapters.fcid > meta['last_fcid'], FictionChapters.fcid <= last_fcid)
+    new_number, first_order, last_order = FictionChapters.query.with_entities(
+        db.func.count(FictionChapters.fcid), db.func.min(FictionChapters.chapter_order),
+        db.func.max(FictionChapters.chapter_order)).filter(FictionChapters.fiction_id == fiction.fid,
+                                                           *criterion).first()
+    # 有章节被删除，或新章节插在了中间，都需要重新生成
+    if meta['chapters_number'] + new_number != chapters_number or first_order <= meta['last_order']:
+        return None
+    with open(file_path, 'r+b') as f:
+        # 丢弃上次追加失败时可能残留的半截内容
+        f.truncate(meta['size'])
+        f.seek(meta['size'])
+        for chunk in fiction.iter_txt_bytes(batch_size, criterion, leading_newline=meta['size'] > 0):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    return dict(meta, chapters_number=chapters_number, last_fcid=last_fcid, last_order=last_order, size=size)
+
+
+def _rebuild(fiction, meta, chapters_number, last_fcid, batch_size):
+    """
+    重新生成完整的缓存文件。新文件使用新的文件名，正在读取旧文件的请求不受影响
+    """
+    file_name = '{}_{}.txt'.format(fiction.fid, uuid.uuid4().hex[:8])
+    file_path = _cache_path(file_name)
+    criterion = (FictionChapters.fcid <= last_fcid,)
+    with open(file_path, 'wb') as f:
+        for chunk in fiction.iter_txt_bytes(batch_size, criterion):
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+    last_order = FictionChapters.query.with_entities(db.func.max(FictionChapters.chapter_order)).filter(
+        FictionChapters.fiction_id == fiction.fid, *criterion).scalar()
+    if meta:
+        with contextlib.suppress(OSError):
+            os.remove(_cache_path(meta['file_name']))
+    return {
+        'file_name': file_name,
+        'chapters_number': chapters_number,
+        'last_fcid': last_fcid,
+        'last_order': last_order if last_order is not None else -1,
+        'size': size
+    }
+
+
+def _make_etag(fiction_id, meta):
+    return '{}-{}-{}'.format(fiction_id, meta['chapters_number'], meta['last_fcid'])
+
+
+class SizedFile:
+    """
+    只能读取前size个字节的只读文件。缓存文件会被并发的更新在末尾原地追加，
+    发送时不能读到声明的Content-Length之后
+    """
+
+    def __init__(self, f, size):
+        self._file = f
+        self.size = size
+
+    def read(self, size=-1):
+        remaining = max(self.size - self._file.tell(), 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self._file.read(size)
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset, whence = self.size + offset, os.SEEK_SET
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def fileno(self):
+        # 服务器使用sendfile发送时按Content-Length截断
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+def open_cached_txt_file(fiction, batch_size=200):
+    """
+    打开小说的txt缓存文件，缓存过期时先增量追加或重新生成
+
+    Args:
+        fiction: 小说
+        batch_size: 每批从数据库中读取的章节数
+
+    Returns:
+        typing.Tuple[SizedFile, int, str]，已打开的文件、本版本的文件大小和ETag。
+        文件只会在末尾追加内容，返回的文件只能读取到本版本的大小为止
+    """
+    chapters_number, last_fcid = read_content_version(fiction.fid)
+    meta = _read_meta(fiction.fid)
+    if _is_fresh(meta, chapters_number, last_fcid):
+        try:
+            f = open(_cache_path(meta['file_name']), 'rb')
+            return SizedFile(f, meta['size']), meta['size'], _make_etag(fiction.fid, meta)
+        except FileNotFoundError:
+            # 文件恰好被其他进程重新生成了，加锁后重新读取
+            pass
+    with _fiction_lock(fiction.fid):
+        # 拿到锁之后再检查一次，其他进程可能已经更新过了
+        chapters_number, last_fcid = read_content_version(fiction.fid)
+        meta = _read_meta(fiction.fid)
+        if not _is_fresh(meta, chapters_number, last_fcid) or not os.path.exists(_cache_path(meta['file_name'])):
+            new_meta = _try_append(fiction, meta, chapters_number, last_fcid, batch_size)
+            if not new_meta:
+                new_meta = _rebuild(fiction, meta, chapters_number, last_fcid, batch_size)
+            _write_meta(fiction.fid, new_meta)
+            meta = new_meta
+        f = open(_cache_path(meta['file_name']), 'rb')
+    return SizedFile(f, meta['size']), meta['size'], _make_etag(fiction.fid, meta)
+
+
+def remove_cached_files(fiction_id):
+    """
+    删除指定小说的全部缓存文件
+
+    Args:
+        fiction_id: 小说编号
+    """
+    with _fiction_lock(fiction_id, remove=True):
+        meta = _read_meta(fiction_id)
+        file_names = ['{}.json'.format(fiction_id)]
+        if meta:
+            file_names.append(meta['file_name'])
+        for file_name in file_names:
+            with contextlib.suppress(OSError):
+                os.remove(_cache_path(file_name))
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# @File    : metrics.py
+# @Author  : AaronJny
+# @Time    : 2020/03/27
+# @Desc    : 爬虫运行指标，按prometheus文本格式输出
+from collections import deque
+import contextlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+import typing
+from loguru import logger
+
+# 请求耗时的分桶上限，单位秒
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+# 解析和写入数据库耗时的分桶上限，单位秒
+FAST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in list(zip(names, values)) + list(extra)]
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    指标基本类，按标签值分别计数，线程安全
+    """
+    kind = ''
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: typing.Dict[tuple, typing.Any] = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            # 没有标签的指标从0开始输出
+            self._values[()] = self._initial_value()
+
+    def _initial_value(self):
+        return 0
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise Exception('指标{}需要{}个标签！'.format(self.name, len(self.label_names)))
+        return tuple(str(label) for label in labels)
+
+    def samples(self):
+        """
+        Returns:
+            typing.List[typing.Tuple[str, str, typing.Any]]，(指标名称后缀, 标签, 数值)
+        """
+        with self._lock:
+            return [('', _format_labels(self.label_names, key), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    只增不减的计数
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    可以任意设置的当前值
+    """
+    kind = 'gauge'
+
+    def set(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """
+    按分桶统计的耗时分布
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        super().__init__(name, documentation, label_names)
+
+    def _initial_value(self):
+        return [0] * len(self.buckets), 0
+
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or self._initial_value()
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """
+        统计代码块的耗时，出错时也计入
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.time() - start_time)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            for bucket, count in zip(self.buckets, counts):
+                samples.append(('_bucket', _format_labels(self.label_names, key, [('le', _format_value(bucket))]),
+                                count))
+            samples.append(('_sum', _format_labels(self.label_names, key), total))
+            samples.append(('_count', _format_labels(self.label_names, key), counts[-1]))
+        return samples
+
+
+class RateGauge(Metric):
+    """
+    最近window秒内的平均速率，每秒的数量
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, window=60):
+        super().__init__(name, documentation)
+        self.window = window
+        self._events = deque()
+
+    def mark(self, amount=1):
+        with self._lock:
+            self._events.append((time.time(), amount))
+
+    def samples(self):
+        now = time.time()
+        with self._lock:
+            while self._events and self._events[0][0] < now - self.window:
+                self._events.popleft()
+            amount = sum(amount for _, amount in self._events)
+        return [('', '', amount / self.window)]
+
+
+class Registry:
+    """
+    指标注册表。除了直接记录的指标，还可以注册在输出时才采集的回调，比如队列长度
+    """
+
+    def __init__(self):
+        self._metrics: typing.List[Metric] = []
+        self._collectors: typing.List[typing.Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        注册一个输出前调用的回调，回调中更新指标的当前值
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        按prometheus文本格式输出全部指标
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error('采集指标失败：{}'.format(e))
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+fetch_seconds = registry.register(Histogram('crawler_fetch_seconds', '请求网页的耗时', ['site']))
+fetch_bytes = registry.register(Counter('crawler_fetch_bytes_total', '下载的网页字节数', ['site']))
+fetch_errors = registry.register(Counter('crawler_fetch_errors_total', '请求失败的次数', ['site']))
+parse_seconds = registry.register(Histogram('crawler_parse_seconds', '解析章节页面的耗时', ['site'], FAST_BUCKETS))
+flush_seconds = registry.register(Histogram('crawler_flush_seconds', '批量写入数据库的耗时', [], FAST_BUCKETS))
+chapters_written = registry.register(Counter('crawler_chapters_written_total', '写入数据库的章节数', ['site']))
+chapters_per_second = registry.register(RateGauge('crawler_chapters_per_second', '最近一分钟平均每秒写入的章节数'))
+chapter_retries = registry.register(Counter('crawler_chapter_retries_total', '放入延迟重试队列的章节数'))
+chapter_failures = registry.register(Counter('crawler_chapter_failures_total', '重试次数用完、放入死信队列的章节数'))
+messages_in_flight = registry.register(Gauge('crawler_messages_in_flight', '已取出、还没有确认的消息数'))
+queue_depth = registry.register(Gauge('crawler_queue_depth', '消息队列中等待处理的消息数', ['queue']))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不输出每次抓取的访问日志
+        pass
+
+
+def start_http_server(port, host='0.0.0.0'):
+    """
+    在后台线程中启动指标服务，通过http://host:port/metrics访问。端口被占用时只记录错误，不影响爬虫运行
+
+    Args:
+        port: 端口
+        host: 监听地址
+
+    Returns:
+        HTTPServer，启动失败时返回None
+    """
+    try:
+        server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error('指标服务启动失败，端口{}：{}'.format(port, e))
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info('指标服务已启动：http://{}:{}/metrics'.format(host, port))
+    return server
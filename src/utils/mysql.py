@@ -3,7 +3,9 @@
 # @Author  : AaronJny
 # @Time    : 2020/03/06
 # @Desc    :
-from sqlalchemy import create_engine, MetaData
+from loguru import logger
+from sqlalchemy import create_engine, MetaData, inspect
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import sessionmaker
 from config import Config
 
@@ -29,3 +31,42 @@ def create_sqlalchemy_session_and_metadata(engine=None):
     session = create_sqlalchemy_session(engine=engine)
     metadata = create_sqlalchemy_metadata(engine=engine)
     return session, metadata
+
+
+def add_missing_columns(engine, tables):
+    """
+    给已经存在的表补上模型中新增的列和索引。
+    create_all只会创建不存在的表，升级后旧表中缺少的列在这里通过ALTER TABLE补上
+
+    Args:
+        engine: 数据库引擎
+        tables: 需要检查的sqlalchemy.Table列表
+
+    Returns:
+        typing.List[str]，新增的列，格式为“表名.列名”
+    """
+    added_columns = []
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            # 已有数据行需要默认值才能满足NOT NULL约束
+            default = column.default.arg if column.default is not None and column.default.is_scalar else None
+            if default is not None and 'DEFAULT' not in str(column_ddl).upper():
+                column_ddl = '{} DEFAULT {!r}'.format(column_ddl, default)
+            sql = 'ALTER TABLE {} ADD COLUMN {}'.format(table.name, column_ddl)
+            logger.info(sql)
+            engine.execute(sql)
+            added_columns.append('{}.{}'.format(table.name, column.name))
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info('CREATE INDEX {} ON {}'.format(index.name, table.name))
+                index.create(engine)
+    return added_columns
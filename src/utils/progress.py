@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# @File    : progress.py
+# @Author  : AaronJny
+# @Time    : 2020/03/26
+# @Desc    : 小说缓存进度的推送中心
+import contextlib
+import threading
+import time
+import typing
+from loguru import logger
+from config import Config
+from models import db, Fictions, ChapterJobs
+
+
+def load_progress(fiction_ids):
+    """
+    读取多本小说的缓存进度，缓存章节数读取爬虫维护的计数，排队、下载中和失败的章节数读取采集登记
+
+    Args:
+        fiction_ids: 小说编号列表
+
+    Returns:
+        typing.Dict[int, dict]，不存在的小说不在结果中
+    """
+    rows = Fictions.query.with_entities(Fictions.fid, Fictions.cached_chapters_count,
+                                        Fictions.fiction_chapters_total).filter(Fictions.fid.in_(fiction_ids)).all()
+    job_counts = ChapterJobs.count_by_fictions([row[0] for row in rows])
+    progress = {}
+    for fid, cached_number, total_number in rows:
+        progress[fid] = {
+            'fiction_id': fid,
+            'cached_number': cached_number,
+            'total_number': total_number,
+            'queued_number': job_counts[fid]['queued'],
+            'running_number': job_counts[fid]['running'],
+            'failed_number': job_counts[fid]['failed']
+        }
+    return progress
+
+
+class ProgressHub:
+    """
+    进度推送中心，每个web进程一个。
+    后台线程定时用一次批量查询读取所有订阅中小说的进度，再分发给全部订阅者，
+    打开再多的页面，每个进程每个周期也只访问一次数据库
+    """
+
+    def __init__(self, poll_interval=None):
+        self.poll_interval = poll_interval or Config.PROGRESS_POLL_INTERVAL
+        # 小说编号 -> 订阅数
+        self._subscriptions: typing.Dict[int, int] = {}
+        self._snapshot: typing.Dict[int, dict] = {}
+        # 每次进度变化时加1，订阅者据此判断是否有新数据
+        self._version = 0
+        self._condition = threading.Condition()
+        # 有新的小说被订阅时唤醒后台线程，马上读取一次
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self, app):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, args=(app,), name='progress-hub', daemon=True)
+                self._thread.start()
+
+    @contextlib.contextmanager
+    def subscribe(self, app, fiction_ids):
+        """
+        订阅一组小说的进度，退出时取消订阅
+
+        Args:
+            app: flask应用，后台线程中使用它的应用上下文
+            fiction_ids: 小说编号列表
+        """
+        self._ensure_thread(app)
+        with self._condition:
+            for fiction_id in fiction_ids:
+                self._subscriptions[fiction_id] = self._subscriptions.get(fiction_id, 0) + 1
+        self._wakeup.set()
+        try:
+            yield
+        finally:
+            with self._condition:
+                for fiction_id in fiction_ids:
+                    self._subscriptions[fiction_id] -= 1
+                    if not self._subscriptions[fiction_id]:
+                        del self._subscriptions[fiction_id]
+                        self._snapshot.pop(fiction_id, None)
+
+    def wait(self, version, timeout):
+        """
+        等待进度版本超过version，超时后也返回
+
+        Args:
+            version: 订阅者已经处理过的版本
+            timeout: 最长等待时间，单位秒
+
+        Returns:
+            typing.Tuple[int, typing.Dict[int, dict]]，当前版本和全部订阅中小说的进度
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._version > version, timeout)
+            return self._version, dict(self._snapshot)
+
+    def poll(self, app):
+        """
+        读取一次全部订阅中小说的进度，有变化时通知订阅者
+        """
+        with self._condition:
+            fiction_ids = list(self._subscriptions)
+        if not fiction_ids:
+            return
+        with app.app_context():
+            try:
+                progress = load_progress(fiction_ids)
+            finally:
+                db.session.remove()
+        with self._condition:
+            changed = False
+            for fiction_id, item in progress.items():
+                if fiction_id in self._subscriptions and self._snapshot.get(fiction_id) != item:
+                    self._snapshot[fiction_id] = item
+                    changed = True
+            if changed:
+                self._version += 1
+                self._condition.notify_all()
+
+    def _run(self, app):
+        while True:
+            start_time = time.time()
+            try:
+                self.poll(app)
+            except Exception as e:
+                logger.error(e)
+            self._wakeup.wait(max(self.poll_interval - (time.time() - start_time), 0))
+            self._wakeup.clear()
+
+
+# 进程内共享的进度推送中心
+progress_hub = ProgressHub()
@@ -3,13 +3,21 @@
 # @Author  : AaronJny
 # @Time    : 2020/03/05
 # @Desc    :
+import math
+import queue
+import random
+import threading
+from loguru import logger
 import pika
 from config import Config
 
 
-def create_rabbitmq_connection():
+def create_rabbitmq_connection(confirm_delivery=True):
     """
     创建并初始化rabbitmq连接，返回连接和channel
+
+    Args:
+        confirm_delivery: 是否开启发布确认
     """
     # 创建连接
     parameters = pika.URLParameters(Config.RABBITMQ_URL)
@@ -20,11 +28,167 @@ def create_rabbitmq_connection():
                              durable=True, auto_delete=False)
     channel.queue_declare(queue=Config.RABBITMQ_QUEUE, auto_delete=True)
     channel.queue_bind(queue=Config.RABBITMQ_QUEUE, exchange=Config.RABBITMQ_EXCHANGE, routing_key=Config.ROUTING_KEY)
+    declare_retry_queues(channel)
     # 接收确认消息
-    channel.confirm_delivery()
+    if confirm_delivery:
+        channel.confirm_delivery()
     return connection, channel
 
 
+def retry_queue_name(level):
+    """
+    第level级延迟重试队列的名称
+    """
+    return '{}.retry.{}'.format(Config.RABBITMQ_QUEUE, level)
+
+
+def dead_letter_queue_name():
+    """
+    死信队列的名称，超过重试次数的消息会被放到这里
+    """
+    return '{}.dead'.format(Config.RABBITMQ_QUEUE)
+
+
+def parked_queue_name(level):
+    """
+    第level级暂存队列的名称，来源网站熔断期间的消息在这里等待，不消耗重试次数
+    """
+    return '{}.parked.{}'.format(Config.RABBITMQ_QUEUE, level)
+
+
+def parked_queue_levels():
+    """
+    暂存队列的级数，第level级存放等待时间不超过2**level秒的消息，最后一级可以容纳熔断的全部时间
+    """
+    return math.ceil(math.log2(max(Config.BREAKER_OPEN_SECONDS, 1))) + 1
+
+
+def parked_queue_level(delay):
+    """
+    等待delay秒的消息应该放入的暂存队列级别。
+    消息只有在队首时才会过期，按等待时间分级，避免等待短的消息被排在前面的长等待消息挡住
+    """
+    level = math.ceil(math.log2(delay)) if delay > 1 else 0
+    return min(level, parked_queue_levels() - 1)
+
+
+def queue_depths():
+    """
+    通过新建的连接查询采集队列、各级延迟重试队列、暂存队列和死信队列中等待的消息数
+
+    Returns:
+        typing.Dict[str, int]，队列名称和消息数
+    """
+    queue_names = [Config.RABBITMQ_QUEUE] + [retry_queue_name(level) for level in range(Config.RETRY_MAX_ATTEMPTS)]
+    queue_names += [parked_queue_name(level) for level in range(parked_queue_levels())]
+    queue_names += [dead_letter_queue_name()]
+    connection = pika.BlockingConnection(pika.URLParameters(Config.RABBITMQ_URL))
+    try:
+        channel = connection.channel()
+        depths = {}
+        for queue_name in queue_names:
+            try:
+                depths[queue_name] = channel.queue_declare(queue=queue_name, passive=True).method.message_count
+            except pika.exceptions.ChannelClosedByBroker:
+                # 队列还不存在，被动声明失败后信道会被关闭，重新打开
+                channel = connection.channel()
+        return depths
+    finally:
+        connection.close()
+
+
+def retry_queue_arguments():
+    """
+    延迟重试队列的参数。延迟队列没有消费者，消息过期后经死信交换机回到采集队列
+    """
+    return {
+        'x-dead-letter-exchange': Config.RABBITMQ_EXCHANGE,
+        'x-dead-letter-routing-key': Config.ROUTING_KEY
+    }
+
+
+def declare_retry_queues(channel):
+    """
+    声明各级延迟重试队列、各级暂存队列和死信队列。
+    每一级队列中的消息延迟时间相近，避免延迟短的消息被排在前面的长延迟消息挡住
+
+    Args:
+        channel: 信道
+    """
+    for level in range(Config.RETRY_MAX_ATTEMPTS):
+        channel.queue_declare(queue=retry_queue_name(level), durable=True, arguments=retry_queue_arguments())
+    for level in range(parked_queue_levels()):
+        channel.queue_declare(queue=parked_queue_name(level), durable=True, arguments=retry_queue_arguments())
+    channel.queue_declare(queue=dead_letter_queue_name(), durable=True)
+
+
+def compute_retry_delay(retry_count):
+    """
+    计算第retry_count次重试前的等待时间，指数退避并加入随机抖动
+
+    Args:
+        retry_count: 已经重试过的次数
+
+    Returns:
+        等待时间，单位秒
+    """
+    delay = min(Config.RETRY_MAX_DELAY, Config.RETRY_BASE_DELAY * 2 ** retry_count)
+    return delay * random.uniform(1 - Config.RETRY_JITTER, 1 + Config.RETRY_JITTER)
+
+
+def get_retry_count(properties):
+    """
+    从消息属性中读取已经重试过的次数
+    """
+    headers = getattr(properties, 'headers', None) or {}
+    return int(headers.get('x-retry-count', 0))
+
+
+def send_retry_msg(channel, data, retry_count, delay=None, content_type='application/json'):
+    """
+    将处理失败的消息放到延迟重试队列中，等待一段时间后回到采集队列。
+    重试次数用完时放到死信队列中
+
+    Args:
+        channel: 信道
+        data: 消息内容
+        retry_count: 已经重试过的次数
+        delay: 等待时间，单位秒，默认按重试次数指数退避
+        content_type: 数据类型
+
+    Returns:
+        是否放入了延迟重试队列，放入死信队列时返回False
+    """
+    if retry_count >= Config.RETRY_MAX_ATTEMPTS:
+        props = pika.BasicProperties(content_type=content_type, delivery_mode=2,
+                                     headers={'x-retry-count': retry_count})
+        channel.basic_publish('', routing_key=dead_letter_queue_name(), body=data, properties=props)
+        return False
+    if delay is None:
+        delay = compute_retry_delay(retry_count)
+    props = pika.BasicProperties(content_type=content_type, delivery_mode=2, expiration=str(int(delay * 1000)),
+                                 headers={'x-retry-count': retry_count + 1})
+    level = min(retry_count, Config.RETRY_MAX_ATTEMPTS - 1)
+    channel.basic_publish('', routing_key=retry_queue_name(level), body=data, properties=props)
+    return True
+
+
+def send_parked_msg(channel, data, delay, retry_count=0, content_type='application/json'):
+    """
+    将消息放入对应级别的暂存队列，等待delay秒后回到采集队列，重试次数保持不变
+
+    Args:
+        channel: 信道
+        data: 消息内容
+        delay: 等待时间，单位秒
+        retry_count: 已经重试过的次数
+        content_type: 数据类型
+    """
+    props = pika.BasicProperties(content_type=content_type, delivery_mode=2, expiration=str(int(delay * 1000)),
+                                 headers={'x-retry-count': retry_count})
+    channel.basic_publish('', routing_key=parked_queue_name(parked_queue_level(delay)), body=data, properties=props)
+
+
 def send_msg(channel, data, content_type='application/json'):
     """
     通过channel将content_type类型的数据data写入到消息队列中
@@ -36,3 +200,88 @@ def send_msg(channel, data, content_type='application/json'):
     """
     props = pika.BasicProperties(content_type=content_type, delivery_mode=2)
     channel.basic_publish(Config.RABBITMQ_EXCHANGE, routing_key=Config.ROUTING_KEY, body=data, properties=props)
+
+
+class MessagePublisher:
+    """
+    后台批量发布消息的发布器，一个进程内复用同一个连接。
+    信道使用事务模式，每批消息只在提交时等待一次broker确认，而不是每条消息都同步等待。
+    待发布的消息只保存在内存中，进程退出时没有发布完的任务由TaskJobs.fail_orphaned_jobs标记为失败
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or Config.PUBLISH_BATCH_SIZE
+        self.connection = None
+        self.channel = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, bodies, callback=None):
+        """
+        提交一组待发布的消息，立即返回，消息在后台线程中发布
+
+        Args:
+            bodies: 消息内容列表
+            callback: 回调函数callback(published, finished, error)，每发布一批调用一次，
+                      全部发布完成或出错时finished为True
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='message-publisher', daemon=True)
+                self._thread.start()
+        self._queue.put((bodies, callback))
+
+    def _ensure_channel(self):
+        if self.connection is None or self.connection.is_closed:
+            self.connection, self.channel = create_rabbitmq_connection(confirm_delivery=False)
+            self.channel.tx_select()
+        return self.channel
+
+    def _close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.error(e)
+        self.connection = None
+        self.channel = None
+
+    def _publish(self, bodies, callback):
+        published = 0
+        try:
+            channel = self._ensure_channel()
+            for start in range(0, len(bodies), self.batch_size):
+                for body in bodies[start:start + self.batch_size]:
+                    send_msg(channel, body)
+                channel.tx_commit()
+                published = min(start + self.batch_size, len(bodies))
+                if callback and published < len(bodies):
+                    callback(published, False, None)
+        except Exception as e:
+            logger.error(e)
+            self._close()
+            if callback:
+                callback(published, True, e)
+            return
+        if callback:
+            callback(published, True, None)
+
+    def _run(self):
+        while True:
+            try:
+                bodies, callback = self._queue.get(timeout=10)
+            except queue.Empty:
+                # 空闲时处理心跳，保持连接
+                if self.connection is not None and self.connection.is_open:
+                    try:
+                        self.connection.process_data_events()
+                    except Exception as e:
+                        logger.error(e)
+                        self._close()
+                continue
+            self._publish(bodies, callback)
+
+
+# 进程内共享的消息发布器
+publisher = MessagePublisher()
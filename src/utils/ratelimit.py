@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# @File    : ratelimit.py
+# @Author  : AaronJny
+# @Time    : 2020/03/19
+# @Desc    : 多进程共享的按域名限流器
+import asyncio
+import contextlib
+import time
+from config import Config
+from .sqlite_store import SqliteStore
+
+
+class DomainRateLimiter(SqliteStore):
+    """
+    按域名限流的令牌桶，同一台机器上的多个进程通过同一个sqlite文件共享请求额度。
+    每个域名同时限制每秒请求数、突发请求数和同时进行中的请求数，
+    并按AIMD规则自动调整速率：请求正常时每秒大约增加increase_step，遇到429、5xx、异常或响应过慢时成倍减少
+    """
+
+    def __init__(self, db_path, rate=None, burst=None, max_concurrent=None, min_rate=None, max_rate=None,
+                 slow_seconds=None, increase_step=0.1, decrease_factor=0.5, decrease_interval=1.0,
+                 lease_timeout=60):
+        super().__init__(db_path)
+        self.rate = rate or Config.RATE_LIMIT_RATE
+        self.burst = burst or Config.RATE_LIMIT_BURST
+        self.max_concurrent = max_concurrent or Config.RATE_LIMIT_MAX_CONCURRENT
+        self.min_rate = min_rate or Config.RATE_LIMIT_MIN_RATE
+        self.max_rate = max_rate or Config.RATE_LIMIT_MAX_RATE
+        self.slow_seconds = slow_seconds or Config.RATE_LIMIT_SLOW_SECONDS
+        # 每秒增加的速率，每个成功的请求只增加increase_step / rate，避免速率越高增加得越快
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        # 两次减速之间的最短间隔，避免同一时刻的一批失败请求把速率连续减半
+        self.decrease_interval = decrease_interval
+        # 进程异常退出时未归还的请求名额，超过这个时间后自动失效
+        self.lease_timeout = lease_timeout
+
+    def init_schema(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS buckets (domain TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                     'rate REAL NOT NULL, updated_at REAL NOT NULL, decreased_at REAL NOT NULL DEFAULT 0)')
+        conn.execute('CREATE TABLE IF NOT EXISTS leases (lease_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                     'domain TEXT NOT NULL, expire_at REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_leases_domain ON leases (domain)')
+
+    def _load_bucket(self, conn, domain, now):
+        row = conn.execute('SELECT tokens, rate, updated_at FROM buckets WHERE domain = ?', (domain,)).fetchone()
+        if not row:
+            conn.execute('INSERT INTO buckets (domain, tokens, rate, updated_at) VALUES (?, ?, ?, ?)',
+                         (domain, self.burst, self.rate, now))
+            return float(self.burst), self.rate
+        tokens, rate, updated_at = row
+        # 按经过的时间补充令牌
+        tokens = min(self.burst, tokens + max(now - updated_at, 0) * rate)
+        return tokens, rate
+
+    def try_acquire(self, domain):
+        """
+        尝试获取一个请求名额
+
+        Args:
+            domain: 域名
+
+        Returns:
+            typing.Tuple[typing.Optional[int], float]，获取成功时返回名额编号和0，否则返回None和建议等待的秒数
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            tokens, rate = self._load_bucket(conn, domain, now)
+            conn.execute('DELETE FROM leases WHERE expire_at < ?', (now,))
+            in_flight = conn.execute('SELECT COUNT(*) FROM leases WHERE domain = ?', (domain,)).fetchone()[0]
+            lease_id = None
+            if in_flight >= self.max_concurrent:
+                wait_seconds = 0.05
+            elif tokens < 1:
+                wait_seconds = (1 - tokens) / rate
+            else:
+                tokens -= 1
+                wait_seconds = 0
+                cursor = conn.execute('INSERT INTO leases (domain, expire_at) VALUES (?, ?)',
+                                      (domain, now + self.lease_timeout))
+                lease_id = cursor.lastrowid
+            conn.execute('UPDATE buckets SET tokens = ?, updated_at = ? WHERE domain = ?', (tokens, now, domain))
+        return lease_id, wait_seconds
+
+    def acquire(self, domain):
+        """
+        阻塞直到获取一个请求名额
+
+        Args:
+            domain: 域名
+
+        Returns:
+            名额编号
+        """
+        while True:
+            lease_id, wait_seconds = self.try_acquire(domain)
+            if lease_id is not None:
+                return lease_id
+            time.sleep(wait_seconds)
+
+    async def acquire_async(self, domain):
+        """
+        在asyncio中等待获取一个请求名额。
+        其他进程持有写锁时sqlite事务会阻塞等待，放到线程池中执行，不阻塞事件循环
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            future = loop.run_in_executor(None, self.try_acquire, domain)
+            try:
+                lease_id, wait_seconds = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 线程中的事务不会被取消，拿到名额后立即归还
+                future.add_done_callback(self._cancel_acquired)
+                raise
+            if lease_id is not None:
+                return lease_id
+            await asyncio.sleep(wait_seconds)
+
+    def _cancel_acquired(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        lease_id, _ = future.result()
+        if lease_id is not None:
+            self.cancel_soon(lease_id)
+
+    def release(self, lease_id, domain, elapsed, status_code=None, error=False):
+        """
+        归还请求名额，并根据请求结果调整速率
+
+        Args:
+            lease_id: 名额编号
+            domain: 域名
+            elapsed: 请求耗时，单位秒
+            status_code: 响应状态码
+            error: 请求是否抛出了异常
+        """
+        now = time.time()
+        throttled = error or status_code == 429 or (status_code or 0) >= 500 or elapsed > self.slow_seconds
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM leases WHERE lease_id = ?', (lease_id,))
+            row = conn.execute('SELECT rate, decreased_at FROM buckets WHERE domain = ?', (domain,)).fetchone()
+            if not row:
+                return
+            rate, decreased_at = row
+            if throttled:
+                if now - decreased_at >= self.decrease_interval:
+                    conn.execute('UPDATE buckets SET rate = ?, decreased_at = ? WHERE domain = ?',
+                                 (max(self.min_rate, rate * self.decrease_factor), now, domain))
+            elif rate < self.max_rate:
+                conn.execute('UPDATE buckets SET rate = ? WHERE domain = ?',
+                             (min(self.max_rate, rate + self.increase_step / rate), domain))
+
+    async def release_async(self, lease_id, domain, elapsed, status_code=None, error=False):
+        """
+        在asyncio中归还请求名额，参数同release
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self.release, lease_id, domain, elapsed, status_code,
+                                                       error)
+
+    def cancel(self, lease_id):
+        """
+        归还请求被取消的名额，不调整速率
+
+        Args:
+            lease_id: 名额编号
+        """
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM leases WHERE lease_id = ?', (lease_id,))
+
+    def cancel_soon(self, lease_id):
+        """
+        在asyncio任务被取消时调用，在线程池中归还名额，不需要等待
+        """
+        asyncio.get_event_loop().run_in_executor(None, self.cancel, lease_id)
+
+    @contextlib.contextmanager
+    def limit(self, domain):
+        """
+        在with语句中占用一个请求名额，退出时自动归还。
+        with语句中可以把响应状态码写入返回的dict中，用于调整速率
+
+        Args:
+            domain: 域名
+        """
+        lease_id = self.acquire(domain)
+        result = {'status_code': None}
+        start_time = time.time()
+        try:
+            yield result
+        except Exception:
+            self.release(lease_id, domain, time.time() - start_time, result['status_code'], error=True)
+            raise
+        else:
+            self.release(lease_id, domain, time.time() - start_time, result['status_code'])
+
+    def stats(self):
+        """
+        查询各域名当前的限流状态
+
+        Returns:
+            typing.List[dict]
+        """
+        now = time.time()
+        rows = self.fetchall('SELECT b.domain, b.tokens, b.rate, b.updated_at, '
+                             '(SELECT COUNT(*) FROM leases l WHERE l.domain = b.domain AND l.expire_at >= ?) '
+                             'FROM buckets b ORDER BY b.domain', (now,))
+        stats = []
+        for domain, tokens, rate, updated_at, in_flight in rows:
+            stats.append({
+                'domain': domain,
+                'rate': round(rate, 3),
+                'tokens': round(min(self.burst, tokens + max(now - updated_at, 0) * rate), 3),
+                'in_flight': in_flight,
+                'burst': self.burst,
+                'max_concurrent': self.max_concurrent
+            })
+        return stats
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# @File    : segment_store.py
+# @Author  : AaronJny
+# @Time    : 2020/03/23
+# @Desc    : 按小说追加写入章节内容的段文件存储
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import time
+import typing
+from config import Config
+
+
+class SegmentStore:
+    """
+    章节内容段文件存储。
+    每本小说一个目录，章节内容依次追加到当前代的段文件中，数据库只保存(代号, 偏移, 长度, 摘要)。
+    整理时按章节顺序把有效内容写入新一代段文件，导出时就是顺序读取；被替换的段文件保留retain_seconds秒，
+    避免正在导出的请求读不到文件
+    """
+
+    def __init__(self, root, retain_seconds=None):
+        self.root = root
+        self.retain_seconds = Config.SEGMENT_RETAIN_SECONDS if retain_seconds is None else retain_seconds
+
+    def _dir(self, fiction_id):
+        path = os.path.join(self.root, str(fiction_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def segment_path(self, fiction_id, generation):
+        return os.path.join(self._dir(fiction_id), '{}.seg'.format(generation))
+
+    @contextlib.contextmanager
+    def lock(self, fiction_id):
+        """
+        同一本小说的段文件同一时间只允许一个进程修改。
+        写入方需要持有锁直到数据库事务提交，避免整理时漏掉还没有提交的章节
+        """
+        with open(os.path.join(self._dir(fiction_id), 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def current_generation(self, fiction_id):
+        """
+        当前写入的段文件代号，需要在持有锁时调用
+        """
+        try:
+            with open(os.path.join(self._dir(fiction_id), 'CURRENT')) as f:
+                return int(f.read().strip() or 1)
+        except FileNotFoundError:
+            return 1
+
+    def _set_current_generation(self, fiction_id, generation):
+        path = os.path.join(self._dir(fiction_id), 'CURRENT')
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(generation))
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def content_hash(cls, data: bytes):
+        return hashlib.sha1(data).hexdigest()
+
+    def append(self, fiction_id, blobs: typing.List[bytes]):
+        """
+        把一批章节内容追加到当前段文件，需要在持有锁时调用。内容相同的章节只写入一次
+
+        Args:
+            fiction_id: 小说编号
+            blobs: 章节内容列表
+
+        Returns:
+            typing.Tuple[int, typing.List[typing.Tuple[int, int, str]]]，段文件代号和每个章节的(偏移, 长度, 摘要)
+        """
+        generation = self.current_generation(fiction_id)
+        locations = []
+        written = {}
+        with open(self.segment_path(fiction_id, generation), 'ab') as f:
+            offset = f.tell()
+            for blob in blobs:
+                digest = self.content_hash(blob)
+                if digest not in written:
+                    f.write(blob)
+                    written[digest] = offset
+                    offset += len(blob)
+                locations.append((written[digest], len(blob), digest))
+            f.flush()
+            os.fsync(f.fileno())
+        return generation, locations
+
+    def compact(self, fiction_id, blobs: typing.Iterable[typing.Tuple[typing.Any, bytes]]):
+        """
+        把有效的章节内容按给定顺序写入新一代段文件，需要在持有锁时调用。
+        调用方在数据库中更新章节位置并提交后，再调用activate切换到新一代
+
+        Args:
+            fiction_id: 小说编号
+            blobs: (章节标识, 章节内容)，按导出顺序排列
+
+        Returns:
+            typing.Tuple[int, typing.List[typing.Tuple[typing.Any, int, int, str]]]，
+            新段文件代号和每个章节的(章节标识, 偏移, 长度, 摘要)
+        """
+        generation = self.current_generation(fiction_id) + 1
+        locations = []
+        written = {}
+        with open(self.segment_path(fiction_id, generation), 'wb') as f:
+            offset = 0
+            for key, blob in blobs:
+                digest = self.content_hash(blob)
+                if digest not in written:
+                    f.write(blob)
+                    written[digest] = offset
+                    offset += len(blob)
+                locations.append((key, written[digest], len(blob), digest))
+            f.flush()
+            os.fsync(f.fileno())
+        return generation, locations
+
+    def activate(self, fiction_id, generation):
+        """
+        切换到新一代段文件，并删除被替换超过保留时间的旧段文件。需要在持有锁时调用。
+        连续整理时，上一代段文件可能还在被流式导出读取，不能只保留上一代
+        """
+        previous_path = self.segment_path(fiction_id, self.current_generation(fiction_id))
+        self._set_current_generation(fiction_id, generation)
+        # 用修改时间记录段文件被替换的时间，被替换后不会再写入
+        if os.path.exists(previous_path):
+            os.utime(previous_path)
+        expire_time = time.time() - self.retain_seconds
+        for name in os.listdir(self._dir(fiction_id)):
+            path = os.path.join(self._dir(fiction_id), name)
+            if name.endswith('.seg') and int(name[:-4]) < generation and os.path.getmtime(path) < expire_time:
+                os.remove(path)
+
+    def discard(self, fiction_id, generation):
+        """
+        整理失败时删除写了一半的新段文件
+        """
+        path = self.segment_path(fiction_id, generation)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def segment_sizes(self, fiction_id):
+        """
+        各代段文件的大小
+
+        Returns:
+            typing.Dict[int, int]
+        """
+        sizes = {}
+        for name in os.listdir(self._dir(fiction_id)):
+            if name.endswith('.seg'):
+                sizes[int(name[:-4])] = os.path.getsize(os.path.join(self._dir(fiction_id), name))
+        return sizes
+
+    def remove(self, fiction_id):
+        """
+        删除小说的全部段文件
+        """
+        path = os.path.join(self.root, str(fiction_id))
+        if not os.path.exists(path):
+            return
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+    def reader(self):
+        return SegmentReader(self)
+
+
+class SegmentReader:
+    """
+    通过mmap读取段文件，同一个读取器中打开的文件会被复用，用完后需要调用close
+    """
+
+    def __init__(self, store: SegmentStore):
+        self.store = store
+        self._maps: typing.Dict[typing.Tuple[int, int], typing.Tuple[typing.IO, mmap.mmap]] = {}
+
+    def read(self, fiction_id, generation, offset, length, content_hash=None):
+        """
+        读取一个章节的内容
+
+        Args:
+            fiction_id: 小说编号
+            generation: 段文件代号
+            offset: 偏移
+            length: 长度
+            content_hash: 内容摘要，不为空时校验读取到的内容
+        """
+        if not length:
+            return b''
+        key = (fiction_id, generation)
+        opened = self._maps.get(key)
+        if opened is not None and len(opened[1]) < offset + length:
+            # 打开之后文件又追加了内容，重新映射
+            opened[1].close()
+            opened[0].close()
+            opened = None
+        if opened is None:
+            f = open(self.store.segment_path(fiction_id, generation), 'rb')
+            opened = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self._maps[key] = opened
+        data = opened[1][offset:offset + length]
+        if len(data) != length or (content_hash and SegmentStore.content_hash(data) != content_hash):
+            raise Exception('小说{}的段文件{}已损坏！'.format(fiction_id, generation))
+        return data
+
+    def close(self):
+        for f, mapped in self._maps.values():
+            mapped.close()
+            f.close()
+        self._maps = {}
+
+
+# 进程内共享的段文件存储
+store = SegmentStore(Config.SEGMENT_PATH)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# @File    : sqlite_store.py
+# @Author  : AaronJny
+# @Time    : 2020/03/15
+# @Desc    : 基于sqlite的本地共享存储，供同一台机器上的多个进程共享状态
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# 驱动层等待锁的时间，单位毫秒。驱动层等待时不会让出gevent的事件循环，只保留很短的时间
+BUSY_TIMEOUT_MS = 50
+
+
+class SqliteStore:
+    """
+    sqlite存储基本类，子类在init_schema中建表。
+    连接保存在进程内共享的连接池中：gunicorn使用gevent时threading.local按协程隔离，
+    按线程保存连接会让每个请求都新建连接、重新设置PRAGMA和建表
+    """
+    # 连接池中最多保留的空闲连接数
+    pool_size = 4
+    # 等待写锁的最长时间，单位秒
+    lock_timeout = 10
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._pool = queue.LifoQueue()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._pid = os.getpid()
+
+    def _connect(self):
+        dir_path = os.path.dirname(self.db_path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        # 自行管理事务，写入时使用BEGIN IMMEDIATE提前拿到写锁；连接会在线程之间复用
+        conn = sqlite3.connect(self.db_path, timeout=self.lock_timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with self._schema_lock:
+            if not self._schema_ready:
+                self.init_schema(conn)
+                self._schema_ready = True
+        conn.execute('PRAGMA busy_timeout={}'.format(BUSY_TIMEOUT_MS))
+        return conn
+
+    def init_schema(self, conn: sqlite3.Connection):
+        raise NotImplementedError
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        从连接池中取出一个连接，用完后放回
+        """
+        if self._pid != os.getpid():
+            # fork出的子进程不能使用父进程的连接
+            self._pool = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(conn)
+            else:
+                conn.close()
+
+    def fetchone(self, sql, parameters=()):
+        with self.connection() as conn:
+            return conn.execute(sql, parameters).fetchone()
+
+    def fetchall(self, sql, parameters=()):
+        with self.connection() as conn:
+            return conn.execute(sql, parameters).fetchall()
+
+    def _begin(self, conn: sqlite3.Connection):
+        """
+        开启写事务。写锁被其他连接持有时用time.sleep轮询等待，gevent下不会阻塞同一进程中的其他协程
+        """
+        deadline = time.time() + self.lock_timeout
+        delay = 0.001
+        while True:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or time.time() >= deadline:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        开启一个写事务，跨进程互斥
+        """
+        with self.connection() as conn:
+            self._begin(conn)
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')